@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""import_time.py: Measures how long it takes to import fccsmap's look-up
+modules and to run `fccsmap --version`, each in a fresh interpreter, and
+reports which of the heavy dependencies were loaded in doing so.
+
+Usage:
+
+    python3 benchmarks/import_time.py [-n NUM_RUNS] [-o OUTPUT_FILE]
+
+Results are output as json.
+"""
+
+__author__      = "Joel Dubowy"
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+HEAVY_MODULES = ['geopandas', 'numpy', 'osgeo', 'pyproj', 'rasterio',
+    'rasterstats', 'rioxarray', 'shapely']
+
+IMPORT_CODE = """
+import json, sys, time
+t = time.perf_counter()
+import {modules}
+t = time.perf_counter() - t
+print(json.dumps({{'seconds': t, 'loaded': [m for m in {heavy!r}
+    if m in sys.modules]}}))
+"""
+
+def _env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+def _summarize(times):
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'max': max(times)
+    }
+
+def time_import(modules, num_runs):
+    """Times importing `modules` in num_runs separate interpreters"""
+    code = IMPORT_CODE.format(modules=', '.join(modules), heavy=HEAVY_MODULES)
+    runs = [json.loads(subprocess.run([sys.executable, '-c', code],
+        env=_env(), check=True, capture_output=True, text=True).stdout)
+        for i in range(num_runs)]
+    return dict(_summarize([r['seconds'] for r in runs]),
+        heavy_modules_loaded=runs[0]['loaded'])
+
+def time_command(args, num_runs):
+    """Times running a command, start to finish, num_runs times"""
+    times = []
+    for i in range(num_runs):
+        t = time.perf_counter()
+        p = subprocess.run(args, env=_env(), capture_output=True)
+        times.append(time.perf_counter() - t)
+        if p.returncode != 0:
+            return {'error': p.stderr.decode().strip().splitlines()[-1:]}
+    return _summarize(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--num-runs', type=int, default=5,
+        help="number of times to run each; default 5")
+    parser.add_argument('-o', '--output-file',
+        help="file to write results to; default stdout")
+    args = parser.parse_args()
+
+    results = {
+        'python': sys.version.split()[0],
+        'num_runs': args.num_runs,
+        'imports': {
+            'fccsmap.lookup': time_import(['fccsmap.lookup'], args.num_runs),
+            'fccsmap.tileslookup': time_import(['fccsmap.tileslookup'],
+                args.num_runs),
+            # for reference, what a look-up will pay on first use
+            'heavy_modules': time_import(['geopandas', 'rasterio',
+                'rasterstats', 'shapely'], args.num_runs),
+        },
+        'commands': {
+            'fccsmap --version': time_command([sys.executable,
+                os.path.join(ROOT_DIR, 'bin', 'fccsmap'), '--version'],
+                args.num_runs)
+        }
+    }
+
+    output = json.dumps(results, indent=4)
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+"""look_ups.py: Benchmarks FccsLookUp and FccsTilesLookUp look-ups, against
+synthetic data generated locally, across geometry types and sizes,
+sampling escalations, and batch sizes.
+
+Each scenario is run in its own process, so that its peak RSS can be
+measured, and is warmed up with one look-up (which opens the raster or
+tiles index) before being timed. Results, including throughput, latency
+percentiles, and peak RSS, are output as json, which can be compared
+with those of a previous run (e.g. of a previous release) with --compare.
+
+Usage:
+
+    python3 benchmarks/look_ups.py [-d DATA_DIR] [-n NUM_LOOK_UPS] \\
+        [-s SCENARIO ...] [-l file|tiles ...] [-O OPTION=JSON_VALUE ...] \\
+        [-o OUTPUT_FILE] [--compare PREVIOUS_OUTPUT_FILE]
+
+Examples:
+
+    python3 benchmarks/look_ups.py -o results.json
+    python3 benchmarks/look_ups.py -s point polygon_large -l file \\
+        -O summed_area_tables=true --compare results.json
+"""
+
+__author__      = "Joel Dubowy"
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic_data
+
+try:
+    import fccsmap
+except ImportError:
+    sys.path.insert(0, os.path.abspath(os.path.join(sys.path[0], '..')))
+    import fccsmap
+
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(),
+    'fccsmap-benchmark-data')
+DEFAULT_NUM_LOOK_UPS = 50
+
+# Inner bounds of the synthetic data, avoiding its nodata edge
+LNG_RANGE = (-123.0, -117.5)
+LAT_RANGE = (45.8, 49.2)
+
+
+##
+## Scenarios
+##
+
+def _random_point(rng, margin=0.0):
+    return [float(rng.uniform(LNG_RANGE[0] + margin, LNG_RANGE[1] - margin)),
+        float(rng.uniform(LAT_RANGE[0] + margin, LAT_RANGE[1] - margin))]
+
+def _square(lng, lat, size):
+    return [[[lng, lat], [lng + size, lat], [lng + size, lat + size],
+        [lng, lat + size], [lng, lat]]]
+
+def _points(rng, n, metadata, area_acres=None):
+    return [({"type": "Point", "coordinates": _random_point(rng)}, area_acres)
+        for i in range(n)]
+
+def _lake_points(rng, n, metadata, km_inside=None):
+    """Points in the grid cell km_inside grid cells from the lake's
+    northern edge, or at its center, all of which require the sampling
+    area to be expanded at least once
+    """
+    from pyproj import Transformer
+
+    x, y = metadata['lake_center']
+    if km_inside is not None:
+        y += (metadata['lake_half_width_km'] - km_inside) * 1000
+    lng, lat = Transformer.from_crs(metadata['crs'], "EPSG:4326",
+        always_xy=True).transform(x, y)
+    return [({"type": "Point", "coordinates": [lng, lat]}, None)
+        for i in range(n)]
+
+def _multipoints(rng, n, metadata, num_points):
+    return [({"type": "MultiPoint", "coordinates": [
+            [c + float(rng.uniform(-0.1, 0.1)) for c in center]
+            for j in range(num_points)]}, None)
+        for center in [_random_point(rng, 0.1) for i in range(n)]]
+
+def _polygons(rng, n, metadata, size):
+    return [({"type": "Polygon", "coordinates": _square(
+            *_random_point(rng, size), size)}, None)
+        for i in range(n)]
+
+def _multipolygons(rng, n, metadata, num_polygons, size):
+    return [({"type": "MultiPolygon", "coordinates": [
+            _square(*_random_point(rng, size), size)
+            for j in range(num_polygons)]}, None)
+        for i in range(n)]
+
+def _mixed(rng, n, metadata):
+    geometries = []
+    for i in range(n):
+        geometries.extend([_points, _polygons][i % 2](rng, 1, metadata,
+            *([] if i % 2 == 0 else [0.02])))
+    return geometries
+
+# name: (function generating (geo_data, area_acres) tuples, extra args,
+#   batch size (None for individual look-ups), relative number of look-ups)
+SCENARIOS = {
+    'point': (_points, {}, None, 1),
+    'point_with_area_small': (_points, {'area_acres': 50}, None, 1),
+    'point_with_area_large': (_points, {'area_acres': 50000}, None, 1),
+    'point_escalated_once': (_lake_points, {'km_inside': 2}, None, 1),
+    'point_escalated_twice': (_lake_points, {'km_inside': 4}, None, 1),
+    'point_all_ignored': (_lake_points, {}, None, 1),
+    'multipoint_2': (_multipoints, {'num_points': 2}, None, 1),
+    'multipoint_10': (_multipoints, {'num_points': 10}, None, 0.5),
+    'polygon_small': (_polygons, {'size': 0.01}, None, 1),
+    'polygon_medium': (_polygons, {'size': 0.1}, None, 0.5),
+    'polygon_large': (_polygons, {'size': 1.0}, None, 0.1),
+    'multipolygon': (_multipolygons, {'num_polygons': 3, 'size': 0.05},
+        None, 0.5),
+    'batch_10': (_mixed, {}, 10, 4),
+    'batch_100': (_mixed, {}, 100, 10),
+}
+
+LOOK_UP_CLASSES = ('file', 'tiles')
+
+
+##
+## Running scenarios
+##
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(int(p * len(sorted_values)),
+        len(sorted_values) - 1)]
+
+def _create_lookup(look_up_class, metadata, options):
+    if look_up_class == 'file':
+        from fccsmap.lookup import FccsLookUp
+        return FccsLookUp(fccs_fuelload_file=metadata['raster_file'],
+            **options)
+    else:
+        from fccsmap.tileslookup import FccsTilesLookUp
+        return FccsTilesLookUp(tiles_directory=metadata['tiles_directory'],
+            **options)
+
+def run_scenario(look_up_class, scenario, metadata, num_look_ups, options,
+        seed=0):
+    """Runs a single scenario in the current process, returning its stats"""
+    import numpy
+
+    func, kwargs, batch_size, factor = SCENARIOS[scenario]
+    n = max(int(num_look_ups * factor), batch_size or 1)
+    num_warm_up = batch_size or 1
+    rng = numpy.random.default_rng(seed)
+    geometries = func(rng, n + num_warm_up, metadata, **kwargs)
+    warm_up, geometries = geometries[:num_warm_up], geometries[num_warm_up:]
+
+    t = time.perf_counter()
+    lookup = _create_lookup(look_up_class, metadata, options)
+    if batch_size:
+        call = lambda chunk: lookup.look_up_many([g for g, a in chunk],
+            [a for g, a in chunk])
+        calls = [geometries[i:i + batch_size]
+            for i in range(0, len(geometries), batch_size)]
+        call(warm_up)
+    else:
+        call = lambda g: lookup.look_up(*g)
+        calls = geometries
+        call(warm_up[0])
+    first_call = time.perf_counter() - t
+    setup_rss = _peak_rss_mb()
+
+    latencies = []
+    start = time.perf_counter()
+    for c in calls:
+        t = time.perf_counter()
+        call(c)
+        latencies.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'num_calls': len(calls),
+        'num_geometries': len(geometries),
+        'batch_size': batch_size,
+        'total_s': total,
+        'throughput_per_s': len(geometries) / total,
+        'latency_s': {
+            'mean': total / len(calls),
+            'p50': _percentile(latencies, 0.5),
+            'p99': _percentile(latencies, 0.99),
+            'max': latencies[-1]
+        },
+        'first_call_s': first_call,
+        'setup_peak_rss_mb': setup_rss,
+        'peak_rss_mb': _peak_rss_mb()
+    }
+
+def run_scenario_in_subprocess(look_up_class, scenario, metadata,
+        num_look_ups, options, seed):
+    spec = json.dumps([look_up_class, scenario, metadata, num_look_ups,
+        options, seed])
+    p = subprocess.run([sys.executable, os.path.abspath(__file__),
+        '--run-scenario', spec], capture_output=True, text=True)
+    if p.returncode != 0:
+        return {'error': p.stderr.strip().splitlines()[-1:]}
+    return json.loads(p.stdout)
+
+
+##
+## Comparing results
+##
+
+def compare(previous, current):
+    """Returns the ratio of current to previous throughput, latency, and
+    peak RSS, for each scenario run in both
+    """
+    comparison = {}
+    for look_up_class, scenarios in current['results'].items():
+        for scenario, stats in scenarios.items():
+            prev = previous['results'].get(look_up_class, {}).get(scenario)
+            if not prev or 'error' in prev or 'error' in stats:
+                continue
+            comparison.setdefault(look_up_class, {})[scenario] = {
+                'throughput': stats['throughput_per_s'] / prev['throughput_per_s'],
+                'p50': stats['latency_s']['p50'] / prev['latency_s']['p50'],
+                'p99': stats['latency_s']['p99'] / prev['latency_s']['p99'],
+                'peak_rss': stats['peak_rss_mb'] / prev['peak_rss_mb']
+            }
+    return {
+        'previous': {k: previous.get(k) for k in ('fccsmap_version', 'created')},
+        'ratios': comparison
+    }
+
+
+##
+## Main
+##
+
+def _package_versions():
+    versions = {}
+    for name in ('numpy', 'rasterio', 'rasterstats', 'shapely', 'geopandas',
+            'pyproj'):
+        try:
+            versions[name] = __import__(name).__version__
+        except ImportError:
+            versions[name] = None
+    return versions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--data-dir', default=DEFAULT_DATA_DIR,
+        help="directory in which to generate (or reuse) synthetic data; "
+            f"default {DEFAULT_DATA_DIR}")
+    parser.add_argument('--seed', type=int, default=0,
+        help="random seed for data and geometries; default 0")
+    parser.add_argument('-n', '--num-look-ups', type=int,
+        default=DEFAULT_NUM_LOOK_UPS, help="base number of look-ups per "
+            f"scenario (scaled per scenario); default {DEFAULT_NUM_LOOK_UPS}")
+    parser.add_argument('-s', '--scenarios', nargs='+', choices=SCENARIOS,
+        default=list(SCENARIOS), metavar='SCENARIO',
+        help="scenarios to run; default all: " + ', '.join(SCENARIOS))
+    parser.add_argument('-l', '--look-up-classes', nargs='+',
+        choices=LOOK_UP_CLASSES, default=list(LOOK_UP_CLASSES),
+        help="look-up classes to benchmark; default both")
+    parser.add_argument('-O', '--option', action='append', default=[],
+        dest='options', metavar='OPTION=JSON_VALUE',
+        help="look-up option, e.g. -O summed_area_tables=true")
+    parser.add_argument('-o', '--output-file',
+        help="file to write results to; default stdout")
+    parser.add_argument('--compare', metavar='PREVIOUS_OUTPUT_FILE',
+        help="include comparison with previous results")
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.run_scenario:
+        print(json.dumps(run_scenario(*json.loads(args.run_scenario))))
+        return
+
+    options = {k: json.loads(v) for k, v in
+        (o.split('=', 1) for o in args.options)}
+    metadata = synthetic_data.create_data(args.data_dir, args.seed)
+
+    results = {
+        'fccsmap_version': fccsmap.__version__,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'packages': _package_versions(),
+        'seed': args.seed,
+        'num_look_ups': args.num_look_ups,
+        'options': options,
+        'results': {
+            look_up_class: {
+                scenario: run_scenario_in_subprocess(look_up_class, scenario,
+                    metadata, args.num_look_ups, options, args.seed)
+                for scenario in args.scenarios
+            } for look_up_class in args.look_up_classes
+        }
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            results['comparison'] = compare(json.load(f), results)
+
+    output = json.dumps(results, indent=4)
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""synthetic_data.py: Generates a synthetic FCCS raster and tile set, so that
+look-ups can be benchmarked without bundled or downloaded data.
+
+The raster is in EPSG:5070 (Conus Albers), with 1km grid cells, covering
+most of Washington state. Fuelbeds are assigned in 7x7 blocks, with some
+noise, so that neighborhoods are realistically coherent. There's a band
+of nodata along the western edge, and a square lake (fuelbed 900), so
+that point look-ups within it trigger sampling escalation.
+"""
+
+__author__      = "Joel Dubowy"
+
+import json
+import os
+
+BOUNDS = (-124.0, 45.5, -117.0, 49.5)  # lng/lat
+RESOLUTION = 1000.0
+CRS = "EPSG:5070"
+NODATA = -9999
+
+FUELBEDS = [0, 900, 52, 24, 60, 4, 319, 237, 9, 61]
+FUELBED_WEIGHTS = [.15, .1, .25, .1, .1, .05, .05, .1, .05, .05]
+
+LAKE_CENTER = (-120.5, 47.5)  # lng/lat
+LAKE_HALF_WIDTH_KM = 8
+
+RASTER_FILE_NAME = "fccs.tif"
+TILES_DIRECTORY_NAME = "tiles"
+METADATA_FILE_NAME = "synthetic_data.json"
+
+def create_raster(filename, seed=0):
+    """Writes the synthetic raster to filename, and returns its
+    metadata, including the location of the lake in the raster's crs
+    """
+    import numpy
+    import rasterio
+    from pyproj import Transformer
+
+    to_raster_crs = Transformer.from_crs("EPSG:4326", CRS, always_xy=True)
+    xs, ys = zip(*[to_raster_crs.transform(x, y)
+        for x in BOUNDS[0::2] for y in BOUNDS[1::2]])
+    minx, maxy = min(xs), max(ys)
+    width = int((max(xs) - minx) / RESOLUTION) + 1
+    height = int((maxy - min(ys)) / RESOLUTION) + 1
+
+    rng = numpy.random.default_rng(seed)
+    fuelbeds = numpy.array(FUELBEDS, dtype=numpy.int32)
+    blocks = rng.choice(fuelbeds, size=(height // 7 + 1, width // 7 + 1),
+        p=FUELBED_WEIGHTS)
+    data = numpy.kron(blocks, numpy.ones((7, 7), dtype=numpy.int32))[
+        :height, :width]
+    noise = rng.random((height, width)) < 0.2
+    data[noise] = rng.choice(fuelbeds, size=int(noise.sum()))
+    data[:, :40] = NODATA
+
+    transform = rasterio.transform.from_origin(minx, maxy,
+        RESOLUTION, RESOLUTION)
+    lake_x, lake_y = to_raster_crs.transform(*LAKE_CENTER)
+    lake_row, lake_col = rasterio.transform.rowcol(transform, lake_x, lake_y)
+    # The lake is surrounded by a fuelbed that's not ignored, so that
+    # exactly how many times sampling is escalated for points within the
+    # lake depends only on their distance from its edge
+    border = LAKE_HALF_WIDTH_KM + 5
+    data[lake_row - border:lake_row + border,
+        lake_col - border:lake_col + border] = 52
+    data[lake_row - LAKE_HALF_WIDTH_KM:lake_row + LAKE_HALF_WIDTH_KM,
+        lake_col - LAKE_HALF_WIDTH_KM:lake_col + LAKE_HALF_WIDTH_KM] = 900
+
+    with rasterio.open(filename, 'w', driver='GTiff', width=width,
+            height=height, count=1, dtype='int32', crs=CRS, nodata=NODATA,
+            transform=transform, tiled=True, blockxsize=256,
+            blockysize=256) as dst:
+        dst.write(data, 1)
+
+    return {
+        'raster_file': filename,
+        'shape': [height, width],
+        'seed': seed,
+        'crs': CRS,
+        # center of the lake's center grid cell, in the raster's crs
+        'lake_center': list(rasterio.transform.xy(transform,
+            lake_row, lake_col)),
+        'lake_half_width_km': LAKE_HALF_WIDTH_KM
+    }
+
+def create_tiles(raster_file, tiles_directory, tile_size=128):
+    """Splits raster_file into tile_size x tile_size tiles, and writes
+    them to tiles_directory along with index shapefile and compact index,
+    as fccscreatetiles would
+    """
+    import geopandas
+    import rasterio
+    import shapely
+    from rasterio.windows import Window
+
+    from fccsmap.tileslookup import (create_compact_index,
+        DEFAULT_COMPACT_INDEX_FILE_NAME, DEFAULT_INDEX_SHAPEFILE_NAME)
+
+    os.makedirs(tiles_directory, exist_ok=True)
+    records = []
+    with rasterio.open(raster_file) as src:
+        profile = dict(src.profile, tiled=False)
+        profile.pop('blockxsize', None)
+        profile.pop('blockysize', None)
+        for row in range(0, src.height, tile_size):
+            for col in range(0, src.width, tile_size):
+                window = Window(col, row, min(tile_size, src.width - col),
+                    min(tile_size, src.height - row))
+                name = f"fccs_{row // tile_size}_{col // tile_size}.tif"
+                with rasterio.open(os.path.join(tiles_directory, name), 'w',
+                        **dict(profile, width=window.width,
+                            height=window.height,
+                            transform=src.window_transform(window))) as dst:
+                    dst.write(src.read(1, window=window), 1)
+                records.append({'location': name, 'geometry': shapely.box(
+                    *rasterio.windows.bounds(window, src.transform))})
+
+    index_shapefile = os.path.join(tiles_directory,
+        DEFAULT_INDEX_SHAPEFILE_NAME)
+    geopandas.GeoDataFrame(records, crs=CRS).to_file(index_shapefile)
+    create_compact_index(index_shapefile,
+        os.path.join(tiles_directory, DEFAULT_COMPACT_INDEX_FILE_NAME))
+    return len(records)
+
+def create_data(directory, seed=0):
+    """Creates the raster and tiles in directory, unless already created
+    with the same seed, and returns the metadata
+    """
+    metadata_file = os.path.join(directory, METADATA_FILE_NAME)
+    if os.path.exists(metadata_file):
+        with open(metadata_file) as f:
+            metadata = json.load(f)
+        if metadata['seed'] == seed:
+            return metadata
+
+    os.makedirs(directory, exist_ok=True)
+    metadata = create_raster(os.path.join(directory, RASTER_FILE_NAME), seed)
+    metadata['tiles_directory'] = os.path.join(directory,
+        TILES_DIRECTORY_NAME)
+    metadata['num_tiles'] = create_tiles(metadata['raster_file'],
+        metadata['tiles_directory'])
+    with open(metadata_file, 'w') as f:
+        json.dump(metadata, f, indent=4)
+    return metadata
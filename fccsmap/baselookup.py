@@ -1,55 +1,163 @@
 import abc
-import datetime
+import concurrent.futures
+import contextlib
+import functools
 import json
 import logging
 import math
+import numbers
+import os
+import threading
+import time
+import weakref
 from collections import defaultdict, OrderedDict
 
-import geopandas
-import numpy
-from rasterstats import zonal_stats
-import rioxarray
-import shapely
+# asyncio, geopandas, numpy, rasterio, rasterstats, and shapely take a
+# while to load, so they're imported in the methods that use them, rather
+# than here, so that importing fccsmap (e.g. to run `fccsmap --help`) is fast
+
+from . import instrumentation
+from .cache import DiskLookUpCache, LookUpCache
+from .instrumentation import LookUpMetrics
+from .profiling import LookUpProfiler
 
 __all__ = [
     "time_me", "BaseLookUp"
 ]
 
 def time_me(message_header="TIME-ME"):
+    """Logs, at DEBUG level, how long the decorated function takes. Used
+    for one-off operations, like creating indexes; the stages of look-ups
+    are timed with fccsmap.instrumentation.
+    """
     def _time_me(func):
         def _(*args, **kwargs):
-            n = datetime.datetime.now()
+            n = time.perf_counter()
             r = func(*args,  **kwargs)
-            t = (datetime.datetime.now() - n).total_seconds()
+            t = time.perf_counter() - n
             logging.debug(f"{message_header}: {func.__name__} {t}s")
             return r
         return _
     return _time_me
 
 
+# Each worker process in the pool used by look_up_many creates its own
+# look-up object, once, which it then uses for each chunk it's given
+_worker_lookup = None
+
+def _init_worker(lookup_class, options):
+    global _worker_lookup
+    _worker_lookup = lookup_class(**options)
+
+def _look_up_chunk_in_worker(chunk):
+    geometries, area_acres = chunk
+    return _worker_lookup._look_up_many_raw(geometries, area_acres)
+
+
 class BaseLookUp(metaclass=abc.ABCMeta):
 
     CONFIG_DEFAULTS = {
+        "async_max_large_look_ups": None,
+        "async_num_workers": 4,
+        "batch_chunk_size": 500,
+        "cache_coordinate_precision": 6,
+        "cache_size": None,
+        "chunk_memory_budget_mb": None,
+        "coverage_weighting": False,
+        "disk_cache_file": None,
         "ignored_fuelbeds": ('0', '900'),
         "ignored_percent_resampling_threshold": 99.9,  # instead of 100.0, to account for rounding errors
+        "independent_point_sampling": False,
         "insignificance_threshold": 10.0, # set to 0 to not remove
         "max_fuelbed_count_threshold": None,
         "no_sampling": False,
+        "num_processes": 1,
+        "profile_directory": None,
+        "profile_latency_threshold": None,
+        "profile_memory_threshold_mb": None,
+        "rasterio_engine": False,
         "sampling_radius_km": 1.0,
         "sampling_radius_factors": [1, 3, 5],
+        "single_read_sampling": False,
         "use_all_grid_cells": False,
     }
 
     OPTIONS_STRING = """
+         - async_max_large_look_ups -- maximum number of look_up_async
+            calls for geometries that aren't sampled (e.g. polygons), and of
+            chunks of look_up_many_async calls, to run at once, so that they
+            can't occupy all async_num_workers threads and hold up smaller
+            look-ups; default: one less than async_num_workers
+         - async_num_workers -- number of threads in which to run
+            look_up_async and look_up_many_async calls; default: 4
+         - batch_chunk_size -- number of geometries given to each worker
+            process at a time; only plays a part in look_up_many when
+            num_processes is greater than 1, and in look_up_many_async
+         - cache -- LookUpCache object to use, allowing a cache to be
+            shared by multiple look-up objects (python only; overrides
+            cache_size)
+         - cache_coordinate_precision -- number of decimal places to which
+            coordinates are rounded when keying cached results; default: 6
+         - cache_size -- maximum number of look-up results to cache in
+            memory; results are cached prior to removal of ignored fuelbeds
+            and truncation; default: no caching
+         - chunk_memory_budget_mb -- look up geometries whose raster
+            windows would take more than this many MB to read and count
+            (e.g. those of very large regions) by splitting their windows
+            into chunks of the raster's internal blocks, each read and
+            counted separately, so that peak memory is capped at roughly
+            this many MB (but no less than one block), not counting
+            GDAL's block cache (see GDAL_CACHEMAX); implies rasterio_engine,
+            but isn't applied by FccsLookUp's summed area tables or point
+            grid; default: no chunking
+         - coverage_weighting -- weight each grid cell by the fraction of
+            its area within the geometry, rather than counting whole cells
+            whose centers are within it, so that the reported grid_cells
+            are fractional; implies rasterio_engine, but isn't applied by
+            FccsLookUp's summed area tables or point grid
+         - disk_cache_file -- SQLite file in which to persist look-up
+            results (as cached in memory, with cache_size), so that they
+            can be reused across processes and runs; default: none
          - ignored_fuelbeds -- fuelbeds to ignore
          - ignored_percent_resampling_threshold -- percentage of ignored
             fuelbeds which should trigger resampling in larger area; only
             plays a part in Point and MultiPoint look-ups
+         - independent_point_sampling -- sample the area around each point
+            of a MultiPoint independently, enlarging the sampling area only
+            for those points that need it, and then combine the results,
+            weighting each point equally (since each is considered to
+            represent an equal share of the total area)
+         - instrumentation_hooks -- functions to call with the timings
+            of each stage of each look-up call, and counts of what it
+            involved, as a dict (python only); see fccsmap.instrumentation
          - insignificance_threshold -- remove least prevalent fuelbeds that
             cumulatively add up to no more that this percentage; default: 10.0
          - max_fuelbed_count_threshold -- maximum number of fuelbeds to return
+         - metrics -- LookUpMetrics object in which to accumulate look-up
+            timings and counts, allowing metrics to be shared by multiple
+            look-up objects (python only)
          - no_sampling -- don't sample surrounding area for Point
             and MultiPoint geometries
+         - num_processes -- number of worker processes to spread
+            look_up_many's work across; each opens the raster data once
+            and looks up chunks of batch_chunk_size geometries
+         - profile_directory -- directory in which to write profiles of
+            look-up calls exceeding profile_latency_threshold or
+            profile_memory_threshold_mb, along with the geometries looked
+            up, for offline analysis; see fccsmap.profiling; default: no
+            profiling
+         - profile_latency_threshold -- run look-ups under cProfile,
+            writing profiles of those taking at least this many seconds;
+            only plays a part if profile_directory is set
+         - profile_memory_threshold_mb -- trace memory allocations of
+            look-ups with tracemalloc, writing the top allocations of
+            those whose peak traced memory is at least this many MB; only
+            plays a part if profile_directory is set
+         - rasterio_engine -- look up fuelbeds by reading just the window
+            of the raster covering each geometry with rasterio, rasterizing
+            the geometry, and counting grid cells with numpy, instead of
+            using rasterstats; note that partial cells are then those that
+            the geometry touches rather than all those within its bounds
          - sampling_radius_km -- distance, in km, from points to start sampling
          - sampling_radius_factors -- increasing size of sampling area,
             expressed as a factor times the sampling radius (or grid resolution,
@@ -57,6 +165,11 @@ class BaseLookUp(metaclass=abc.ABCMeta):
             e.g. With 1km data, [1,3,5] would mean sampling a 2km x 2km area around
             the point, followed by a 6km x 6km area, and finally a 10km x 10km
             area (if necessary).
+         - single_read_sampling -- read the raster window covering the
+            largest sampling area once, and sample each of the smaller areas
+            from it in memory, rather than reading the raster for each
+            sampling; only plays a part in Point and MultiPoint look-ups,
+            and is only supported by look-ups against a single raster file
          - use_all_grid_cells -- Consider FCCS map grid cells entirely within
             the area of interest as well as cells partially outside of the area.
             (The default behavior is to ignore partial cells, unless there are no
@@ -82,6 +195,45 @@ class BaseLookUp(metaclass=abc.ABCMeta):
                 logging.debug(f"Setting {attr} to {val}")
                 setattr(self, attr, val)
 
+        if self._coverage_weighting or self._chunk_memory_budget_mb:
+            self._rasterio_engine = True
+
+        # Recorded for creating look-up objects in worker processes
+        self._options = options
+
+        self._cache = options.get('cache')
+        if self._cache is None and self._cache_size:
+            self._cache = LookUpCache(self._cache_size)
+        self._disk_cache = (DiskLookUpCache(self._disk_cache_file)
+            if self._disk_cache_file else None)
+        self._cache_config_key = json.dumps({
+            k: getattr(self, f"_{k}") for k in self.CONFIG_DEFAULTS
+                if k not in self.CACHE_KEY_EXCLUDED_OPTIONS
+        }, sort_keys=True)
+
+        # Created on first use, by _run_async, since most look-up
+        # objects are never used asynchronously
+        self._async_executor = None
+        # asyncio semaphores are bound to the event loop in which they're
+        # first waited on, so there's one per loop
+        self._large_look_up_semaphores = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
+
+        # Guards reads from (and lazy opening of) raster datasets that are
+        # kept open and shared across look-ups
+        self._raster_lock = threading.Lock()
+
+        self._metrics = options.get('metrics')
+        if self._metrics is None:
+            self._metrics = LookUpMetrics()
+        self._instrumentation_hooks = list(
+            options.get('instrumentation_hooks') or [])
+
+        self._profiler = (LookUpProfiler(self._profile_directory,
+                self._profile_latency_threshold,
+                self._profile_memory_threshold_mb)
+            if self._profile_directory else None)
+
     ##
     ## Public Interface
     ##
@@ -129,30 +281,216 @@ class BaseLookUp(metaclass=abc.ABCMeta):
         if hasattr(geo_data, 'capitalize'):
             geo_data = json.loads(geo_data)
 
-        if not self._no_sampling and geo_data["type"] in ('Point', 'MultiPoint'):
+        with (self._instrumented_call('look_up'),
+                self._profiled('look_up', geo_data, area_acres)):
+            instrumentation.count('geometries')
+            cache_key = self._cache_key(geo_data, area_acres)
+            stats = self._get_cached(cache_key)
+            if stats is None:
+                stats = self._look_up_raw(geo_data, area_acres)
+                self._put_cached(cache_key, stats)
+            else:
+                instrumentation.count('cache_hits')
 
-            # If area_acres is defined, and if this is a MultiPoint, we want
-            # to search an area around each point based on its fraction of
-            # the total area. So, divide area_acres by the number of points
-            area_acres_per_point = (
-                (area_acres / len(geo_data['coordinates']))
-                if (area_acres and geo_data["type"] == 'MultiPoint')
-                else area_acres
-            )
+            return self._post_process(stats)
 
-            sampling_radius_km = self._sampling_radius_from_area(area_acres_per_point)
+    def look_up_many(self, geometries, area_acres=None):
+        """Looks up FCCS fuelbed information within each of multiple
+        regions, batching the work across them (e.g. reprojecting them
+        all at once and opening each raster file once for all of them)
 
-            for radius_factor in self._sampling_radius_factors:
-                logging.debug(f"Sampling {radius_factor} * sampling radius")
+        Arguments
+         - geometries -- iterable of vector data, each json formatted
+            (or already loaded), as would be passed to look_up
+
+        Kwargs
+        - area_acres -- either a single area applying to each of the
+            geometries, or an iterable of areas (or None values), one per
+            geometry; only relevent to Point and MultiPoint data
+
+        Returns a list of results, each as would be returned by look_up,
+        in the same order as geometries.
+
+        Note that batching saves reprojection and per-call overhead, not
+        raster reads; each geometry's window of the raster is still read
+        and counted separately.
+
+        Also note that the single_read_sampling option doesn't apply here,
+        since each escalation of sampling is already done in one batch
+        for all geometries that require it.
+        """
+        geometries, area_acres = self._load_look_up_many_args(geometries,
+            area_acres)
+
+        with (self._instrumented_call('look_up_many'),
+                self._profiled('look_up_many', geometries, area_acres)):
+            instrumentation.count('geometries', len(geometries))
+            cache_keys = [self._cache_key(g, a)
+                for g, a in zip(geometries, area_acres)]
+            results = [self._get_cached(k) for k in cache_keys]
+
+            missing = [i for i, stats in enumerate(results) if stats is None]
+            instrumentation.count('cache_hits',
+                len(geometries) - len(missing))
+            if missing:
+                missing_geometries = [geometries[i] for i in missing]
+                missing_area_acres = [area_acres[i] for i in missing]
+                if (self._num_processes and self._num_processes > 1
+                        and len(missing) > self._batch_chunk_size):
+                    stats = self._look_up_many_in_parallel(
+                        missing_geometries, missing_area_acres)
+                else:
+                    stats = self._look_up_many_raw(missing_geometries,
+                        missing_area_acres)
+
+                for i, s in zip(missing, stats):
+                    results[i] = s
+                    self._put_cached(cache_keys[i], s)
+
+            return [self._post_process(stats) for stats in results]
+
+    async def look_up_async(self, geo_data, area_acres=None):
+        """Asynchronous version of look_up, which runs the look-up in
+        a thread, so as not to block the event loop.  Look-ups of
+        geometries that aren't sampled (e.g. polygons) are limited to
+        async_max_large_look_ups at a time.  If cancelled before
+        the thread starts on it, the look-up isn't run at all.
+        """
+        if hasattr(geo_data, 'capitalize'):
+            geo_data = json.loads(geo_data)
+
+        return await self._run_async(not self._is_sampled(geo_data),
+            self.look_up, geo_data, area_acres)
+
+    async def look_up_many_async(self, geometries, area_acres=None):
+        """Asynchronous version of look_up_many, which looks up
+        batch_chunk_size geometries at a time, each chunk in a thread,
+        limited as are large look-ups in look_up_async.  If cancelled,
+        chunks not yet started aren't looked up.
+        """
+        geometries, area_acres = self._load_look_up_many_args(geometries,
+            area_acres)
+
+        results = []
+        n = self._batch_chunk_size
+        for i in range(0, len(geometries), n):
+            results.extend(await self._run_async(True, self.look_up_many,
+                geometries[i:i+n], area_acres[i:i+n]))
+
+        return results
+
+    def close(self):
+        """Shuts down the threads in which look_up_async and
+        look_up_many_async calls are run, if any were started, waiting
+        for any look-ups in progress to finish.  They're started again
+        if needed.
+        """
+        with self._async_lock:
+            executor, self._async_executor = self._async_executor, None
+        if executor:
+            executor.shutdown(wait=True)
+
+    @property
+    def cache(self):
+        """The LookUpCache used by this object, if caching is enabled,
+        e.g. for inspecting its hit, miss, and eviction counts
+        """
+        return self._cache
+
+    @property
+    def disk_cache(self):
+        """The DiskLookUpCache used by this object, if enabled"""
+        return self._disk_cache
+
+    @property
+    def metrics(self):
+        """The LookUpMetrics in which this object's look-up timings and
+        counts are accumulated, e.g. for exporting to a monitoring system
+        """
+        return self._metrics
 
-                new_geo_data = self._transform_points(geo_data,
-                    radius_factor * sampling_radius_km)
-                stats = self._look_up(new_geo_data)
-                logging.debug(f"Stats from sampling {stats}")
+    ##
+    ## Helper methods
+    ##
 
-                if not self._has_high_percent_of_ignored(stats):
-                    break
-            # at this point, if all water, we'll stick with it
+    def _load_look_up_many_args(self, geometries, area_acres):
+        geometries = [json.loads(g) if hasattr(g, 'capitalize') else g
+            for g in geometries]
+        if area_acres is None or isinstance(area_acres, numbers.Number):
+            area_acres = [area_acres] * len(geometries)
+        else:
+            area_acres = list(area_acres)
+            if len(area_acres) != len(geometries):
+                raise ValueError("area_acres must be a single value or "
+                    "have one value per geometry")
+        return geometries, area_acres
+
+    def _instrumented_call(self, method):
+        return instrumentation.call(method, self._metrics,
+            self._instrumentation_hooks)
+
+    def _profiled(self, method, geo_data, area_acres):
+        if self._profiler is None:
+            return contextlib.nullcontext()
+        return self._profiler.profile(method, geo_data, area_acres)
+
+    async def _run_async(self, is_large, func, *args):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            if self._async_executor is None:
+                self._async_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._async_num_workers)
+            executor = self._async_executor
+            semaphore = self._large_look_up_semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self._async_max_large_look_ups
+                    or max(self._async_num_workers - 1, 1))
+                self._large_look_up_semaphores[loop] = semaphore
+
+        if not is_large:
+            return await loop.run_in_executor(executor,
+                functools.partial(func, *args))
+
+        # The permit is held until the look-up itself finishes (or is
+        # cancelled before starting), rather than until the awaiting task
+        # is cancelled, since a look-up can't be stopped once its thread
+        # has started on it
+        await semaphore.acquire()
+        try:
+            future = executor.submit(func, *args)
+        except BaseException:
+            semaphore.release()
+            raise
+        future.add_done_callback(
+            lambda f: self._release_from_thread(loop, semaphore))
+        return await asyncio.wrap_future(future)
+
+    @staticmethod
+    def _release_from_thread(loop, semaphore):
+        try:
+            loop.call_soon_threadsafe(semaphore.release)
+        except RuntimeError:
+            # The loop is closed, and the semaphore with it
+            pass
+
+    def _look_up_raw(self, geo_data, area_acres):
+        """Returns stats for geo_data prior to removal of ignored
+        fuelbeds and truncation
+        """
+        if self._is_sampled(geo_data):
+            sampling_radius_km = self._sampling_radius_from_area(
+                self._area_acres_per_point(geo_data, area_acres))
+            if (self._independent_point_sampling
+                    and geo_data["type"] == 'MultiPoint'):
+                stats = self._merge_point_stats([
+                    self._sample({"type": "Point", "coordinates": c},
+                        sampling_radius_km)
+                    for c in geo_data['coordinates']
+                ])
+            else:
+                stats = self._sample(geo_data, sampling_radius_km)
 
             stats['sampled_grid_cells'] = stats.pop('grid_cells', None)
             stats['sampled_area'] = stats.pop('area', None)
@@ -160,6 +498,165 @@ class BaseLookUp(metaclass=abc.ABCMeta):
         else:
             stats = self._look_up(geo_data)
 
+        return stats
+
+    def _look_up_many_raw(self, geometries, area_acres):
+        """Batch version of _look_up_raw"""
+        results = [None] * len(geometries)
+
+        not_sampled = [i for i, g in enumerate(geometries)
+            if not self._is_sampled(g)]
+        if not_sampled:
+            stats = self._look_up_batch([geometries[i] for i in not_sampled])
+            for i, s in zip(not_sampled, stats):
+                results[i] = s
+
+        # Each sampling input is a (geo_data, sampling radius) tuple,
+        # recorded along with the index of the geometry it belongs to. With
+        # independent_point_sampling, MultiPoints are broken up into points
+        sampling_indices = []
+        sampling_inputs = []
+        for i, geo_data in enumerate(geometries):
+            if self._is_sampled(geo_data):
+                sampling_radius_km = self._sampling_radius_from_area(
+                    self._area_acres_per_point(geo_data, area_acres[i]))
+                if (self._independent_point_sampling
+                        and geo_data["type"] == 'MultiPoint'):
+                    for c in geo_data['coordinates']:
+                        sampling_indices.append(i)
+                        sampling_inputs.append(({"type": "Point",
+                            "coordinates": c}, sampling_radius_km))
+                else:
+                    sampling_indices.append(i)
+                    sampling_inputs.append((geo_data, sampling_radius_km))
+
+        per_geometry_sampled_stats = defaultdict(list)
+        for i, stats in zip(sampling_indices,
+                self._sample_many(sampling_inputs)):
+            per_geometry_sampled_stats[i].append(stats)
+
+        for i, sampled_stats in per_geometry_sampled_stats.items():
+            if (self._independent_point_sampling
+                    and geometries[i]["type"] == 'MultiPoint'):
+                stats = self._merge_point_stats(sampled_stats)
+            else:
+                stats = sampled_stats[0]
+            stats['sampled_grid_cells'] = stats.pop('grid_cells', None)
+            stats['sampled_area'] = stats.pop('area', None)
+            results[i] = stats
+
+        return results
+
+    def _look_up_many_in_parallel(self, geometries, area_acres):
+        n = self._batch_chunk_size
+        chunks = [(geometries[i:i+n], area_acres[i:i+n])
+            for i in range(0, len(geometries), n)]
+        logging.debug(f"Looking up {len(chunks)} chunks of geometries "
+            f"in {self._num_processes} processes")
+
+        # Workers look up their chunks serially. Results are cached, and
+        # timings recorded, here, in the parent process, so workers don't
+        # need a cache, instrumentation, or profiling
+        options = dict(self._options, num_processes=1, cache_size=None,
+            disk_cache_file=None, profile_directory=None)
+        for k in ('cache', 'metrics', 'instrumentation_hooks'):
+            options.pop(k, None)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self._num_processes, initializer=_init_worker,
+                initargs=(self.__class__, options)) as executor:
+            # map returns results in the order of chunks
+            return [stats
+                for chunk_results in executor.map(
+                    _look_up_chunk_in_worker, chunks)
+                for stats in chunk_results]
+
+    # Config options that affect neither which grid cells are counted
+    # nor how sampling proceeds, and so are left out of cache keys
+    CACHE_KEY_EXCLUDED_OPTIONS = (
+        'async_max_large_look_ups', 'async_num_workers', 'batch_chunk_size',
+        'cache_coordinate_precision', 'cache_size', 'chunk_memory_budget_mb',
+        'disk_cache_file',
+        'insignificance_threshold', 'max_fuelbed_count_threshold',
+        'num_processes', 'profile_directory', 'profile_latency_threshold',
+        'profile_memory_threshold_mb', 'single_read_sampling'
+    )
+
+    def _cache_key(self, geo_data, area_acres):
+        """Returns the key for caching geo_data's look-up results, or
+        None if caching is disabled.  The key combines the raster's
+        fingerprint, the config options affecting results prior to
+        post-processing, area_acres, and the normalized geometry, with
+        coordinates rounded to cache_coordinate_precision decimal places.
+        """
+        import numpy
+        import shapely
+
+        if self._cache is None and self._disk_cache is None:
+            return None
+
+        shape = shapely.geometry.shape(geo_data)
+        shape = shapely.transform(shape,
+            lambda c: numpy.round(c, self._cache_coordinate_precision))
+        if not hasattr(self, '_raster_fingerprint'):
+            self._raster_fingerprint = self._compute_raster_fingerprint()
+        return (self._raster_fingerprint, self._cache_config_key,
+            area_acres, shapely.normalize(shape).wkb)
+
+    def _compute_raster_fingerprint(self):
+        """Identifies the raster data being looked up, for cache keys.
+        Overridden in derived classes.
+        """
+        return self.__class__.__name__
+
+    def _file_fingerprint(self, filename):
+        """Returns the file's absolute path, size, and modification time,
+        or just its url or path if remote or nonexistent"""
+        if filename.startswith('http') or not os.path.exists(filename):
+            return (filename,)
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        return (filename, stat.st_size, stat.st_mtime)
+
+    def _get_cached(self, cache_key):
+        """Checks the in-memory cache and then the disk cache, if enabled,
+        for cached results, saving disk cache hits in memory
+        """
+        if not cache_key:
+            return None
+
+        stats = self._cache.get(cache_key) if self._cache is not None else None
+        if stats is None and self._disk_cache is not None:
+            stats = self._disk_cache.get(cache_key)
+            if stats is not None and self._cache is not None:
+                self._cache.put(cache_key, stats)
+
+        return stats
+
+    def _put_cached(self, cache_key, stats):
+        if not cache_key:
+            return
+
+        if self._cache is not None:
+            self._cache.put(cache_key, stats)
+        if self._disk_cache is not None:
+            self._disk_cache.put(cache_key, stats)
+
+    def _is_sampled(self, geo_data):
+        return (not self._no_sampling
+            and geo_data["type"] in ('Point', 'MultiPoint'))
+
+    def _area_acres_per_point(self, geo_data, area_acres):
+        # If area_acres is defined, and if this is a MultiPoint, we want
+        # to search an area around each point based on its fraction of
+        # the total area. So, divide area_acres by the number of points
+        return (
+            (area_acres / len(geo_data['coordinates']))
+            if (area_acres and geo_data["type"] == 'MultiPoint')
+            else area_acres
+        )
+
+    @instrumentation.timed('post_processing')
+    def _post_process(self, stats):
         stats = self._remove_ignored(stats)
         stats = self._truncate(stats)
 
@@ -170,13 +667,8 @@ class BaseLookUp(metaclass=abc.ABCMeta):
                     key=lambda e: e[1]['percent']))
         })
 
-
         return stats
 
-    ##
-    ## Helper methods
-    ##
-
     SQUARE_KM_PER_ACRE = 0.00404686
 
     def _sampling_radius_from_area(self, area_acres):
@@ -187,6 +679,106 @@ class BaseLookUp(metaclass=abc.ABCMeta):
         dim = math.sqrt(area_square_km)
         return dim / 2
 
+    def _sample(self, geo_data, sampling_radius_km):
+        window = None
+        if self._single_read_sampling:
+            largest_geo_data = self._transform_points(geo_data,
+                max(self._sampling_radius_factors) * sampling_radius_km)
+            window = self._read_sampling_window(largest_geo_data)
+
+        for i, radius_factor in enumerate(self._sampling_radius_factors):
+            logging.debug(f"Sampling {radius_factor} * sampling radius")
+            if i > 0:
+                instrumentation.count('sampling_escalations')
+
+            new_geo_data = self._transform_points(geo_data,
+                radius_factor * sampling_radius_km)
+            if window:
+                stats = self._look_up_in_array(
+                    self._create_geo_data_df(new_geo_data), *window)
+            else:
+                stats = self._look_up_sampled([new_geo_data])[0]
+            logging.debug(f"Stats from sampling {stats}")
+
+            if not self._has_high_percent_of_ignored(stats):
+                break
+        # at this point, if all water, we'll stick with it
+
+        return stats
+
+    def _sample_many(self, sampling_inputs):
+        """Batch version of _sample. Each round of sampling is looked up
+        in one batch, for those inputs still with too high a percentage
+        of ignored fuelbeds.
+
+        Arguments
+         - sampling_inputs -- list of (geo_data, sampling_radius_km) tuples
+        """
+        stats = [None] * len(sampling_inputs)
+        pending = list(range(len(sampling_inputs)))
+        for round_number, radius_factor in enumerate(
+                self._sampling_radius_factors):
+            if not pending:
+                break
+            logging.debug(f"Sampling {radius_factor} * sampling radius "
+                f"for {len(pending)} inputs")
+            if round_number > 0:
+                instrumentation.count('sampling_escalations', len(pending))
+
+            round_stats = self._look_up_sampled([
+                self._transform_points(sampling_inputs[i][0],
+                    radius_factor * sampling_inputs[i][1])
+                for i in pending
+            ])
+
+            still_pending = []
+            for i, s in zip(pending, round_stats):
+                stats[i] = s
+                if self._has_high_percent_of_ignored(s):
+                    still_pending.append(i)
+            pending = still_pending
+        # at this point, if all water, we'll stick with it
+
+        return stats
+
+    def _look_up_sampled(self, geo_data_list):
+        """Looks up each of the sampling areas in geo_data_list, as
+        generated by _transform_points.  Derived classes may override this
+        to take advantage of the areas being squares.
+        """
+        if len(geo_data_list) == 1:
+            return [self._look_up(geo_data_list[0])]
+        return self._look_up_batch(geo_data_list)
+
+    @instrumentation.timed('aggregation')
+    def _merge_point_stats(self, per_point_stats):
+        """Combines the stats from independently sampling each point of a
+        MultiPoint, weighting each point equally, regardless of how large
+        an area had to be sampled around it.  Points with no grid cells
+        (e.g. outside of the raster) are left out of the weighting.
+        """
+        per_point_stats = [s for s in per_point_stats if s.get('grid_cells')]
+        fuelbeds = defaultdict(lambda: {'grid_cells': 0, 'percent': 0.0})
+        for stats in per_point_stats:
+            for fccs_id, fb in stats['fuelbeds'].items():
+                fuelbeds[fccs_id]['grid_cells'] += fb['grid_cells']
+                fuelbeds[fccs_id]['percent'] += (
+                    fb['percent'] / len(per_point_stats))
+
+        return {
+            'fuelbeds': dict(fuelbeds),
+            'grid_cells': sum([s['grid_cells'] for s in per_point_stats]),
+            'area': sum([s['area'] for s in per_point_stats]),
+            'units': 'm^2'
+        }
+
+    def _read_sampling_window(self, geo_data):
+        """Returns the (array, affine, nodata) of the raster window
+        covering geo_data, for sampling in memory, or None if
+        not supported.  Overridden in derived classes.
+        """
+        return None
+
 
     KM_PER_DEG_LAT = 111.0
     KM_PER_DEG_LNG_AT_EQUATOR = 111.321
@@ -238,42 +830,407 @@ class BaseLookUp(metaclass=abc.ABCMeta):
         """
         pass
 
-    @time_me()
+    def _look_up_batch(self, geo_data_list):
+        """Returns a list of stats, as returned by _look_up, for each of
+        geo_data_list. Derived classes may override this to batch the work.
+        """
+        return [self._look_up(geo_data) for geo_data in geo_data_list]
+
     def _create_geo_data_df(self, geo_data):
+        """Creates a data frame, in the raster's projection, with one row
+        for geo_data, or one row per geometry if geo_data is a list
+        """
+        import geopandas
+        import shapely
+
         logging.debug("Creating data frame of geo-data")
-        shape = shapely.geometry.shape(geo_data)
-        wgs84_df = geopandas.GeoDataFrame({'geometry': [shape]}, crs="EPSG:4326")
-        return wgs84_df.to_crs(self._crs)
+        with instrumentation.stage('dataframe_creation'):
+            geo_data_list = (geo_data if isinstance(geo_data, list)
+                else [geo_data])
+            shapes = [shapely.geometry.shape(g) for g in geo_data_list]
+            wgs84_df = geopandas.GeoDataFrame({'geometry': shapes},
+                crs="EPSG:4326")
+        with instrumentation.stage('reprojection'):
+            return wgs84_df.to_crs(self._crs)
+
+    def _covering_window(self, geo_data_df, transform):
+        """Returns the window of the raster that covers geo_data_df,
+        padded by one grid cell on each side so that rasterstats, which
+        recomputes the window from the geometry's bounds, finds the same
+        grid cells it would find reading from the file itself.
+        """
+        from rasterio import windows
+
+        minx, miny, maxx, maxy = geo_data_df.total_bounds
+        cols, rows = zip(*[~transform * (x, y)
+            for x in (minx, maxx) for y in (miny, maxy)])
+        return windows.Window.from_slices(
+            (math.floor(min(rows)) - 1, math.ceil(max(rows)) + 1),
+            (math.floor(min(cols)) - 1, math.ceil(max(cols)) + 1),
+            boundless=True)
+
+    def _dataset_lock(self, dataset):
+        """Returns the lock to hold while reading from `dataset`.  Datasets
+        opened for a single look-up (e.g. tiles) aren't shared, and so are
+        read without locking, concurrently.  Subclasses that keep datasets
+        open across look-ups return self._raster_lock for those.
+        """
+        return contextlib.nullcontext()
 
-    @time_me()
-    def _look_up_in_file(self, geo_data_df, filename):
+    def _read_window(self, geo_data_df, dataset, transform, nodata,
+            window=None):
+        """Reads the window of an open raster dataset that covers
+        geo_data_df (see _covering_window)
+        """
+        from rasterio import windows
+
+        window = window or self._covering_window(geo_data_df, transform)
+        boundless = (window.row_off < 0 or window.col_off < 0
+            or window.row_off + window.height > dataset.height
+            or window.col_off + window.width > dataset.width)
+
+        with (instrumentation.stage('raster_read'),
+                self._dataset_lock(dataset)):
+            array = dataset.read(1, window=window, boundless=boundless,
+                fill_value=nodata)
+
+        return array, windows.transform(window, transform)
+
+    @instrumentation.timed('counting')
+    def _look_up_in_file(self, geo_data_df, raster, transform=None,
+            nodata=None):
         """Determines the fuelbeds represented within geo_data_df and computes
         the percentage of each.  It does this by finding the grid cells whose
         centers are within geo_data_df and counts each with equal weight.
+
+        `raster` is either the name of a raster file or an open rasterio
+        dataset. In the latter case, only the window covering geo_data_df
+        is read, using `transform` and `nodata` if specified (to avoid
+        querying the dataset for them on each look-up).
         """
-        def counts(x):
-            # We'll ignore the mask (i.e. consider partial cells) if
-            # configured to do so or if the mask is all true values
-            # (i.e. all cells are partial)
-            ignore_mask = self._use_all_grid_cells or not any([
-                not val for subarray in x.mask  for val in subarray
-            ])
-            counts = defaultdict(lambda: 0)
-            for i in range(len(x.data)):
-                for j in range(len(x.data[i])):
-                    if (ignore_mask or not x.mask[i][j]) and x.data[i][j] >= 0:
-                        counts[x.data[i][j]] += 1
-            return dict(counts)
-
-        stats = zonal_stats(geo_data_df, filename,
-            add_stats={'counts':counts})
+        import rasterio
+        from rasterstats import zonal_stats
+
+        if hasattr(raster, 'read'):
+            transform = transform or raster.transform
+            nodata = nodata if nodata is not None else raster.nodata
+            window = self._covering_window(geo_data_df, transform)
+            if self._exceeds_chunk_memory_budget(window, raster):
+                return self._look_up_in_chunks(geo_data_df, raster,
+                    transform, nodata, window)
+            array, affine = self._read_window(geo_data_df, raster,
+                transform, nodata, window)
+            return self._look_up_in_array(geo_data_df, array, affine, nodata)
+
+        if self._rasterio_engine:
+            with rasterio.open(raster) as dataset:
+                return self._look_up_in_file(geo_data_df, dataset)
+
+        stats = zonal_stats(geo_data_df, raster,
+            stats='count', add_stats={'counts': self._count_grid_cells})
+        return self._finalize_zonal_stats(stats, geo_data_df.area[0])
+
+    @instrumentation.timed('counting')
+    def _look_up_in_file_batch(self, geo_data_df, raster, transform=None,
+            nodata=None):
+        """Like _look_up_in_file, but returns separate stats for each
+        row of geo_data_df.
+
+        As with _look_up_in_file, `raster` is either the name of a raster
+        file or an open rasterio dataset. Either way, this isn't one pass
+        through the file: from an open dataset, the window covering each
+        row is read, and counted (with one zonal_stats call, or by
+        rasterizing), separately, and otherwise zonal_stats reads and
+        counts each row's window in turn. All that's saved is opening
+        the file, and the per-call overhead, for each row.
+        """
+        import rasterio
+        from rasterstats import zonal_stats
+
+        if hasattr(raster, 'read'):
+            return [self._look_up_in_file(geo_data_df.iloc[[i]], raster,
+                    transform=transform, nodata=nodata)
+                for i in range(len(geo_data_df))]
+
+        if self._rasterio_engine:
+            with rasterio.open(raster) as dataset:
+                return self._look_up_in_file_batch(geo_data_df, dataset)
+
+        stats = zonal_stats(geo_data_df, raster,
+            stats='count', add_stats={'counts': self._count_grid_cells})
+        return [self._finalize_zonal_stats([s], area)
+            for s, area in zip(stats, geo_data_df.area)]
+
+    @instrumentation.timed('counting')
+    def _look_up_in_array(self, geo_data_df, array, affine, nodata):
+        """Like _look_up_in_file, but looks up fuelbeds in an in-memory
+        array, such as a window previously read from a raster file.
+        """
+        from rasterstats import zonal_stats
+
+        if self._rasterio_engine:
+            stats = [{'counts': self._rasterize_and_count(shape, array,
+                affine, nodata)} for shape in geo_data_df.geometry]
+        else:
+            stats = zonal_stats(geo_data_df, array, affine=affine,
+                nodata=nodata, stats='count',
+                add_stats={'counts': self._count_grid_cells})
+        return self._finalize_zonal_stats(stats, geo_data_df.area.iloc[0])
+
+    def _rasterize_and_count(self, shape, array, affine, nodata):
+        """Counts the grid cells of each fuelbed in `array` whose centers
+        are within `shape`, or, if configured to consider partial cells
+        or if there are no such cells, those touched by `shape`.
+        """
+        from rasterio import features
+
+        valid = array >= 0
+        if nodata is not None:
+            valid &= array != nodata
+
+        if self._coverage_weighting and shape.area > 0:
+            return self._weigh_by_coverage(shape, array, affine, valid)
+
+        selected = features.geometry_mask([shape], out_shape=array.shape,
+            transform=affine, invert=True)
+        if self._use_all_grid_cells or not (selected & valid).any():
+            selected = features.geometry_mask([shape], out_shape=array.shape,
+                transform=affine, invert=True, all_touched=True)
+
+        return self._count_values(array[selected & valid])
+
+    def _weigh_by_coverage(self, shape, array, affine, valid):
+        """Sums, for each fuelbed in `array`, the fractions of its grid
+        cells' areas within `shape`.
+        """
+        touched, weights = self._compute_coverage(shape, array, affine, valid)
+        return self._count_values(array[touched], weights[touched])
+
+    def _compute_coverage(self, shape, array, affine, valid):
+        """Returns a mask of the valid grid cells of `array` touched by
+        `shape`, and the fraction of each grid cell's area within `shape`.
+        Only the grid cells crossed by the shape's boundary are partially
+        within it, so the fractions are computed just for those.
+        """
+        import numpy
+        from rasterio import features
+        import shapely
+
+        touched = valid & features.geometry_mask([shape],
+            out_shape=array.shape, transform=affine, invert=True,
+            all_touched=True)
+        boundary = touched & features.geometry_mask([shape.boundary],
+            out_shape=array.shape, transform=affine, invert=True,
+            all_touched=True)
+
+        weights = numpy.ones(array.shape)
+        rows, cols = numpy.nonzero(boundary)
+        x0, y0 = affine * (cols, rows)
+        x1, y1 = affine * (cols + 1, rows + 1)
+        cells = shapely.box(numpy.minimum(x0, x1), numpy.minimum(y0, y1),
+            numpy.maximum(x0, x1), numpy.maximum(y0, y1))
+        weights[rows, cols] = (shapely.area(shapely.intersection(cells, shape))
+            / shapely.area(cells))
+
+        return touched, weights
+
+    ##
+    ## Chunked look-ups
+    ##
+
+    def _chunk_bytes_per_grid_cell(self, dataset):
+        """Estimates the peak memory needed, per grid cell, to read and
+        count a chunk: the raster values, masks of valid and selected grid
+        cells, and the indices, values, and sorting arrays used to count
+        selected cells, plus, with coverage weighting, the weights and the
+        arrays used to sum them
+        """
+        import numpy
+
+        itemsize = numpy.dtype(dataset.dtypes[0]).itemsize
+        return 3 * itemsize + 26 + (40 if self._coverage_weighting else 0)
+
+    def _exceeds_chunk_memory_budget(self, window, dataset):
+        return bool(self._chunk_memory_budget_mb
+            and window.width * window.height
+                * self._chunk_bytes_per_grid_cell(dataset)
+                > self._chunk_memory_budget_mb * 1024 * 1024)
+
+    def _chunk_windows(self, window, dataset):
+        """Splits `window`, clipped to the raster, into chunks made up of
+        whole internal blocks of the raster (except where clipped to the
+        window), in row-major order, each sized to fit within
+        chunk_memory_budget_mb, but no smaller than one block
+        """
+        from rasterio import windows
+
+        block_height, block_width = dataset.block_shapes[0]
+        row_start = max(int(window.row_off), 0)
+        row_stop = min(int(window.row_off + window.height), dataset.height)
+        col_start = max(int(window.col_off), 0)
+        col_stop = min(int(window.col_off + window.width), dataset.width)
+        if row_start >= row_stop or col_start >= col_stop:
+            return []
+
+        # Align the chunks' edges with the blocks'
+        first_row = row_start - row_start % block_height
+        first_col = col_start - col_start % block_width
+
+        budget_cells = int(self._chunk_memory_budget_mb * 1024 * 1024
+            // self._chunk_bytes_per_grid_cell(dataset))
+        # Prefer chunks spanning the full width of the window, to read as
+        # few partial blocks as possible
+        num_blocks_across = math.ceil((col_stop - first_col) / block_width)
+        blocks_across = max(min(num_blocks_across,
+            budget_cells // (block_height * block_width)), 1)
+        blocks_down = max(budget_cells
+            // (blocks_across * block_width * block_height), 1)
+        chunk_height = blocks_down * block_height
+        chunk_width = blocks_across * block_width
+
+        return [
+            windows.Window.from_slices(
+                (max(r, row_start), min(r + chunk_height, row_stop)),
+                (max(c, col_start), min(c + chunk_width, col_stop)))
+            for r in range(first_row, row_stop, chunk_height)
+            for c in range(first_col, col_stop, chunk_width)
+        ]
+
+    def _look_up_in_chunks(self, geo_data_df, dataset, transform, nodata,
+            window):
+        """Like _look_up_in_array, with the rasterio engine, but reads and
+        counts the grid cells in each chunk of `window` separately (see
+        _chunk_windows), merging the counts, so that the whole window is
+        never in memory at once.
+        """
+        import shapely
+
+        chunks = self._chunk_windows(window, dataset)
+        logging.debug(f"Looking up {window.width}x{window.height} window "
+            f"in {len(chunks)} chunks")
+
+        stats = []
+        for shape in geo_data_df.geometry:
+            shapely.prepare(shape)
+            all_touched = self._use_all_grid_cells
+            counts = self._count_in_chunks(shape, dataset, transform, nodata,
+                chunks, all_touched)
+            if not counts and not all_touched and not (
+                    self._coverage_weighting and shape.area > 0):
+                # As in _rasterize_and_count, fall back to partial cells
+                # if there are no grid cells with centers within the shape
+                counts = self._count_in_chunks(shape, dataset, transform,
+                    nodata, chunks, True)
+            stats.append({'counts': counts})
+
+        return self._finalize_zonal_stats(stats, geo_data_df.area.iloc[0])
+
+    def _count_in_chunks(self, shape, dataset, transform, nodata, chunks,
+            all_touched):
+        """Counts (or, with coverage weighting, weighs) the valid grid
+        cells selected by `shape` in each chunk, returning the totals per
+        fuelbed in order of first occurrence, row by row, across the whole
+        window, as _count_values would for the whole window.
+        """
+        import numpy
+        from rasterio import features, windows
+        import shapely
+
+        totals = defaultdict(float if self._coverage_weighting else int)
+        first_cells = {}
+        for chunk in chunks:
+            affine = windows.transform(chunk, transform)
+            if not shape.intersects(shapely.box(*windows.bounds(chunk,
+                    transform))):
+                continue
+
+            with (instrumentation.stage('raster_read'),
+                    self._dataset_lock(dataset)):
+                array = dataset.read(1, window=chunk)
+
+            valid = array >= 0
+            if nodata is not None:
+                valid &= array != nodata
+
+            weights = None
+            if self._coverage_weighting and shape.area > 0:
+                selected, weights = self._compute_coverage(shape, array,
+                    affine, valid)
+            else:
+                selected = valid & features.geometry_mask([shape],
+                    out_shape=array.shape, transform=affine, invert=True,
+                    all_touched=all_touched)
+            indices = numpy.flatnonzero(selected)
+            if not len(indices):
+                continue
+
+            values = array.ravel()[indices]
+            del array, valid, selected
+            if weights is None:
+                fccs_ids, first_indices, counts = numpy.unique(values,
+                    return_index=True, return_counts=True)
+            else:
+                fccs_ids, first_indices, inverse = numpy.unique(values,
+                    return_index=True, return_inverse=True)
+                counts = numpy.bincount(inverse,
+                    weights=weights.ravel()[indices], minlength=len(fccs_ids))
+            rows, cols = numpy.divmod(indices[first_indices], chunk.width)
+            for fccs_id, count, row, col in zip(fccs_ids.tolist(),
+                    counts.tolist(), (rows + chunk.row_off).tolist(),
+                    (cols + chunk.col_off).tolist()):
+                totals[fccs_id] += count
+                first_cells[fccs_id] = min(first_cells.get(fccs_id,
+                    (row, col)), (row, col))
+
+        return {k: totals[k] for k in sorted(first_cells,
+            key=first_cells.get) if totals[k] > 0}
+
+    def _finalize_zonal_stats(self, stats, area):
         # TODO: make sure area units are correct and properly translated
         # to real geographical area; read them from nc file
         # TODO: read and include grid cell size from nc file
         final_stats = self._compute_percentages(stats)
-        final_stats.update(area=geo_data_df.area[0], units='m^2')
+        final_stats.update(area=area, units='m^2')
+        instrumentation.count('grid_cells_counted', final_stats['grid_cells'])
         return final_stats
 
+    def _count_grid_cells(self, masked_array):
+        """Counts the grid cells of each fuelbed in a masked array of
+        fuelbed values, as passed to zonal_stats' `add_stats` functions.
+
+        We'll ignore the mask (i.e. consider partial cells) if configured
+        to do so or if the mask is all true values (i.e. all cells are
+        partial). Negative values (i.e. nodata) are never counted.
+
+        Fuelbeds are returned in order of first occurrence, row by row, so
+        that ties in percentage are later broken consistently.
+        """
+        import numpy
+
+        mask = numpy.ma.getmaskarray(masked_array)
+        data = numpy.ma.getdata(masked_array)
+        if self._use_all_grid_cells or mask.all():
+            values = data.ravel()
+        else:
+            values = data[~mask]
+        return self._count_values(values[values >= 0])
+
+    def _count_values(self, values, weights=None):
+        """Counts occurrences of each fuelbed in a 1-d array of fuelbed
+        values, or sums their weights, if specified, returned in order
+        of first occurrence.  Fuelbeds with zero weight are left out.
+        """
+        import numpy
+
+        fccs_ids, first_indices, inverse, counts = numpy.unique(values,
+            return_index=True, return_inverse=True, return_counts=True)
+        if weights is not None:
+            counts = numpy.bincount(inverse, weights=weights,
+                minlength=len(fccs_ids))
+        order = numpy.argsort(first_indices, kind='stable')
+        return {k: v for k, v in zip(fccs_ids[order].tolist(),
+            counts[order].tolist()) if v > 0}
+
     def _has_high_percent_of_ignored(self, stats):
         return (self._compute_total_percent_ignored(stats) >=
             self._ignored_percent_resampling_threshold)
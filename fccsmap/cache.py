@@ -0,0 +1,252 @@
+"""fccsmap.cache
+"""
+
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+__all__ = [
+    'LookUpCache',
+    'DiskLookUpCache',
+    'BlockCache'
+]
+
+class LookUpCache(object):
+    """In-process LRU cache of look-up results, safe to share across
+    threads and across look-up objects.
+
+    Values are deep-copied going in and coming out, since look-up results
+    are modified in place while being post-processed.
+    """
+
+    def __init__(self, max_size):
+        if not max_size or max_size < 1:
+            raise ValueError("LookUpCache max_size must be a positive integer")
+
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns a copy of the cached value, or None if not cached"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+
+        return copy.deepcopy(value)
+
+    def put(self, key, value):
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self._max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskLookUpCache(object):
+    """Persistent cache of look-up results, stored in an SQLite database,
+    which may be shared across threads, processes, and runs.
+
+    The database is put in WAL mode, which allows any number of concurrent
+    readers alongside a single writer; concurrent writers wait on each
+    other, up to `timeout` seconds.  Each thread gets its own connection.
+    """
+
+    def __init__(self, filename, timeout=30.0):
+        self._filename = os.path.abspath(filename)
+        self._timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS look_ups "
+                "(key TEXT PRIMARY KEY, stats TEXT NOT NULL)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._filename, timeout=self._timeout)
+            self._local.conn = conn
+        return conn
+
+    def _hash(self, key):
+        return hashlib.sha256(repr(key).encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the cached value, or None if not cached"""
+        row = self._connection().execute(
+            "SELECT stats FROM look_ups WHERE key = ?",
+            (self._hash(key),)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO look_ups (key, stats) VALUES (?, ?)",
+                (self._hash(key), json.dumps(value)))
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM look_ups")
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'filename': self._filename,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class BlockCache(object):
+    """In-process LRU cache of decoded blocks of internally tiled rasters
+    (e.g. cloud-optimized GeoTIFFs), from which windows are assembled, so
+    that look-ups of nearby geometries reuse blocks rather than reading
+    and decompressing them again.
+
+    Blocks are keyed by the id of the dataset they were read from, so the
+    datasets must be kept open for as long as the cache is used.
+    """
+
+    def __init__(self, max_size):
+        if not max_size or max_size < 1:
+            raise ValueError("BlockCache max_size must be a positive integer")
+
+        self._max_size = max_size
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def is_tiled(dataset):
+        """Returns whether or not the dataset is stored in blocks
+        narrower than the raster, rather than in strips of whole rows
+        """
+        return dataset.block_shapes[0][1] < dataset.width
+
+    def read(self, dataset, window, fill_value, lock=None):
+        """Returns the (possibly boundless) window of the dataset's first
+        band, assembled from the blocks it intersects, with fill_value
+        outside of the raster.  `lock`, if specified, is held while
+        reading blocks from the dataset.
+        """
+        import numpy
+
+        row_start = int(window.row_off)
+        col_start = int(window.col_off)
+        height = int(window.height)
+        width = int(window.width)
+        array = numpy.full((height, width), fill_value,
+            dtype=dataset.dtypes[0])
+
+        block_height, block_width = dataset.block_shapes[0]
+        rows = range(max(row_start, 0) // block_height,
+            (min(row_start + height, dataset.height) - 1) // block_height + 1)
+        cols = range(max(col_start, 0) // block_width,
+            (min(col_start + width, dataset.width) - 1) // block_width + 1)
+        for block_row in rows:
+            for block_col in cols:
+                block = self._get_block(dataset, block_row, block_col, lock)
+                r = block_row * block_height
+                c = block_col * block_width
+                # Intersection of the block and the window, relative to each
+                r0, r1 = max(r, row_start), min(r + block.shape[0],
+                    row_start + height)
+                c0, c1 = max(c, col_start), min(c + block.shape[1],
+                    col_start + width)
+                array[r0 - row_start:r1 - row_start,
+                    c0 - col_start:c1 - col_start] = block[
+                    r0 - r:r1 - r, c0 - c:c1 - c]
+
+        return array
+
+    def _get_block(self, dataset, block_row, block_col, lock):
+        key = (id(dataset), block_row, block_col)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self.hits += 1
+                self._blocks.move_to_end(key)
+                return block
+            self.misses += 1
+
+        with lock or contextlib.nullcontext():
+            block = dataset.read(1,
+                window=dataset.block_window(1, block_row, block_col))
+        # Blocks are shared by all windows assembled from them
+        block.flags.writeable = False
+
+        with self._lock:
+            self._blocks[key] = block
+            self._blocks.move_to_end(key)
+            while len(self._blocks) > self._max_size:
+                self._blocks.popitem(last=False)
+                self.evictions += 1
+
+        return block
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._blocks),
+                'max_size': self._max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def __len__(self):
+        return len(self._blocks)
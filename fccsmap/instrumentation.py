@@ -0,0 +1,269 @@
+"""fccsmap.instrumentation
+
+Timings of each stage of look-ups, and counts of what they involved, both
+per call (of look_up, look_up_many, etc.) and cumulatively, across calls.
+
+Stages:
+
+  - crs_load -- opening the raster, or loading the tiles index, and
+    reading its crs
+  - dataframe_creation -- creating data frames of geometries
+  - reprojection -- projecting geometries into the raster's crs
+  - tile_matching -- finding the tiles each geometry overlaps, and
+    clipping the geometries to them
+  - raster_read -- reading windows of the raster, or loading it into
+    memory (note that, when counting with rasterstats from a file, as
+    is done by default for batches and tiles, reading is included in
+    counting)
+  - counting -- counting the grid cells of each fuelbed
+  - aggregation -- combining per-tile or per-point results
+  - post_processing -- removing ignored fuelbeds and truncating
+
+Stage timings are exclusive of nested stages, so that they add up to no
+more than the time of the call.
+
+Counters:
+
+  - geometries -- geometries looked up
+  - cache_hits -- geometries whose results were cached
+  - sampling_escalations -- times a Point or MultiPoint's sampling area
+    was expanded because of too high a percentage of ignored fuelbeds
+  - tiles_touched -- tiles looked up in (counted once per batch of
+    geometries looked up in each)
+  - grid_cells_counted -- grid cells counted, including in sampling
+    areas that were then expanded
+
+Timings and counts are recorded only within a call, tracked in a context
+variable, so that concurrent calls in separate threads are recorded
+separately.
+"""
+
+__author__      = "Joel Dubowy"
+
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+
+__all__ = [
+    'STAGES',
+    'COUNTERS',
+    'CallStats',
+    'LookUpMetrics',
+    'call',
+    'stage',
+    'timed',
+    'count',
+    'current',
+    'propagating'
+]
+
+STAGES = ('crs_load', 'dataframe_creation', 'reprojection', 'tile_matching',
+    'raster_read', 'counting', 'aggregation', 'post_processing')
+
+COUNTERS = ('geometries', 'cache_hits', 'sampling_escalations',
+    'tiles_touched', 'grid_cells_counted')
+
+# The stats of the call in progress, if any
+_current_call = contextvars.ContextVar('fccsmap_current_call', default=None)
+
+# A single element list of the time spent in stages nested within the
+# stage in progress, if any
+_nested_seconds = contextvars.ContextVar('fccsmap_nested_seconds',
+    default=None)
+
+
+class CallStats:
+    """Timings and counts of a single look-up call. Stages and counts may
+    be recorded from multiple threads, e.g. when looking up in multiple
+    tiles concurrently.
+    """
+
+    def __init__(self, method):
+        self._method = method
+        self._lock = threading.Lock()
+        self._stage_seconds = defaultdict(float)
+        self._counters = defaultdict(int)
+        self._seconds = None
+
+    @property
+    def seconds(self):
+        return self._seconds
+
+    def add_stage_seconds(self, stage_name, seconds):
+        with self._lock:
+            self._stage_seconds[stage_name] += seconds
+
+    def increment(self, counter_name, n=1):
+        with self._lock:
+            self._counters[counter_name] += n
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'method': self._method,
+                'seconds': self._seconds,
+                'stage_seconds': dict(self._stage_seconds),
+                'counters': dict(self._counters)
+            }
+
+
+class LookUpMetrics:
+    """Cumulative timings and counts across look-up calls, which may be
+    shared by multiple look-up objects
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._calls = defaultdict(int)
+            self._seconds = 0.0
+            self._stage_seconds = {s: 0.0 for s in STAGES}
+            self._counters = {c: 0 for c in COUNTERS}
+
+    def record(self, call_stats):
+        stats = call_stats.to_dict()
+        with self._lock:
+            self._calls[stats['method']] += 1
+            self._seconds += stats['seconds']
+            for k, v in stats['stage_seconds'].items():
+                self._stage_seconds[k] = self._stage_seconds.get(k, 0.0) + v
+            for k, v in stats['counters'].items():
+                self._counters[k] = self._counters.get(k, 0) + v
+
+    @property
+    def snapshot(self):
+        with self._lock:
+            return {
+                'calls': dict(self._calls),
+                'seconds': self._seconds,
+                'stage_seconds': dict(self._stage_seconds),
+                'counters': dict(self._counters)
+            }
+
+    def to_prometheus(self, prefix='fccsmap'):
+        """Returns the metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot
+        lines = [
+            f"# HELP {prefix}_calls_total Look-up calls, by method",
+            f"# TYPE {prefix}_calls_total counter",
+        ]
+        lines.extend(f'{prefix}_calls_total{{method="{m}"}} {n}'
+            for m, n in sorted(snapshot['calls'].items()))
+        lines.extend([
+            f"# HELP {prefix}_call_seconds_total Time spent in look-up calls",
+            f"# TYPE {prefix}_call_seconds_total counter",
+            f"{prefix}_call_seconds_total {snapshot['seconds']}",
+            f"# HELP {prefix}_stage_seconds_total Time spent in each "
+                "stage of look-ups",
+            f"# TYPE {prefix}_stage_seconds_total counter",
+        ])
+        lines.extend(f'{prefix}_stage_seconds_total{{stage="{s}"}} {t}'
+            for s, t in snapshot['stage_seconds'].items())
+        for k, v in snapshot['counters'].items():
+            lines.extend([
+                f"# TYPE {prefix}_{k}_total counter",
+                f"{prefix}_{k}_total {v}"
+            ])
+        return '\n'.join(lines) + '\n'
+
+
+@contextlib.contextmanager
+def call(method, metrics=None, hooks=()):
+    """Records the timings and counts of a look-up call, adding them to
+    metrics, if specified, and passing them, as a dict, to each of hooks,
+    when done.  Calls made within another, in the same thread, are
+    recorded as part of it.
+    """
+    if _current_call.get() is not None:
+        yield _current_call.get()
+        return
+
+    call_stats = CallStats(method)
+    token = _current_call.set(call_stats)
+    start = time.perf_counter()
+    try:
+        yield call_stats
+    finally:
+        call_stats._seconds = time.perf_counter() - start
+        _current_call.reset(token)
+        if metrics is not None:
+            metrics.record(call_stats)
+        if hooks:
+            stats = call_stats.to_dict()
+            for hook in hooks:
+                try:
+                    hook(stats)
+                except Exception:
+                    logging.warning("Instrumentation hook failed",
+                        exc_info=True)
+
+@contextlib.contextmanager
+def stage(stage_name):
+    """Times a stage of the call in progress, if any, excluding time
+    spent in nested stages
+    """
+    call_stats = _current_call.get()
+    if call_stats is None:
+        yield
+        return
+
+    nested = [0.0]
+    token = _nested_seconds.set(nested)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _nested_seconds.reset(token)
+        enclosing = _nested_seconds.get()
+        if enclosing is not None:
+            enclosing[0] += seconds
+        call_stats.add_stage_seconds(stage_name, seconds - nested[0])
+
+def timed(stage_name):
+    """Decorator version of stage"""
+    def _timed(func):
+        @functools.wraps(func)
+        def _(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return _
+    return _timed
+
+def count(counter_name, n=1):
+    """Increments a counter of the call in progress, if any"""
+    call_stats = _current_call.get()
+    if call_stats is not None:
+        call_stats.increment(counter_name, n)
+
+def current():
+    """Returns the stats of the call in progress, if any"""
+    return _current_call.get()
+
+def propagating(func):
+    """Wraps func so that, when run in another thread (e.g. in a thread
+    pool), it records timings and counts as part of the call in progress
+    in the current thread.  Its stages aren't considered nested within
+    any stage in progress, since they may run concurrently.
+    """
+    call_stats = _current_call.get()
+    if call_stats is None:
+        return func
+
+    @functools.wraps(func)
+    def _(*args, **kwargs):
+        token = _current_call.set(call_stats)
+        nested_token = _nested_seconds.set(None)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _nested_seconds.reset(nested_token)
+            _current_call.reset(token)
+    return _
@@ -15,16 +15,15 @@ Very simple usage:
 __author__      = "Joel Dubowy"
 
 import logging
+import math
 import os
-import re
 from collections import defaultdict
 
-import geopandas
-import rioxarray
-from osgeo import gdal
-from shapely import ops, geometry
-
-from .baselookup import BaseLookUp, time_me
+# numpy, rasterio, etc. are imported where used, as they take a while to
+# load; see baselookup.py
+from . import instrumentation
+from .baselookup import BaseLookUp
+from .cache import BlockCache
 
 __all__ = [
     'FccsLookUp'
@@ -50,6 +49,40 @@ class FccsLookUp(BaseLookUp):
          - is_alaska -- Whether or not location is in Alaska; boolean
          - is_canada -- Whether or not location is in Canada; boolean
          - fccs_version -- '1' or '2'
+
+         - block_cache_size -- number of decoded blocks of the raster to
+            keep in memory, if it's internally tiled (e.g. a cloud-optimized
+            GeoTIFF), from which to assemble the windows read for look-ups,
+            so that look-ups of nearby geometries reuse them rather than
+            reading and decompressing them again; default: no caching
+         - sampling_overview_grid_cells -- sample Point and MultiPoint
+            look-ups from the coarsest of the raster's overviews, if any,
+            across which the sampling area still spans at least this many
+            grid cells, rather than from the full resolution raster; the
+            sampled_grid_cells returned are then those of the overview;
+            isn't applied with summed_area_tables or single_read_sampling;
+            overviews must have been built with nearest or mode resampling
+            (e.g. `gdaladdo -r mode`), since averaging fuelbed IDs results
+            in IDs of fuelbeds that aren't there; default: don't use
+            overviews
+
+         - point_grid_directory -- point grid, as written by
+            fccscreatepointgrid, from which to answer Point look-ups
+            that have no area specified, instead of sampling the raster;
+            it must have been created from the same raster, with the same
+            sampling radius, radius factors, ignored fuelbeds, and
+            resampling threshold, and can't be used with
+            use_all_grid_cells or coverage_weighting
+
+         - summed_area_tables -- load the raster into memory and build
+            summed-area tables of its fuelbeds, once, with which to count
+            the grid cells within each sampling area, instead of
+            rasterizing it; the grid cells whose centers are within each
+            sampling area are counted exactly, as a span of columns per
+            row of grid cells
+         - summed_area_table_fuelbeds -- number of most prevalent fuelbeds,
+            besides ignored fuelbeds, for which to build tables; others
+            are counted directly from the raster; default: 8
     """
 
     def __init__(self, **options):
@@ -78,17 +111,334 @@ class FccsLookUp(BaseLookUp):
 
             self._filename = self.FUEL_LOAD_NCS[fuel_load_key]
 
+        # The raster is opened lazily, on first look-up, and then kept
+        # open for the life of the instance
+        self._raster = None
+
+        # Likewise, summed area tables are built on first use
+        self._summed_area_tables = None
+        self._to_raster_crs = None
+        self._use_summed_area_tables = options.get('summed_area_tables', False)
+        self._summed_area_table_fuelbeds = options.get(
+            'summed_area_table_fuelbeds') or 8
+
+        # Overviews, like the raster, are opened on first use, and the
+        # blocks read from either are cached if configured to do so
+        self._overview_factors = None
+        self._overviews = {}
+        self._sampling_overview_grid_cells = options.get(
+            'sampling_overview_grid_cells')
+        self._block_cache = (BlockCache(options['block_cache_size'])
+            if options.get('block_cache_size') else None)
+
         super().__init__(**options)
 
+        self._point_grid = None
+        self._point_grid_directory = options.get('point_grid_directory')
+        if self._point_grid_directory:
+            from .pointgrid import (SAMPLING_SETTINGS, UNSUPPORTED_SETTINGS,
+                PointGrid)
+            self._point_grid = PointGrid(self._point_grid_directory)
+            if not self._point_grid.matches({k: getattr(self, f"_{k}")
+                    for k in SAMPLING_SETTINGS + UNSUPPORTED_SETTINGS}):
+                raise ValueError("Point grid was created with sampling "
+                    "settings different than those configured, or "
+                    "use_all_grid_cells or coverage_weighting is enabled")
+            raster = self._open_raster()
+            if not self._point_grid.matches_raster(self._filename,
+                    raster.crs, self._transform):
+                raise ValueError("Point grid was created from a raster "
+                    f"other than {self._filename}")
+
+    ##
+    ## Public Interface
+    ##
+
+    @property
+    def block_cache(self):
+        """The BlockCache used by this object, if enabled"""
+        return self._block_cache
+
     ##
     ## Helper methods
     ##
 
-    @time_me()
+    def _open_raster(self):
+        import rasterio
+
+        if self._raster is None:
+            with self._raster_lock:
+                # check again, in case another thread opened it while
+                # this one was waiting for the lock; only the opening
+                # itself is timed, not waiting for the lock
+                if self._raster is None:
+                    with instrumentation.stage('crs_load'):
+                        logging.debug('Opening %s', self._filename)
+                        raster = rasterio.open(self._filename)
+                        self._crs = raster.crs
+                        self._transform = raster.transform
+                        self._nodata = raster.nodata
+                        self._raster = raster
+
+        return self._raster
+
+    def _get_summed_area_tables(self):
+        from .summedarea import SummedAreaTables
+
+        raster = self._open_raster()
+        if self._summed_area_tables is None:
+            with self._raster_lock:
+                if self._summed_area_tables is None:
+                    with instrumentation.stage('raster_read'):
+                        logging.debug('Building summed area tables')
+                        self._summed_area_tables = SummedAreaTables(
+                            raster.read(1),
+                            max_fuelbeds=self._summed_area_table_fuelbeds,
+                            always_included=[int(f)
+                                for f in self._ignored_fuelbeds],
+                            nodata=self._nodata)
+
+        return self._summed_area_tables
+
+    def _open_overview(self, cells_across):
+        """Returns the coarsest of the raster's overviews across which
+        `cells_across` grid cells of the raster still span at least
+        sampling_overview_grid_cells, or None if there is none
+        """
+        import rasterio
+
+        raster = self._open_raster()
+        if self._overview_factors is None:
+            self._overview_factors = raster.overviews(1)
+
+        levels = [level for level, factor in enumerate(self._overview_factors)
+            if cells_across / factor >= self._sampling_overview_grid_cells]
+        if not levels:
+            return None
+
+        level = levels[-1]
+        if level not in self._overviews:
+            with self._raster_lock:
+                if level not in self._overviews:
+                    logging.debug('Opening overview %s of %s', level,
+                        self._filename)
+                    self._overviews[level] = rasterio.open(self._filename,
+                        overview_level=level)
+        return self._overviews[level]
+
+    def _look_up_sampled_in_overviews(self, geo_data_list):
+        """Looks up each of the sampling areas in geo_data_list in the
+        coarsest applicable overview, if any, and the rest, in one batch,
+        in the full resolution raster
+        """
+        raster = self._open_raster()
+        geo_data_df = self._create_geo_data_df(geo_data_list)
+
+        results = [None] * len(geo_data_list)
+        full_resolution = []
+        for i in range(len(geo_data_df)):
+            row_df = geo_data_df.iloc[[i]]
+            window = self._covering_window(row_df, self._transform)
+            overview = self._open_overview(max(window.width, window.height))
+            if overview is None:
+                full_resolution.append(i)
+            else:
+                results[i] = self._look_up_in_file(row_df, overview,
+                    nodata=self._nodata)
+
+        if full_resolution:
+            stats = self._look_up_in_file_batch(
+                geo_data_df.iloc[full_resolution], raster,
+                transform=self._transform, nodata=self._nodata)
+            for i, s in zip(full_resolution, stats):
+                results[i] = s
+
+        return results
+
+    def _look_up_sampled(self, geo_data_list):
+        import numpy
+        from pyproj import Transformer
+
+        if not self._use_summed_area_tables:
+            if self._sampling_overview_grid_cells:
+                return self._look_up_sampled_in_overviews(geo_data_list)
+            return super()._look_up_sampled(geo_data_list)
+
+        tables = self._get_summed_area_tables()
+        if self._to_raster_crs is None:
+            self._to_raster_crs = Transformer.from_crs("EPSG:4326",
+                self._crs, always_xy=True)
+
+        # Project the corners of all squares at once
+        with instrumentation.stage('reprojection'):
+            squares = [numpy.array(polygon[0]) for geo_data in geo_data_list
+                for polygon in geo_data['coordinates']]
+            lngs, lats = numpy.concatenate(squares).T
+            xs, ys = self._to_raster_crs.transform(lngs, lats)
+            cols, rows = ~self._transform * (xs, ys)
+            corners = numpy.stack([xs, ys, cols, rows],
+                axis=1).reshape(-1, 4, 4)
+
+        results = []
+        i = 0
+        for geo_data in geo_data_list:
+            n = len(geo_data['coordinates'])
+            with instrumentation.stage('counting'):
+                counts = tables.count(
+                    self._sampling_windows(corners[i:i+n, :, 2:]))
+            # shoelace formula
+            x, y = corners[i:i+n, :, 0], corners[i:i+n, :, 1]
+            area = float(numpy.abs((x * numpy.roll(y, -1, axis=1)
+                - numpy.roll(x, -1, axis=1) * y).sum(axis=1)).sum() / 2)
+            results.append(self._finalize_zonal_stats([{'counts': counts}],
+                area))
+            i += n
+
+        return results
+
+    def _sampling_windows(self, squares):
+        """Returns non-overlapping (row_start, row_stop, col_start,
+        col_stop) windows covering the grid cells whose centers are within
+        any of the squares of a sampling area, given their corners' column
+        and row coordinates, in an array of shape (num squares, 4, 2).
+        Since squares are convex, this is a single span of columns per row
+        per square, and overlapping spans are merged.  Windows are returned
+        in row-major order.  If none of the
+        squares contain grid cell centers, or if configured to use all
+        grid cells, the single window of all grid cells within the bounds
+        of the squares is returned instead, as would be the case with
+        zonal stats.
+        """
+        import numpy
+
+        spans = defaultdict(list)
+        if not self._use_all_grid_cells:
+            for square in squares:
+                cols, rows = square.T
+                # centers of rows of grid cells that cross the square
+                row_indices = numpy.arange(math.ceil(rows.min() - 0.5),
+                    math.floor(rows.max() - 0.5) + 1)
+                y = row_indices + 0.5
+                # where each row crosses each side of the square
+                c, r = numpy.roll(cols, -1) - cols, numpy.roll(rows, -1) - rows
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    t = (y[:, None] - rows) / r
+                    x = numpy.where((t >= 0) & (t <= 1), cols + t * c, numpy.nan)
+                col_starts = numpy.ceil(numpy.nanmin(x, axis=1) - 0.5)
+                col_stops = numpy.floor(numpy.nanmax(x, axis=1) - 0.5) + 1
+                for row, start, stop in zip(row_indices.tolist(),
+                        col_starts.tolist(), col_stops.tolist()):
+                    if start < stop:
+                        spans[row].append((int(start), int(stop)))
+
+        if not spans:
+            cols, rows = squares.reshape(-1, 2).T
+            return [(math.floor(rows.min()), math.ceil(rows.max()),
+                math.floor(cols.min()), math.ceil(cols.max()))]
+
+        windows = []
+        for row, row_spans in spans.items():
+            row_spans.sort()
+            merged = [list(row_spans[0])]
+            for start, stop in row_spans[1:]:
+                if start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], stop)
+                else:
+                    merged.append([start, stop])
+            windows.extend((row, row + 1, start, stop)
+                for start, stop in merged)
+
+        return sorted(windows)
+
+    def _look_up_in_point_grid(self, geo_data, area_acres):
+        """Returns stats for geo_data from the point grid, if specified
+        and applicable, or else None
+        """
+        if (self._point_grid and not area_acres
+                and geo_data["type"] == 'Point'
+                and self._is_sampled(geo_data)):
+            with instrumentation.stage('counting'):
+                stats = self._point_grid.look_up(*geo_data['coordinates'][:2])
+            if stats:
+                instrumentation.count('grid_cells_counted',
+                    stats['grid_cells'])
+                stats['sampled_grid_cells'] = stats.pop('grid_cells')
+                stats['sampled_area'] = stats.pop('area')
+                return stats
+
+    def _look_up_raw(self, geo_data, area_acres):
+        return (self._look_up_in_point_grid(geo_data, area_acres)
+            or super()._look_up_raw(geo_data, area_acres))
+
+    def _look_up_many_raw(self, geometries, area_acres):
+        results = [self._look_up_in_point_grid(g, a)
+            for g, a in zip(geometries, area_acres)]
+        missing = [i for i, stats in enumerate(results) if stats is None]
+        if missing:
+            stats = super()._look_up_many_raw([geometries[i] for i in missing],
+                [area_acres[i] for i in missing])
+            for i, s in zip(missing, stats):
+                results[i] = s
+        return results
+
+    def _compute_raster_fingerprint(self):
+        from .pointgrid import METADATA_FILE_NAME
+
+        fingerprint = self._file_fingerprint(self._filename)
+        if self._point_grid:
+            fingerprint += self._file_fingerprint(os.path.join(
+                self._point_grid_directory, METADATA_FILE_NAME))
+        if self._use_summed_area_tables:
+            fingerprint += ('summed_area_tables',)
+        elif self._sampling_overview_grid_cells:
+            fingerprint += ('sampling_overview_grid_cells',
+                self._sampling_overview_grid_cells)
+        return fingerprint
+
     def _look_up(self, geo_data):
-        # set crs
-        raster = rioxarray.open_rasterio(self._filename)
-        self._crs = raster[0].rio.crs
+        raster = self._open_raster()
+        geo_data_df = self._create_geo_data_df(geo_data)
+        return self._look_up_in_file(geo_data_df, raster,
+            transform=self._transform, nodata=self._nodata)
+
+    def _look_up_batch(self, geo_data_list):
+        if not geo_data_list:
+            return []
+
+        raster = self._open_raster()
+        geo_data_df = self._create_geo_data_df(geo_data_list)
+        return self._look_up_in_file_batch(geo_data_df, raster,
+            transform=self._transform, nodata=self._nodata)
+
+    def _dataset_lock(self, dataset):
+        # The raster and its overviews are shared by all look-ups
+        if dataset is self._raster or any(dataset is overview
+                for overview in self._overviews.values()):
+            return self._raster_lock
+        return super()._dataset_lock(dataset)
+
+    def _read_window(self, geo_data_df, dataset, transform, nodata,
+            window=None):
+        if self._block_cache is None or not BlockCache.is_tiled(dataset):
+            return super()._read_window(geo_data_df, dataset, transform,
+                nodata, window)
+
+        from rasterio import windows
+
+        window = window or self._covering_window(geo_data_df, transform)
+        with instrumentation.stage('raster_read'):
+            array = self._block_cache.read(dataset, window,
+                nodata if nodata is not None else 0,
+                self._dataset_lock(dataset))
+        return array, windows.transform(window, transform)
+
+    def _read_sampling_window(self, geo_data):
+        if self._use_summed_area_tables:
+            # no need to read the raster, since it's already in memory
+            return None
 
+        raster = self._open_raster()
         geo_data_df = self._create_geo_data_df(geo_data)
-        return self._look_up_in_file(geo_data_df, self._filename)
+        array, affine = self._read_window(geo_data_df, raster,
+            self._transform, self._nodata)
+        return array, affine, self._nodata
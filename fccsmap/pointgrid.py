@@ -0,0 +1,249 @@
+"""fccsmap.pointgrid
+
+Point look-ups with no area specified depend only on which grid cell the
+point falls in (and on the sampling config), so the neighborhood sampled
+around each grid cell of a raster can be precomputed, once, and stored
+in a point grid, which FccsLookUp can then index instead of rasterizing
+sampling areas on each look-up.
+
+Neighborhoods are computed in the raster's projection, as square blocks
+of grid cells centered on each cell. The block for radius factor f has
+sides of 2k+1 grid cells, where k is f times the sampling radius divided
+by the grid resolution, rounded to the nearest integer. e.g. With 1km
+data, a 1km sampling radius, and radius factors [1, 3, 5], the blocks are
+3x3, 7x7, and 11x11 grid cells, rather than the 2km x 2km, 6km x 6km,
+and 10km x 10km squares, drawn in lat/lng, that are sampled around the
+exact point.  Results will therefore differ somewhat from those of
+regular look-ups.  Only the max_fuelbeds most prevalent (non-ignored)
+fuelbeds in each neighborhood are stored, and percentages are of the
+grid cells of those and of the ignored fuelbeds.
+"""
+
+__author__      = "Joel Dubowy"
+
+import json
+import logging
+import os
+
+import numpy
+import rasterio
+from pyproj import Transformer
+
+from .baselookup import time_me
+from .summedarea import integral_image
+
+__all__ = [
+    'create_point_grid',
+    'PointGrid'
+]
+
+METADATA_FILE_NAME = "point_grid.json"
+ARRAY_NAMES = ('fccs_ids', 'counts', 'ignored_counts', 'totals',
+    'radius_factor_indices')
+
+# Settings that must match the look-up's config for the
+# grid to be used in place of regular sampling
+SAMPLING_SETTINGS = ('sampling_radius_km', 'sampling_radius_factors',
+    'ignored_fuelbeds', 'ignored_percent_resampling_threshold')
+
+# Settings that the grid doesn't support, i.e. that must be disabled
+# in the look-up's config for the grid to be used
+UNSUPPORTED_SETTINGS = ('use_all_grid_cells', 'coverage_weighting')
+
+
+def _box_sums(table, pad, k, shape):
+    """Returns the sum of the (2k+1)x(2k+1) block of grid cells centered
+    on each grid cell, given the integral image returned by
+    integral_image(array, pad), where k <= pad
+    """
+    h, w = shape
+    lo, hi = pad - k, pad + k + 1
+    return (table[hi:hi+h, hi:hi+w] - table[lo:lo+h, hi:hi+w]
+        - table[hi:hi+h, lo:lo+w] + table[lo:lo+h, lo:lo+w])
+
+@time_me()
+def create_point_grid(raster_file, point_grid_directory,
+        sampling_radius_km=1.0, sampling_radius_factors=[1, 3, 5],
+        ignored_fuelbeds=('0', '900'),
+        ignored_percent_resampling_threshold=99.9, max_fuelbeds=8):
+    """Precomputes the neighborhood sampled around each grid cell of
+    raster_file, and writes the results to point_grid_directory, as a
+    set of .npy files, which are memory-mapped when loaded, along with
+    a json file recording the raster's crs and transform and the
+    sampling settings.
+
+    For each grid cell, the neighborhoods for each of the radius factors
+    are considered in turn, stopping at the first with less than
+    ignored_percent_resampling_threshold percent ignored fuelbeds, as
+    is done in regular look-ups.
+    """
+    with rasterio.open(raster_file) as raster:
+        if raster.crs.is_geographic:
+            raise ValueError("Point grids can only be created for "
+                "rasters in projected coordinate systems")
+        data = raster.read(1)
+        nodata = raster.nodata
+        crs = raster.crs
+        transform = raster.transform
+
+    resolution_km = abs(transform.a) / 1000.0
+    radii = [int(round(f * sampling_radius_km / resolution_km))
+        for f in sampling_radius_factors]
+    pad = max(radii)
+    shape = data.shape
+    logging.debug(f"Creating point grid for {raster_file} ({shape}), "
+        f"with neighborhood radii {radii} grid cells")
+
+    # Negative values and the raster's nodata value (which, for unsigned
+    # rasters, is typically non-negative) are never counted
+    valid = data >= 0
+    if nodata is not None:
+        valid &= data != nodata
+    ignored = valid & numpy.isin(data, [int(f) for f in ignored_fuelbeds])
+    valid_table = integral_image(valid, pad)
+    ignored_table = integral_image(ignored, pad)
+
+    # Determine, for each grid cell, which neighborhood is used,
+    # i.e. the first one without too high a percentage ignored
+    totals = numpy.zeros(shape, dtype=numpy.int64)
+    ignored_totals = numpy.zeros(shape, dtype=numpy.int64)
+    radius_factor_indices = numpy.full(shape, len(radii) - 1, dtype=numpy.uint8)
+    undecided = numpy.ones(shape, dtype=bool)
+    for i, k in enumerate(radii):
+        totals[undecided] = _box_sums(valid_table, pad, k, shape)[undecided]
+        ignored_totals[undecided] = _box_sums(
+            ignored_table, pad, k, shape)[undecided]
+        high_ignored = (totals > 0) & (100.0 * ignored_totals
+            >= ignored_percent_resampling_threshold * totals)
+        radius_factor_indices[undecided & ~high_ignored] = i
+        undecided &= high_ignored
+    del valid_table, ignored_table
+
+    def _neighborhood_counts(fccs_id):
+        table = integral_image(valid & (data == fccs_id), pad)
+        counts = numpy.zeros(shape, dtype=numpy.int64)
+        for i, k in enumerate(radii):
+            selected = radius_factor_indices == i
+            counts[selected] = _box_sums(table, pad, k, shape)[selected]
+        return counts
+
+    count_dtype = numpy.min_scalar_type((2 * pad + 1) ** 2)
+    id_dtype = numpy.promote_types(numpy.min_scalar_type(-1),
+        numpy.min_scalar_type(int(data.max())))
+
+    ignored_counts = numpy.zeros(shape + (len(ignored_fuelbeds),),
+        dtype=count_dtype)
+    for j, fccs_id in enumerate(ignored_fuelbeds):
+        ignored_counts[:, :, j] = _neighborhood_counts(int(fccs_id))
+
+    # Keep the max_fuelbeds most prevalent other fuelbeds, replacing
+    # the least prevalent kept so far with each that's more prevalent
+    fccs_ids = numpy.full(shape + (max_fuelbeds,), -1, dtype=id_dtype)
+    counts = numpy.zeros(shape + (max_fuelbeds,), dtype=count_dtype)
+    for fccs_id in numpy.unique(data[valid & ~ignored]).tolist():
+        new_counts = _neighborhood_counts(fccs_id)
+        slots = numpy.argmin(counts, axis=2)
+        least = numpy.take_along_axis(counts, slots[..., None], 2)[..., 0]
+        rows, cols = numpy.nonzero(new_counts > least)
+        counts[rows, cols, slots[rows, cols]] = new_counts[rows, cols]
+        fccs_ids[rows, cols, slots[rows, cols]] = fccs_id
+
+    os.makedirs(point_grid_directory, exist_ok=True)
+    arrays = {
+        'fccs_ids': fccs_ids,
+        'counts': counts,
+        'ignored_counts': ignored_counts,
+        'totals': totals.astype(count_dtype),
+        'radius_factor_indices': radius_factor_indices,
+    }
+    for name in ARRAY_NAMES:
+        numpy.save(os.path.join(point_grid_directory, f"{name}.npy"),
+            arrays[name])
+
+    with open(os.path.join(point_grid_directory, METADATA_FILE_NAME), 'w') as f:
+        json.dump({
+            'raster_file': os.path.abspath(raster_file),
+            'crs': crs.to_wkt(),
+            'transform': list(transform)[:6],
+            'radii': radii,
+            'sampling_radius_km': sampling_radius_km,
+            'sampling_radius_factors': list(sampling_radius_factors),
+            'ignored_fuelbeds': list(ignored_fuelbeds),
+            'ignored_percent_resampling_threshold':
+                ignored_percent_resampling_threshold,
+        }, f, indent=4)
+
+
+class PointGrid:
+    """Answers point look-ups from a point grid written by
+    create_point_grid, with the arrays memory-mapped so that only
+    the pages containing the grid cells looked up are read
+    """
+
+    def __init__(self, point_grid_directory):
+        with open(os.path.join(point_grid_directory, METADATA_FILE_NAME)) as f:
+            self._metadata = json.load(f)
+        for name in ARRAY_NAMES:
+            setattr(self, f"_{name}", numpy.load(
+                os.path.join(point_grid_directory, f"{name}.npy"),
+                mmap_mode='r'))
+
+        self._inverse_transform = ~rasterio.Affine(
+            *self._metadata['transform'])
+        self._transformer = Transformer.from_crs("EPSG:4326",
+            self._metadata['crs'], always_xy=True)
+        self._cell_area = (abs(self._metadata['transform'][0])
+            * abs(self._metadata['transform'][4]))
+
+    def matches(self, settings):
+        """Returns whether or not the grid was created with the
+        sampling settings in `settings`, and none of the settings it
+        doesn't support are enabled
+        """
+        return all(
+            (list(settings[k]) if k in ('sampling_radius_factors',
+                'ignored_fuelbeds') else settings[k]) == self._metadata[k]
+            for k in SAMPLING_SETTINGS
+        ) and not any(settings.get(k) for k in UNSUPPORTED_SETTINGS)
+
+    def matches_raster(self, raster_file, crs, transform):
+        """Returns whether or not the grid was created from raster_file,
+        with the given crs and transform
+        """
+        return (os.path.abspath(raster_file) == self._metadata['raster_file']
+            and rasterio.crs.CRS.from_wkt(self._metadata['crs']) == crs
+            and list(transform)[:6] == self._metadata['transform'])
+
+    def look_up(self, lng, lat):
+        """Returns stats, as returned by BaseLookUp._look_up, for the
+        neighborhood of the grid cell containing lng, lat, or None if
+        beyond the extent of the grid
+        """
+        x, y = self._transformer.transform(lng, lat)
+        col, row = self._inverse_transform * (x, y)
+        row, col = int(numpy.floor(row)), int(numpy.floor(col))
+        if not (0 <= row < self._totals.shape[0]
+                and 0 <= col < self._totals.shape[1]):
+            return None
+
+        total = int(self._totals[row, col])
+        counts = list(zip(self._metadata['ignored_fuelbeds'],
+            self._ignored_counts[row, col].tolist()))
+        counts.extend((str(fccs_id), c) for fccs_id, c in zip(
+            self._fccs_ids[row, col].tolist(), self._counts[row, col].tolist()))
+
+        # Percentages are of the fuelbeds stored, so that they add up to
+        # 100 even where fuelbeds beyond the max_fuelbeds most prevalent
+        # were dropped
+        stored = sum(c for fccs_id, c in counts)
+
+        k = self._metadata['radii'][int(self._radius_factor_indices[row, col])]
+        return {
+            'fuelbeds': {
+                fccs_id: {'percent': 100.0 * c / stored, 'grid_cells': c}
+                    for fccs_id, c in counts if c > 0
+            },
+            'grid_cells': total,
+            'area': (2 * k + 1) ** 2 * self._cell_area,
+            'units': 'm^2'
+        }
@@ -0,0 +1,166 @@
+"""fccsmap.profiling
+
+Opt-in capture of cProfile profiles and tracemalloc memory stats of slow
+or memory hungry look-ups, along with the geometries looked up, for
+offline analysis.
+
+For each look-up call exceeding a threshold, the following files are
+written to the profile directory, each prefixed with the time, process
+id, and a sequence number:
+
+  - <prefix>.json -- the method called, the geometries (and area_acres)
+    looked up, the call's duration and peak traced memory, and its
+    instrumentation stats
+  - <prefix>.prof -- the cProfile stats, if profiling latency, which can
+    be loaded with pstats or viewed with a tool like snakeviz
+  - <prefix>.memory.txt -- the lines of code that allocated the most
+    memory still held at the end of the call, if profiling memory
+
+Both cProfile and tracemalloc are process-wide, so only one look-up is
+profiled at a time; look-ups made concurrently, in other threads, run
+without profiling, and work done in other threads on behalf of the
+profiled look-up (e.g. with tile_concurrency) isn't profiled.
+"""
+
+__author__      = "Joel Dubowy"
+
+import contextlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from . import instrumentation
+
+__all__ = [
+    'LookUpProfiler'
+]
+
+# Only one look-up in the process can be profiled at a time
+_lock = threading.Lock()
+
+_sequence = itertools.count()
+
+MEMORY_STATS_LIMIT = 50
+
+
+class LookUpProfiler:
+
+    def __init__(self, directory, latency_threshold=None,
+            memory_threshold_mb=None):
+        if latency_threshold is None and memory_threshold_mb is None:
+            raise ValueError("Specify a latency and/or memory threshold "
+                "for profiling look-ups")
+        self._directory = directory
+        self._latency_threshold = latency_threshold
+        self._memory_threshold_mb = memory_threshold_mb
+
+    @contextlib.contextmanager
+    def profile(self, method, geo_data, area_acres=None):
+        """Profiles the look-up run within the context, writing the results
+        if it exceeds either threshold
+        """
+        if not _lock.acquire(blocking=False):
+            yield
+            return
+
+        try:
+            profiler = self._start_cprofile()
+            started_tracemalloc = self._start_tracemalloc()
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                seconds = time.perf_counter() - start
+                if profiler:
+                    profiler.disable()
+                peak_memory_mb, memory_snapshot = self._stop_tracemalloc(
+                    started_tracemalloc)
+
+                if self._exceeds_thresholds(seconds, peak_memory_mb):
+                    self._write(method, geo_data, area_acres, seconds,
+                        peak_memory_mb, profiler, memory_snapshot)
+        finally:
+            _lock.release()
+
+    def _start_cprofile(self):
+        if self._latency_threshold is None:
+            return None
+
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active
+            logging.debug("Unable to profile look-up", exc_info=True)
+            return None
+        return profiler
+
+    def _start_tracemalloc(self):
+        """Starts tracing memory allocations, or, if already tracing,
+        resets the peak, and returns whether or not tracing was started
+        """
+        if self._memory_threshold_mb is None:
+            return False
+
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            return False
+        tracemalloc.start()
+        return True
+
+    def _stop_tracemalloc(self, started_tracemalloc):
+        if self._memory_threshold_mb is None:
+            return None, None
+
+        import tracemalloc
+        peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        snapshot = None
+        if peak >= self._memory_threshold_mb:
+            snapshot = tracemalloc.take_snapshot()
+        if started_tracemalloc:
+            tracemalloc.stop()
+        return peak, snapshot
+
+    def _exceeds_thresholds(self, seconds, peak_memory_mb):
+        return ((self._latency_threshold is not None
+                and seconds >= self._latency_threshold)
+            or (self._memory_threshold_mb is not None
+                and peak_memory_mb >= self._memory_threshold_mb))
+
+    def _write(self, method, geo_data, area_acres, seconds, peak_memory_mb,
+            profiler, memory_snapshot):
+        prefix = os.path.join(self._directory, "{}-{}-{}".format(
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid(), next(_sequence)))
+        logging.info(f"Writing profile of {seconds}s look-up to {prefix}.*")
+
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            call_stats = instrumentation.current()
+            with open(f"{prefix}.json", 'w') as f:
+                json.dump({
+                    'method': method,
+                    'geo_data': geo_data,
+                    'area_acres': area_acres,
+                    'seconds': seconds,
+                    'peak_memory_mb': peak_memory_mb,
+                    'instrumentation': (call_stats.to_dict()
+                        if call_stats else None)
+                }, f, indent=4, default=str)
+
+            if profiler:
+                profiler.dump_stats(f"{prefix}.prof")
+
+            if memory_snapshot:
+                with open(f"{prefix}.memory.txt", 'w') as f:
+                    for stat in memory_snapshot.statistics('lineno')[
+                            :MEMORY_STATS_LIMIT]:
+                        f.write(f"{stat}\n")
+
+        except Exception:
+            # Profiling should never cause a look-up to fail
+            logging.warning("Failed to write look-up profile", exc_info=True)
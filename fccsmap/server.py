@@ -0,0 +1,274 @@
+"""fccsmap.server
+
+A small HTTP server, for running on localhost, that keeps one look-up
+object, and thus its open raster or tiles index, warm across requests.
+
+Endpoints:
+
+  POST /look-up -- body: {"geo_data": <geometry>, "area_acres": <optional>},
+    or just the GeoJSON geometry or Feature (with optional area_acres
+    property); responds with the look-up results
+  POST /look-up-many -- body: {"geometries": [<geometry>, ...],
+    "area_acres": <optional single value or list>}; responds with a
+    list of results, in the same order
+  GET /health -- responds with {"status": "ok"}
+  GET /metrics -- responds with request counts and latencies, look-up
+    stage timings and counts, and cache stats, if caching is enabled
+  GET /metrics/prometheus -- responds with the look-up stage timings and
+    counts, in the Prometheus text exposition format
+
+Look-ups are run in a pool of worker threads.  Requests beyond those
+being worked on and those waiting in the queue are rejected with 503.
+Invalid requests are responded to with 400, and look-ups that fail
+otherwise with 500.
+"""
+
+__author__      = "Joel Dubowy"
+
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = [
+    'LookUpServer'
+]
+
+
+def _validate_object(data, name):
+    if not isinstance(data, dict):
+        raise ValueError(f"{name} must be a JSON object")
+
+def _validate_geo_data(geo_data):
+    """Raises ValueError if geo_data isn't a valid GeoJSON geometry, since
+    the various ways invalid geometries fail within look-ups are otherwise
+    indistinguishable from look-up failures
+    """
+    import shapely
+
+    _validate_object(geo_data, "Geometry")
+    try:
+        shapely.geometry.shape(geo_data)
+    except Exception as e:
+        raise ValueError(f"Invalid geometry: {e}") from e
+
+
+class LookUpServer:
+
+    DEFAULT_HOST = '127.0.0.1'
+    DEFAULT_PORT = 8080
+    DEFAULT_NUM_WORKERS = 4
+    DEFAULT_MAX_QUEUE_SIZE = 16
+
+    # Number of most recent look-up latencies used in computing percentiles
+    LATENCY_WINDOW = 1000
+
+    def __init__(self, lookup, host=DEFAULT_HOST, port=DEFAULT_PORT,
+            num_workers=DEFAULT_NUM_WORKERS,
+            max_queue_size=DEFAULT_MAX_QUEUE_SIZE):
+        self._lookup = lookup
+        self._num_workers = num_workers
+        self._max_pending = num_workers + max_queue_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=num_workers)
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._started = time.time()
+        self._counts = {'requests': 0, 'look_ups': 0, 'errors': 0,
+            'rejected': 0}
+        self._latencies = deque(maxlen=self.LATENCY_WINDOW)
+
+        self._http_server = ThreadingHTTPServer((host, port),
+            self._create_handler_class())
+        self._http_server.daemon_threads = True
+
+    @property
+    def server_address(self):
+        return self._http_server.server_address
+
+    def serve_forever(self):
+        logging.info("Serving look-ups on http://%s:%s", *self.server_address)
+        self._http_server.serve_forever()
+
+    def shutdown(self):
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        self._executor.shutdown(wait=True)
+
+    ##
+    ## Metrics
+    ##
+
+    @property
+    def metrics(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            metrics = dict(self._counts,
+                uptime=time.time() - self._started,
+                pending=self._pending,
+                num_workers=self._num_workers,
+                max_pending=self._max_pending)
+
+        def _percentile(p):
+            return latencies[min(int(p * len(latencies)), len(latencies) - 1)]
+
+        if latencies:
+            metrics['latency'] = {
+                'p50': _percentile(0.5),
+                'p99': _percentile(0.99),
+                'max': latencies[-1]
+            }
+
+        cache = getattr(self._lookup, 'cache', None)
+        if cache is not None:
+            metrics['cache'] = cache.stats
+
+        block_cache = getattr(self._lookup, 'block_cache', None)
+        if block_cache is not None:
+            metrics['block_cache'] = block_cache.stats
+
+        look_up_metrics = getattr(self._lookup, 'metrics', None)
+        if look_up_metrics is not None:
+            metrics['look_up'] = look_up_metrics.snapshot
+
+        return metrics
+
+    def _increment(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    ##
+    ## Look-ups
+    ##
+
+    def _run(self, num_look_ups, func, *args):
+        """Runs func in the worker pool, waiting for the result, or returns
+        None if there are already too many requests pending.  Look-ups are
+        counted only once accepted.
+        """
+        with self._lock:
+            if self._pending >= self._max_pending:
+                self._counts['rejected'] += 1
+                return None
+            self._pending += 1
+            self._counts['look_ups'] += num_look_ups
+
+        try:
+            start = time.time()
+            result = self._executor.submit(func, *args).result()
+            with self._lock:
+                self._latencies.append(time.time() - start)
+            return result
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _look_up(self, body):
+        _validate_object(body, "Request body")
+        if body.get('type') == 'Feature':
+            geo_data = body.get('geometry')
+            properties = body.get('properties') or {}
+            _validate_object(properties, "Feature properties")
+            area_acres = properties.get('area_acres')
+        elif 'geo_data' in body:
+            geo_data, area_acres = body['geo_data'], body.get('area_acres')
+        else:
+            geo_data, area_acres = body, None
+        _validate_geo_data(geo_data)
+        return self._run(1, self._lookup.look_up, geo_data, area_acres)
+
+    def _look_up_many(self, body):
+        _validate_object(body, "Request body")
+        geometries = body.get('geometries')
+        if not isinstance(geometries, list):
+            raise ValueError("'geometries' must be a list")
+        for geo_data in geometries:
+            _validate_geo_data(geo_data)
+        return self._run(len(geometries), self._lookup.look_up_many,
+            geometries, body.get('area_acres'))
+
+    ##
+    ## Request handling
+    ##
+
+    def _create_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            POST_ROUTES = {
+                '/look-up': server._look_up,
+                '/look-up-many': server._look_up_many,
+            }
+
+            def do_GET(self):
+                server._increment('requests')
+                if self.path == '/health':
+                    self._respond(200, {'status': 'ok'})
+                elif self.path == '/metrics':
+                    self._respond(200, server.metrics)
+                elif (self.path == '/metrics/prometheus'
+                        and hasattr(server._lookup, 'metrics')):
+                    self._respond(200,
+                        server._lookup.metrics.to_prometheus().encode(),
+                        content_type='text/plain; version=0.0.4')
+                else:
+                    self._respond(404, {'error': f"Not found: {self.path}"})
+
+            def do_POST(self):
+                server._increment('requests')
+                route = self.POST_ROUTES.get(self.path)
+                if not route:
+                    return self._respond(404,
+                        {'error': f"Not found: {self.path}"})
+
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    body = json.loads(self.rfile.read(length))
+                except ValueError as e:
+                    server._increment('errors')
+                    return self._respond(400,
+                        {'error': f"Invalid request body: {e}"})
+
+                # Invalid input, whether rejected here or by the look-up
+                # object, is reported as a ValueError; anything else is
+                # a failure on our part
+                try:
+                    result = route(body)
+                except ValueError as e:
+                    logging.debug("Invalid look-up request", exc_info=True)
+                    server._increment('errors')
+                    return self._respond(400,
+                        {'error': e.args[0] if e.args else str(e)})
+                except Exception as e:
+                    logging.exception("Look-up failed")
+                    server._increment('errors')
+                    return self._respond(500,
+                        {'error': f"Look-up failed: {e}"})
+
+                if result is None:
+                    self._respond(503, {'error': "Too many pending requests"},
+                        headers={'Retry-After': '1'})
+                else:
+                    self._respond(200, result)
+
+            def _respond(self, status, data, headers=None,
+                    content_type='application/json'):
+                body = (data if isinstance(data, bytes)
+                    else json.dumps(data).encode())
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format, *args)
+
+        return Handler
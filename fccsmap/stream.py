@@ -0,0 +1,79 @@
+"""fccsmap.stream
+
+Looks up newline-delimited GeoJSON geometries or Features (with optional
+area_acres properties), writing one line of json output per line of
+input, in the same order, with an error in place of the results of any
+that are invalid or fail to be looked up.
+"""
+
+__author__      = "Joel Dubowy"
+
+import json
+import sys
+
+__all__ = [
+    'stream'
+]
+
+
+def parse_ndjson_line(line):
+    """Returns the geometry and area (if specified) of a GeoJSON
+    geometry or Feature
+    """
+    data = json.loads(line)
+    if data.get('type') == 'Feature':
+        return data['geometry'], (data.get('properties') or {}).get('area_acres')
+    return data, None
+
+def error_msg(e):
+    return e.args[0] if e.args else str(e)
+
+def look_up_batch(fccs_lookup, batch):
+    """Looks up a batch of (geometry, area, error) tuples, returning
+    either the result or an error for each
+    """
+    to_look_up = [(g, a) for g, a, error in batch if not error]
+    try:
+        results = iter(fccs_lookup.look_up_many(
+            [g for g, a in to_look_up], [a for g, a in to_look_up]))
+    except Exception:
+        # Look each up individually, to isolate the ones in error
+        results = None
+
+    for g, a, error in batch:
+        if error:
+            yield {"error": error}
+        elif results:
+            yield next(results)
+        else:
+            try:
+                yield fccs_lookup.look_up(g, area_acres=a)
+            except Exception as e:
+                yield {"error": error_msg(e)}
+
+def stream(fccs_lookup, input_stream, batch_size=1, output_stream=None):
+    """Looks up each line of input_stream, reading and writing one batch
+    at a time, so that memory use doesn't grow with the size of the input.
+    Output is written to output_stream, or to stdout if not specified.
+    """
+    output_stream = output_stream or sys.stdout
+    batch = []
+
+    def _flush():
+        for data in look_up_batch(fccs_lookup, batch):
+            output_stream.write(json.dumps(data))
+            output_stream.write('\n')
+        output_stream.flush()
+        batch.clear()
+
+    for line in input_stream:
+        if line.strip():
+            try:
+                batch.append(parse_ndjson_line(line) + (None,))
+            except Exception as e:
+                batch.append((None, None, f"Invalid input: {error_msg(e)}"))
+            if len(batch) >= batch_size:
+                _flush()
+
+    if batch:
+        _flush()
@@ -0,0 +1,116 @@
+"""fccsmap.summedarea
+
+Summed-area tables (a.k.a. integral images) of fuelbed grid cells, with
+which the number of grid cells of a fuelbed within any rectangular
+window of a raster is computed with four table look-ups, regardless of
+the size of the window.
+"""
+
+__author__      = "Joel Dubowy"
+
+import numpy
+
+__all__ = [
+    'integral_image',
+    'SummedAreaTables'
+]
+
+def integral_image(array, pad=0, dtype=numpy.int64):
+    """Returns the summed-area table of `array`, optionally zero-padded by
+    `pad` grid cells on each side, with an additional leading row and
+    column of zeros, so that window sums don't need any special casing
+    at the edges. i.e. table[r, c] is the sum of (padded) array[:r, :c]
+    """
+    table = numpy.zeros((array.shape[0] + 2 * pad + 1,
+        array.shape[1] + 2 * pad + 1), dtype=dtype)
+    numpy.cumsum(numpy.pad(array, pad), axis=0, dtype=dtype,
+        out=table[1:, 1:])
+    numpy.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+class SummedAreaTables:
+    """Summed-area tables of an in-memory raster of fuelbeds, one per
+    fuelbed for the always_included fuelbeds and the max_fuelbeds most
+    prevalent others, plus one for all remaining fuelbeds combined, so
+    that the (typically few) windows containing any of those can be
+    counted directly from the raster.
+
+    Each table takes four bytes per grid cell (eight, for rasters of over
+    2^32 grid cells).
+    """
+
+    def __init__(self, array, max_fuelbeds=8, always_included=(),
+            nodata=None):
+        self._array = array
+        self._shape = array.shape
+        self._nodata = nodata
+        dtype = (numpy.uint32 if array.size < 2**32 else numpy.uint64)
+
+        # Negative values and nodata (which, for unsigned
+        # rasters, is typically non-negative) are never counted
+        valid = array >= 0
+        if nodata is not None:
+            valid &= array != nodata
+        fccs_ids, counts = numpy.unique(array[valid], return_counts=True)
+        most_prevalent = [i for i in fccs_ids[numpy.argsort(
+                -counts, kind='stable')].tolist()
+            if i not in always_included]
+        self._fccs_ids = ([i for i in always_included if i in fccs_ids]
+            + most_prevalent[:max_fuelbeds])
+
+        # The last table is of all other fuelbeds
+        self._tables = numpy.zeros((len(self._fccs_ids) + 1,
+            self._shape[0] + 1, self._shape[1] + 1), dtype=dtype)
+        for i, fccs_id in enumerate(self._fccs_ids):
+            self._tables[i] = integral_image(array == fccs_id, dtype=dtype)
+        self._tables[-1] = integral_image(
+            valid & ~numpy.isin(array, self._fccs_ids), dtype=dtype)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    def count(self, windows):
+        """Returns a dict of fuelbed grid cell counts within the given
+        windows, each a (row_start, row_stop, col_start, col_stop) tuple
+        of rows [row_start, row_stop) and columns [col_start, col_stop),
+        clipped to the extent of the raster.  Windows are assumed not to
+        overlap.  Fuelbeds are returned in order of first occurrence,
+        row by row within each window, and window by window, so that,
+        given windows in row-major order, ties in percentage are broken
+        as they would be if counting from the raster directly.
+        """
+        if not windows:
+            return {}
+        windows = numpy.array(windows, dtype=numpy.int64)
+        r0, r1 = [numpy.clip(windows[:, i], 0, self._shape[0]) for i in (0, 1)]
+        c0, c1 = [numpy.clip(windows[:, i], 0, self._shape[1]) for i in (2, 3)]
+        r1, c1 = numpy.maximum(r0, r1), numpy.maximum(c0, c1)
+
+        # Cast to signed integers before subtracting, since tables are unsigned
+        t = self._tables
+        sums = (t[:, r1, c1].astype(numpy.int64) - t[:, r0, c1]
+            - t[:, r1, c0] + t[:, r0, c0])
+
+        counts = {fccs_id: int(n)
+            for fccs_id, n in zip(self._fccs_ids, sums[:-1].sum(axis=1)) if n}
+
+        # Only the windows containing other fuelbeds, or containing the
+        # first occurrence of any fuelbed, need to be read
+        first_windows = set(numpy.argmax(sums[:-1] > 0, axis=1)[
+            [fccs_id in counts for fccs_id in self._fccs_ids]].tolist())
+        first_occurrences = {}
+        for i in sorted(first_windows.union(numpy.nonzero(sums[-1])[0].tolist())):
+            window = self._array[r0[i]:r1[i], c0[i]:c1[i]].ravel()
+            fccs_ids, first_indices, window_counts = numpy.unique(window,
+                return_index=True, return_counts=True)
+            for fccs_id, j, n in zip(fccs_ids.tolist(), first_indices.tolist(),
+                    window_counts.tolist()):
+                if fccs_id >= 0 and fccs_id != self._nodata:
+                    first_occurrences.setdefault(fccs_id, (i, j))
+                    if fccs_id not in self._fccs_ids:
+                        counts[fccs_id] = counts.get(fccs_id, 0) + n
+
+        return {fccs_id: counts[fccs_id]
+            for fccs_id in sorted(counts, key=first_occurrences.get)}
@@ -3,28 +3,63 @@
 
 __author__      = "Joel Dubowy"
 
+import concurrent.futures
 import logging
 import os
 from collections import defaultdict
 
-import geopandas
-import numpy
-import rioxarray
-import shapely
-
+# geopandas, numpy, and shapely are imported where used; see baselookup.py
+from . import instrumentation
 from .baselookup import BaseLookUp, time_me
 
 __all__ = [
-    'FccsTilesLookUp'
+    'FccsTilesLookUp',
+    'create_compact_index'
 ]
 
+DEFAULT_INDEX_SHAPEFILE_NAME = "index.shp"
+DEFAULT_COMPACT_INDEX_FILE_NAME = "index.npy"
+
+def _compact_index_crs_file(compact_index_file):
+    return os.path.splitext(compact_index_file)[0] + '.wkt'
+
+@time_me()
+def create_compact_index(index_shapefile, compact_index_file):
+    """Writes the tile bounds and file names in index_shapefile to
+    a .npy file, which can be memory-mapped and loaded much faster than
+    the shapefile, along with a .wkt file containing the tiles' crs
+    """
+    import geopandas
+    import numpy
+
+    tiles_df = geopandas.read_file(index_shapefile)
+    locations = numpy.array(tiles_df['location'], dtype=str)
+    bounds = tiles_df.bounds
+    index = numpy.zeros(len(tiles_df), dtype=[
+        ('minx', 'f8'), ('miny', 'f8'), ('maxx', 'f8'), ('maxy', 'f8'),
+        ('location', locations.dtype)
+    ])
+    for k in ('minx', 'miny', 'maxx', 'maxy'):
+        index[k] = bounds[k]
+    index['location'] = locations
+
+    numpy.save(compact_index_file, index)
+    with open(_compact_index_crs_file(compact_index_file), 'w') as f:
+        f.write(tiles_df.crs.to_wkt())
+
 class FccsTilesLookUp(BaseLookUp):
 
     # OPTIONS_DOC_STRING used by Constructor docstring as well as
     # script helpstring
-    OPTIONS_STRING = """
+    ADDITIONAL_OPTIONS_STRING = """
          - tiles_directory -- directory containing tiles
          - index_shapefile -- default: index.shp
+         - compact_index_file -- index of tile bounds and file names, as
+            written by fccscreatetiles, used instead of index_shapefile if
+            it exists, unless index_shapefile is specified and
+            compact_index_file isn't; default: index.npy
+         - tile_concurrency -- maximum number of tiles to look up
+            concurrently, in separate threads; default: 1
     """
 
     DEFAULT_SAMPLING_RADIUS_KM = 0.25
@@ -40,6 +75,7 @@ class FccsTilesLookUp(BaseLookUp):
 
         self._set_tiles_directory(options)
         self._create_tiles_spatial_index(options)
+        self._tile_concurrency = options.get('tile_concurrency') or 1
 
         super().__init__(**options)
 
@@ -59,59 +95,194 @@ class FccsTilesLookUp(BaseLookUp):
 
     @time_me()
     def _create_tiles_spatial_index(self, options):
+        import shapely
+
         logging.debug("Creating tiles index")
 
-        # if not specified, assume index shapefile is named index.shp and
+        # An index shapefile that's specified explicitly takes precedence
+        # over the default compact index
+        compact_index_file = None
+        if (options.get('compact_index_file')
+                or not options.get('index_shapefile')):
+            compact_index_file = self._find_index_file(options,
+                'compact_index_file', DEFAULT_COMPACT_INDEX_FILE_NAME)
+
+        if (compact_index_file and not compact_index_file.startswith('http')
+                and os.path.exists(compact_index_file)):
+            self._load_compact_index(compact_index_file)
+            self._index_file = compact_index_file
+
+        else:
+            index_shapefile = self._find_index_file(options,
+                'index_shapefile', DEFAULT_INDEX_SHAPEFILE_NAME)
+            if (not index_shapefile.startswith('http')
+                    and not os.path.exists(index_shapefile)):
+                raise RuntimeError(f"Tiles index shapefile does not exist - {index_shapefile}")
+            self._load_index_shapefile(index_shapefile)
+            self._index_file = index_shapefile
+
+        # Tile footprints and file names are kept in plain arrays, indexed
+        # by the spatial index's query results
+        self._tiles_index = shapely.STRtree(self._tile_geometries)
+
+        # TODO: set `self._sampling_radius_km` to grid resolution
+
+    def _find_index_file(self, options, key, default_file_name):
+        # if not specified, assume index file has the default name and
         # exists in the files directory
-        index_shapefile = options.get('index_shapefile') or os.path.join(self._tiles_directory, "index.shp")
+        index_file = options.get(key) or os.path.join(self._tiles_directory, default_file_name)
 
-        # If index_shapefile has no path (is only a file name) and if the file
+        # If index file has no path (is only a file name) and if the file
         # does not exist in the current dir, then assume it's in the tiles directory
-        if (os.path.basename(index_shapefile) == index_shapefile
-                and not os.path.exists(os.path.abspath(index_shapefile))):
-            index_shapefile = os.path.join(self._tiles_directory, index_shapefile)
+        if (os.path.basename(index_file) == index_file
+                and not os.path.exists(os.path.abspath(index_file))):
+            index_file = os.path.join(self._tiles_directory, index_file)
 
-        if not index_shapefile.startswith('http'):
-            index_shapefile = os.path.abspath(index_shapefile)
+        if not index_file.startswith('http'):
+            index_file = os.path.abspath(index_file)
 
-            if not os.path.exists(index_shapefile):
-                raise RuntimeError(f"Tiles index shapefile does not exist - {index_shapefile}")
+        return index_file
 
-        self._tiles_df = geopandas.read_file(index_shapefile)
-        #self._tiles_index = self._tiles_df.sindex
+    def _load_index_shapefile(self, index_shapefile):
+        import geopandas
+        import numpy
 
-        # TODO: set `self._sampling_radius_km` to grid resolution
+        logging.debug(f"Loading tiles index shapefile {index_shapefile}")
+        tiles_df = geopandas.read_file(index_shapefile)
+        self._tile_geometries = numpy.array(tiles_df.geometry)
+        self._tile_locations = numpy.array(tiles_df['location'])
+        self._crs = tiles_df.crs
+
+    def _load_compact_index(self, compact_index_file):
+        import numpy
+        import shapely
 
-        self._crs = self._tiles_df.crs
+        logging.debug(f"Loading compact tiles index {compact_index_file}")
+        index = numpy.load(compact_index_file, mmap_mode='r')
+        self._tile_geometries = shapely.box(index['minx'], index['miny'],
+            index['maxx'], index['maxy'])
+        self._tile_locations = index['location']
+        with open(_compact_index_crs_file(compact_index_file)) as f:
+            self._crs = f.read()
 
     ##
     ## Look-up helpers
     ##
 
-    @time_me()
+    def _compute_raster_fingerprint(self):
+        return (self._tiles_directory,) + self._file_fingerprint(
+            self._index_file)
+
     def _look_up(self, geo_data):
-        geo_data_df = self._create_geo_data_df(geo_data)
-        tiles = self._find_matching_tiles(geo_data_df)
-
-        per_tile_stats = [
-            self._look_up_in_file(
-                geo_data_df,
-                os.path.join(self._tiles_directory, tile)
-            )
-            for tile in tiles
+        return self._look_up_batch([geo_data])[0]
+
+    def _look_up_batch(self, geo_data_list):
+        if not geo_data_list:
+            return []
+
+        geo_data_df = self._create_geo_data_df(geo_data_list)
+
+        # Look up all geometries matching each tile at once, so that each
+        # tile is opened only once
+        def _look_up_in_tile(tile_matches):
+            tile_index, geo_data_indices = tile_matches
+            clipped_df = self._clip_to_tile(
+                geo_data_df.iloc[geo_data_indices],
+                self._tile_geometries[tile_index])
+            if clipped_df.empty:
+                return []
+            tile_stats = self._look_up_in_file_batch(clipped_df,
+                os.path.join(self._tiles_directory,
+                    self._tile_locations[tile_index]))
+            return list(zip(clipped_df.index, tile_stats))
+
+        matching_tiles = self._find_matching_tiles(geo_data_df)
+        instrumentation.count('tiles_touched', len(matching_tiles))
+
+        per_geo_data_per_tile_stats = [[] for g in geo_data_list]
+        for tile_stats in self._map_tiles(_look_up_in_tile, matching_tiles):
+            for i, stats in tile_stats:
+                per_geo_data_per_tile_stats[i].append(stats)
+
+        return [
+            self._aggregate(per_tile_stats, area)
+            for per_tile_stats, area
+                in zip(per_geo_data_per_tile_stats, geo_data_df.area)
         ]
 
-        return self._aggregate(per_tile_stats, geo_data_df)
+    def _map_tiles(self, func, tiles):
+        """Applies func to each of tiles, concurrently if so configured,
+        and returns the results in the same order as tiles.  GDAL releases
+        the GIL while reading, so threads are sufficient here.
+        """
+        if self._tile_concurrency > 1 and len(tiles) > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(self._tile_concurrency, len(tiles))) as executor:
+                return list(executor.map(
+                    instrumentation.propagating(func), tiles))
 
-    @time_me()
+        return [func(tile) for tile in tiles]
+
+    @instrumentation.timed('tile_matching')
     def _find_matching_tiles(self, geo_data_df):
-        logging.debug("Finding matching tiles")
-        matches = self._tiles_df.sjoin(geo_data_df, rsuffix='geo_data')
-        tiles = list(matches['location'])
-        return tiles
+        """Returns a list of (tile index, indices of matching rows of
+        geo_data_df) tuples, ordered by tile index
+        """
+        import numpy
 
-    @time_me()
-    def _aggregate(self, per_tile_stats, geo_data_df):
+        logging.debug("Finding matching tiles")
+        geo_data_indices, tile_indices = self._tiles_index.query(
+            geo_data_df.geometry.values, predicate='intersects')
+        order = numpy.lexsort((geo_data_indices, tile_indices))
+        geo_data_indices = geo_data_indices[order]
+        tile_indices, starts = numpy.unique(tile_indices[order],
+            return_index=True)
+        return list(zip(tile_indices.tolist(),
+            numpy.split(geo_data_indices, starts[1:])))
+
+    @instrumentation.timed('tile_matching')
+    def _clip_to_tile(self, geo_data_df, tile_geometry):
+        """Clips each geometry in geo_data_df to the tile's footprint, so
+        that only the part within the tile is rasterized, and drops those
+        that don't overlap the tile (including polygons that only touch
+        its edge).  Row labels are retained.
+        """
+        import geopandas
+        import shapely
+
+        # The squares sampled around nearby points of a MultiPoint may
+        # overlap, resulting in an invalid MultiPolygon, which GEOS can't
+        # intersect. The union of its parts covers the same grid cells.
+        # (make_valid isn't used, as it drops areas of overlap.)
+        geometries = geo_data_df.geometry
+        is_invalid = ~geometries.is_valid
+        if is_invalid.any():
+            geometries = geometries.copy()
+            geometries[is_invalid] = geometries[is_invalid].apply(
+                lambda g: shapely.unary_union(shapely.get_parts(g)))
+
+        clipped = geometries.intersection(tile_geometry)
+        clipped = clipped[~clipped.is_empty]
+        # If a polygon only shares an edge or corner with the tile, or if,
+        # in addition to overlapping, it touches the tile elsewhere, the
+        # intersection includes lines or points, which we don't want
+        # rasterized
+        is_polygonal = geo_data_df.geometry[clipped.index].area > 0
+        clipped[is_polygonal] = clipped[is_polygonal].apply(
+            self._polygonal_parts)
+        clipped = clipped[~clipped.is_empty]
+        return geopandas.GeoDataFrame({'geometry': clipped}, crs=self._crs)
+
+    def _polygonal_parts(self, geometry):
+        import shapely
+
+        if geometry.geom_type in ('Polygon', 'MultiPolygon'):
+            return geometry
+        return shapely.unary_union([g for g in shapely.get_parts(geometry)
+            if g.geom_type in ('Polygon', 'MultiPolygon')])
+
+    @instrumentation.timed('aggregation')
+    def _aggregate(self, per_tile_stats, area):
         grid_cells = sum([s['grid_cells'] for s in per_tile_stats])
         fuelbeds = defaultdict(lambda: {'grid_cells': 0})
         for stats in per_tile_stats:
@@ -122,8 +293,8 @@ class FccsTilesLookUp(BaseLookUp):
             fb['percent'] = (fb['grid_cells'] / grid_cells) * 100.0
 
         return {
-            'fuelbeds': fuelbeds,
+            'fuelbeds': dict(fuelbeds),
             'grid_cells': grid_cells,
-            'area': geo_data_df.area[0],
+            'area': area,
             'units': 'm^2'
         }
@@ -15,7 +15,9 @@ setup(
     packages=find_packages(),
     scripts=[
         'bin/fccsmap',
-        'bin/fccscreatetiles'
+        'bin/fccscreatetiles',
+        'bin/fccscreatepointgrid',
+        'bin/fccsserver'
     ],
     package_data={
         'fccsmap': ['data/*.nc']
@@ -34,6 +36,7 @@ setup(
         "afscripting>=3.0.0,<4.0.0",
         "numpy==2.1.1",
         "shapely==2.0.6",
+        "rasterio==1.4.1",
         "rasterstats==0.19.0",
         "GDAL==3.8.4",
         "geopandas==1.0.1",
@@ -1,6 +1,58 @@
 import sys, os
 
+from pytest import fixture
+
 # Hack to put the repo root dir at the front of sys.path so that
 # the local fccsmap package is found
 app_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, app_root)
+
+# Upper left corner of test rasters, in EPSG:5070, which is near
+# -120.0, 47.2
+ORIGIN = (-1850000.0, 2970000.0)
+RESOLUTION = 1000
+
+
+@fixture
+def write_raster(tmp_path):
+    """Returns a function that writes `data` to a single band GeoTIFF,
+    in EPSG:5070, with its upper left corner at `origin` and grid cells
+    `resolution` meters across, and returns its filename.  Any other
+    keyword arguments (e.g. tiled, blockxsize) are passed to rasterio,
+    and overviews are built, with nearest resampling, for the given
+    factors, if any.
+    """
+    def _write_raster(data, name='fccs.tif', origin=ORIGIN,
+            resolution=RESOLUTION, nodata=-9999, overviews=None, **profile):
+        import rasterio
+        from rasterio.enums import Resampling
+
+        filename = str(tmp_path / name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with rasterio.open(filename, 'w', driver='GTiff',
+                width=data.shape[1], height=data.shape[0], count=1,
+                dtype=data.dtype, crs='EPSG:5070', nodata=nodata,
+                transform=rasterio.transform.from_origin(*origin,
+                    resolution, resolution), **profile) as dst:
+            dst.write(data, 1)
+            if overviews:
+                dst.build_overviews(overviews, Resampling.nearest)
+        return filename
+
+    return _write_raster
+
+@fixture
+def point():
+    """Returns a function that returns the GeoJSON Point (in lng/lat)
+    x grid cells east and y grid cells south of `origin`
+    """
+    from pyproj import Transformer
+    transformer = Transformer.from_crs('EPSG:5070', 'EPSG:4326',
+        always_xy=True)
+
+    def _point(x, y, origin=ORIGIN):
+        lng, lat = transformer.transform(origin[0] + x * RESOLUTION,
+            origin[1] - y * RESOLUTION)
+        return {"type": "Point", "coordinates": [lng, lat]}
+
+    return _point
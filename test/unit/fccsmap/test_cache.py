@@ -0,0 +1,206 @@
+import numpy
+import rasterio
+from pytest import raises
+
+from fccsmap.cache import BlockCache, DiskLookUpCache, LookUpCache
+from fccsmap.lookup import FccsLookUp
+
+
+class TestLookUpCache(object):
+
+    def test_invalid_max_size(self):
+        with raises(ValueError):
+            LookUpCache(0)
+
+    def test_get_and_put(self):
+        cache = LookUpCache(2)
+        assert cache.get('a') is None
+        cache.put('a', {'foo': [1]})
+        assert cache.get('a') == {'foo': [1]}
+        assert cache.stats == {
+            'size': 1, 'max_size': 2, 'hits': 1, 'misses': 1, 'evictions': 0
+        }
+
+    def test_values_are_copied(self):
+        cache = LookUpCache(2)
+        value = {'foo': [1]}
+        cache.put('a', value)
+        value['foo'].append(2)
+        cache.get('a')['foo'].append(3)
+        assert cache.get('a') == {'foo': [1]}
+
+    def test_least_recently_used_evicted(self):
+        cache = LookUpCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert cache.evictions == 1
+        assert len(cache) == 2
+
+
+class TestFccsLookUpCaching(object):
+
+    GEO_DATA = {
+        "type": "Point",
+        "coordinates": [-119.877732, 48.4255591]
+    }
+
+    RAW_STATS = {
+        'fuelbeds': {
+            '52': {'grid_cells': 19, 'percent': 95.0},
+            '24': {'grid_cells': 1, 'percent': 5.0}
+        },
+        'sampled_grid_cells': 20,
+        'sampled_area': 4014629.570957375,
+        'units': 'm^2'
+    }
+
+    def setup_method(self):
+        self._raw_look_ups = []
+
+    def _look_up_raw(self, geo_data, area_acres):
+        self._raw_look_ups.append((geo_data, area_acres))
+        return {
+            'fuelbeds': {k: dict(v) for k, v in self.RAW_STATS['fuelbeds'].items()},
+            'sampled_grid_cells': 20,
+            'sampled_area': 4014629.570957375,
+            'units': 'm^2'
+        }
+
+    def _create_lookup(self, monkeypatch, **options):
+        lookup = FccsLookUp(**options)
+        monkeypatch.setattr(lookup, '_look_up_raw', self._look_up_raw)
+        return lookup
+
+    def test_disabled(self, monkeypatch):
+        lookup = self._create_lookup(monkeypatch)
+        lookup.look_up(self.GEO_DATA)
+        lookup.look_up(self.GEO_DATA)
+        assert lookup.cache is None
+        assert len(self._raw_look_ups) == 2
+
+    def test_hit(self, monkeypatch):
+        lookup = self._create_lookup(monkeypatch, cache_size=10)
+        first = lookup.look_up(self.GEO_DATA)
+        # coordinates within cache_coordinate_precision of the first
+        second = lookup.look_up({
+            "type": "Point",
+            "coordinates": [-119.8777320001, 48.4255591]
+        })
+        assert first == second
+        assert len(self._raw_look_ups) == 1
+        assert lookup.cache.hits == 1
+        assert lookup.cache.misses == 1
+
+    def test_area_acres_in_key(self, monkeypatch):
+        lookup = self._create_lookup(monkeypatch, cache_size=10)
+        lookup.look_up(self.GEO_DATA)
+        lookup.look_up(self.GEO_DATA, area_acres=100)
+        assert len(self._raw_look_ups) == 2
+
+    def test_shared_across_truncation_settings(self, monkeypatch):
+        cache = LookUpCache(10)
+        truncated = self._create_lookup(monkeypatch, cache=cache)
+        not_truncated = self._create_lookup(monkeypatch, cache=cache,
+            insignificance_threshold=0)
+        assert list(truncated.look_up(self.GEO_DATA)['fuelbeds']) == ['52']
+        assert list(not_truncated.look_up(self.GEO_DATA)['fuelbeds']) == ['52', '24']
+        assert len(self._raw_look_ups) == 1
+
+    def test_not_shared_across_sampling_settings(self, monkeypatch):
+        cache = LookUpCache(10)
+        self._create_lookup(monkeypatch, cache=cache).look_up(self.GEO_DATA)
+        self._create_lookup(monkeypatch, cache=cache,
+            sampling_radius_km=2.0).look_up(self.GEO_DATA)
+        assert len(self._raw_look_ups) == 2
+
+
+class TestDiskLookUpCache(object):
+
+    def test_get_and_put(self, tmp_path):
+        cache = DiskLookUpCache(str(tmp_path / 'cache.sqlite'))
+        key = ('foo.nc', '{}', None, b'\x01\x02')
+        assert cache.get(key) is None
+        cache.put(key, {'fuelbeds': {'52': {'grid_cells': 1, 'percent': 100.0}}})
+        assert cache.get(key) == {'fuelbeds': {'52': {'grid_cells': 1, 'percent': 100.0}}}
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_persisted(self, tmp_path):
+        filename = str(tmp_path / 'cache.sqlite')
+        DiskLookUpCache(filename).put('a', {'foo': 1})
+        assert DiskLookUpCache(filename).get('a') == {'foo': 1}
+
+    def test_used_by_look_up(self, tmp_path, monkeypatch):
+        filename = str(tmp_path / 'cache.sqlite')
+        raw_look_ups = []
+        def _look_up_raw(geo_data, area_acres):
+            raw_look_ups.append(geo_data)
+            return {
+                'fuelbeds': {'52': {'grid_cells': 4, 'percent': 100.0}},
+                'sampled_grid_cells': 4,
+                'sampled_area': 4014629.570957375,
+                'units': 'm^2'
+            }
+        geo_data = {"type": "Point", "coordinates": [-119.877732, 48.4255591]}
+
+        for i in range(2):
+            lookup = FccsLookUp(disk_cache_file=filename)
+            monkeypatch.setattr(lookup, '_look_up_raw', _look_up_raw)
+            assert lookup.look_up(geo_data)['fuelbeds'] == {
+                '52': {'grid_cells': 4, 'percent': 100.0}
+            }
+        assert len(raw_look_ups) == 1
+        assert lookup.disk_cache.hits == 1
+
+
+class TestBlockCache(object):
+
+    def _create_raster(self, write_raster, tiled=True):
+        data = numpy.arange(40 * 48, dtype='int32').reshape(40, 48)
+        return rasterio.open(write_raster(data, origin=(0, 40), resolution=1,
+            tiled=tiled, blockxsize=16, blockysize=16))
+
+    def test_invalid_max_size(self):
+        with raises(ValueError):
+            BlockCache(0)
+
+    def test_is_tiled(self, write_raster):
+        assert BlockCache.is_tiled(self._create_raster(write_raster))
+        assert not BlockCache.is_tiled(self._create_raster(write_raster,
+            tiled=False))
+
+    def test_read(self, write_raster):
+        from rasterio.windows import Window
+
+        dataset = self._create_raster(write_raster)
+        cache = BlockCache(100)
+        for window in (Window(0, 0, 48, 40), Window(5, 7, 20, 30),
+                Window(-3, -2, 10, 10), Window(40, 35, 12, 9),
+                Window(100, 100, 5, 5)):
+            expected = dataset.read(1, window=window, boundless=True,
+                fill_value=-9999)
+            numpy.testing.assert_array_equal(
+                cache.read(dataset, window, -9999), expected)
+        # The whole raster is 3x3 blocks, each read once
+        assert cache.stats == {
+            'size': 9, 'max_size': 100, 'hits': 8, 'misses': 9,
+            'evictions': 0
+        }
+
+    def test_least_recently_used_evicted(self, write_raster):
+        from rasterio.windows import Window
+
+        dataset = self._create_raster(write_raster)
+        cache = BlockCache(2)
+        cache.read(dataset, Window(0, 0, 32, 10), -9999)
+        cache.read(dataset, Window(0, 0, 5, 5), -9999)
+        cache.read(dataset, Window(40, 0, 5, 5), -9999)
+        assert len(cache) == 2
+        assert cache.evictions == 1
+        cache.read(dataset, Window(0, 0, 5, 5), -9999)
+        assert cache.hits == 2
+
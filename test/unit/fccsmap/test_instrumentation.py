@@ -0,0 +1,142 @@
+import concurrent.futures
+import time
+
+import numpy
+from pytest import approx
+
+from fccsmap import instrumentation
+from fccsmap.instrumentation import LookUpMetrics
+from fccsmap.lookup import FccsLookUp
+
+
+class TestStages(object):
+
+    def test_not_recorded_outside_of_call(self):
+        with instrumentation.stage('counting'):
+            instrumentation.count('geometries')
+
+    def test_nested_stages_are_exclusive(self):
+        with instrumentation.call('look_up') as call_stats:
+            with instrumentation.stage('counting'):
+                time.sleep(0.01)
+                with instrumentation.stage('raster_read'):
+                    time.sleep(0.1)
+            instrumentation.count('geometries')
+            instrumentation.count('geometries', 2)
+
+        stats = call_stats.to_dict()
+        assert stats['method'] == 'look_up'
+        assert stats['counters'] == {'geometries': 3}
+        assert stats['stage_seconds']['raster_read'] >= 0.1
+        # would be at least 0.11 if it included raster_read
+        assert 0.01 <= stats['stage_seconds']['counting'] < 0.1
+        assert stats['seconds'] >= sum(stats['stage_seconds'].values())
+
+    def test_nested_calls_are_combined(self):
+        with instrumentation.call('look_up_many') as outer:
+            with instrumentation.call('look_up') as inner:
+                instrumentation.count('geometries')
+        assert inner is outer
+        assert outer.to_dict()['counters'] == {'geometries': 1}
+
+    def test_propagating(self):
+        def _f(i):
+            with instrumentation.stage('counting'):
+                instrumentation.count('tiles_touched')
+            return i
+
+        with instrumentation.call('look_up') as call_stats:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=2) as executor:
+                assert list(executor.map(instrumentation.propagating(_f),
+                    range(3))) == [0, 1, 2]
+        assert call_stats.to_dict()['counters'] == {'tiles_touched': 3}
+        assert 'counting' in call_stats.to_dict()['stage_seconds']
+
+    def test_hooks_and_metrics(self):
+        metrics = LookUpMetrics()
+        received = []
+        def _failing_hook(stats):
+            raise RuntimeError("oops")
+
+        for i in range(2):
+            with instrumentation.call('look_up', metrics,
+                    [_failing_hook, received.append]):
+                instrumentation.count('grid_cells_counted', 10)
+        with instrumentation.call('look_up_many', metrics):
+            instrumentation.count('geometries', 5)
+
+        assert [s['counters'] for s in received] == [
+            {'grid_cells_counted': 10}, {'grid_cells_counted': 10}]
+        snapshot = metrics.snapshot
+        assert snapshot['calls'] == {'look_up': 2, 'look_up_many': 1}
+        assert snapshot['counters']['grid_cells_counted'] == 20
+        assert snapshot['counters']['geometries'] == 5
+        assert snapshot['counters']['tiles_touched'] == 0
+        assert snapshot['seconds'] == approx(
+            sum(s['seconds'] for s in received), abs=0.01)
+
+        text = metrics.to_prometheus()
+        assert 'fccsmap_calls_total{method="look_up"} 2\n' in text
+        assert 'fccsmap_grid_cells_counted_total 20\n' in text
+        assert 'fccsmap_stage_seconds_total{stage="counting"} 0.0\n' in text
+
+        metrics.reset()
+        assert metrics.snapshot['calls'] == {}
+
+
+class TestFccsLookUpInstrumentation(object):
+
+    def test_look_ups(self, write_raster, point):
+        # 20x20 raster of fuelbed 52, with a 10x10 lake (fuelbed 900)
+        data = numpy.full((20, 20), 52, dtype=numpy.int32)
+        data[5:15, 5:15] = 900
+        filename = write_raster(data)
+        point = point(10, 10)
+
+        received = []
+        lookup = FccsLookUp(fccs_fuelload_file=filename, cache_size=10,
+            instrumentation_hooks=[received.append])
+        expected = lookup.look_up(point)
+        assert lookup.look_up_many([point, point]) == [expected, expected]
+
+        assert [s['method'] for s in received] == ['look_up', 'look_up_many']
+        # The lake is sampled with radius factors 1 and 3 before
+        # reaching fuelbed 52 with factor 5, and so more grid cells are
+        # counted than are in the final sampled area
+        assert received[0]['counters'].pop('grid_cells_counted') > (
+            expected['sampled_grid_cells'] + 36)
+        assert received[0]['counters'] == {
+            'geometries': 1,
+            'sampling_escalations': 2
+        }
+        assert set(received[0]['stage_seconds']) == {'crs_load',
+            'dataframe_creation', 'reprojection', 'raster_read', 'counting',
+            'post_processing'}
+        assert received[1]['counters'] == {'geometries': 2, 'cache_hits': 2}
+
+        snapshot = lookup.metrics.snapshot
+        assert snapshot['calls'] == {'look_up': 1, 'look_up_many': 1}
+        assert snapshot['counters']['geometries'] == 3
+        assert snapshot['counters']['sampling_escalations'] == 2
+
+    def test_lock_waits_not_timed(self, write_raster):
+        filename = write_raster(numpy.full((20, 20), 52, dtype=numpy.int32))
+        lookup = FccsLookUp(fccs_fuelload_file=filename)
+
+        def _wait_for_lock(func, stage_name):
+            # Another thread holds the lock while func waits for it
+            def _call():
+                with instrumentation.call('look_up') as call_stats:
+                    func()
+                return call_stats.to_dict()['stage_seconds']
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1) as executor:
+                with lookup._raster_lock:
+                    future = executor.submit(_call)
+                    time.sleep(0.2)
+                stage_seconds = future.result()
+            assert 0 < stage_seconds[stage_name] < 0.2
+
+        _wait_for_lock(lookup._open_raster, 'crs_load')
+        _wait_for_lock(lookup._get_summed_area_tables, 'raster_read')
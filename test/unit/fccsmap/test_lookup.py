@@ -1,4 +1,10 @@
-from pytest import raises
+import asyncio
+import threading
+
+import numpy
+import rasterio
+import shapely
+from pytest import approx, fixture, raises
 
 from fccsmap.lookup import FccsLookUp
 
@@ -78,6 +84,25 @@ class TestFccsLookUp(object):
         }
         assert self._lookup.look_up(geo_data) == expected
 
+    def test_point_in_water_single_read_sampling(self):
+        lookup = FccsLookUp(single_read_sampling=True)
+        geo_data = {
+            "type": "Point",
+            # in lake chelan
+            "coordinates": [-120.3606708, 48.0364064]
+        }
+        expected = {
+            'fuelbeds': {
+                '319': {'grid_cells': 4, 'percent': 19.047619047619047},
+                '52': {'grid_cells': 10, 'percent': 47.61904761904762},
+                '60': {'grid_cells': 7, 'percent': 33.33333333333333}
+            },
+            'sampled_area': 36128384.22755571,
+            'sampled_grid_cells': 36,
+            'units': 'm^2'
+        }
+        assert lookup.look_up(geo_data) == expected
+
     def test_multipoint_one(self):
         geo_data = {
             "type": "MultiPoint",
@@ -248,6 +273,224 @@ class TestFccsLookUp(object):
         assert self._lookup.look_up(geo_data) == expected
 
 
+class TestFccsLookUpLookUpMany(object):
+
+    GEOMETRIES = [
+        {
+            "type": "Point",
+            # hills east of Methow valley
+            "coordinates": [-119.877732, 48.4255591]
+        },
+        {
+            "type": "Point",
+            # in lake chelan
+            "coordinates": [-120.3606708, 48.0364064]
+        },
+        {
+            "type": "Point",
+            # hills east of Methow valley
+            "coordinates": [-119.877732, 48.4255591]
+        }
+    ]
+    EXPECTED = [
+        {
+            'fuelbeds': {
+                '52': {'percent': 100.0, 'grid_cells': 4}
+            },
+            'sampled_grid_cells': 4,
+            'sampled_area': 4014629.570957375,
+            'units': 'm^2'
+        },
+        {
+            'fuelbeds': {
+                '319': {'grid_cells': 4, 'percent': 19.047619047619047},
+                '52': {'grid_cells': 10, 'percent': 47.61904761904762},
+                '60': {'grid_cells': 7, 'percent': 33.33333333333333}
+            },
+            'sampled_area': 36128384.22755571,
+            'sampled_grid_cells': 36,
+            'units': 'm^2'
+        },
+        {
+            'fuelbeds': {
+                '52': {'percent': 100.0, 'grid_cells': 4}
+            },
+            'sampled_grid_cells': 4,
+            'sampled_area': 406166.10213060165,
+            'units': 'm^2'
+        }
+    ]
+
+    def setup_method(self):
+        self._lookup = FccsLookUp()
+
+    def test_empty(self):
+        assert self._lookup.look_up_many([]) == []
+
+    def test_invalid_area_acres(self):
+        geometries = [{"type": "Point", "coordinates": [-119.877732, 48.4255591]}]
+        with raises(ValueError):
+            self._lookup.look_up_many(geometries, area_acres=[100, 200])
+
+    def test_multiple(self):
+        assert self._lookup.look_up_many(self.GEOMETRIES,
+            area_acres=[None, None, 100]) == self.EXPECTED
+
+    def test_multiple_in_parallel(self):
+        lookup = FccsLookUp(num_processes=2, batch_chunk_size=1)
+        assert lookup.look_up_many(self.GEOMETRIES,
+            area_acres=[None, None, 100]) == self.EXPECTED
+
+    def test_multiple_async(self):
+        lookup = FccsLookUp(batch_chunk_size=2)
+        assert asyncio.run(lookup.look_up_many_async(self.GEOMETRIES,
+            area_acres=[None, None, 100])) == self.EXPECTED
+        assert asyncio.run(lookup.look_up_async(self.GEOMETRIES[1])
+            ) == self.EXPECTED[1]
+
+
+class TestFccsLookUpAsync(object):
+
+    POINT = {"type": "Point", "coordinates": [-119.877732, 48.4255591]}
+    POLYGON = {
+        "type": "Polygon",
+        "coordinates": [[[-121.0, 47.0], [-120.9, 47.0], [-120.9, 47.1],
+            [-121.0, 47.0]]]
+    }
+
+    def setup_method(self):
+        self._raw_look_ups = []
+        self._release = threading.Event()
+        self._lock = threading.Lock()
+        self._running = 0
+        self._max_running = 0
+
+    def _look_up_raw(self, geo_data, area_acres):
+        with self._lock:
+            self._running += 1
+            self._max_running = max(self._max_running, self._running)
+        if geo_data['type'] == 'Polygon':
+            self._release.wait(5)
+        with self._lock:
+            self._running -= 1
+            self._raw_look_ups.append((geo_data['type'], area_acres))
+        return {'fuelbeds': {}, 'grid_cells': 0, 'area': 0, 'units': 'm^2'}
+
+    def _look_up_many_raw(self, geometries, area_acres):
+        return [self._look_up_raw(g, a) for g, a in zip(geometries, area_acres)]
+
+    def _create_lookup(self, monkeypatch, **options):
+        lookup = FccsLookUp(**options)
+        monkeypatch.setattr(lookup, '_look_up_raw', self._look_up_raw)
+        monkeypatch.setattr(lookup, '_look_up_many_raw', self._look_up_many_raw)
+        return lookup
+
+    def test_look_up_many_async(self, monkeypatch):
+        lookup = self._create_lookup(monkeypatch, batch_chunk_size=2)
+        results = asyncio.run(lookup.look_up_many_async([self.POINT] * 5,
+            area_acres=[1, 2, 3, 4, 5]))
+        assert len(results) == 5
+        assert self._raw_look_ups == [('Point', a) for a in range(1, 6)]
+
+    def test_large_look_ups_limited(self, monkeypatch):
+        lookup = self._create_lookup(monkeypatch, async_num_workers=3)
+
+        async def _run():
+            polygons = [asyncio.create_task(lookup.look_up_async(self.POLYGON))
+                for i in range(3)]
+            # Points are looked up while the polygons are held up, since
+            # polygons can only occupy two of the three threads
+            await asyncio.wait_for(lookup.look_up_async(self.POINT), 5)
+            assert self._raw_look_ups == [('Point', None)]
+            self._release.set()
+            await asyncio.gather(*polygons)
+
+        asyncio.run(_run())
+        assert len(self._raw_look_ups) == 4
+        assert self._max_running == 3
+
+    def test_cancel(self, monkeypatch):
+        lookup = self._create_lookup(monkeypatch, async_num_workers=1,
+            async_max_large_look_ups=2)
+
+        async def _run():
+            first = asyncio.create_task(lookup.look_up_async(self.POLYGON))
+            second = asyncio.create_task(lookup.look_up_async(self.POLYGON))
+            await asyncio.sleep(0.1)
+            second.cancel()
+            await asyncio.sleep(0.1)
+            self._release.set()
+            await first
+            with raises(asyncio.CancelledError):
+                await second
+
+        asyncio.run(_run())
+        assert self._raw_look_ups == [('Polygon', None)]
+
+    def test_cancel_running(self, monkeypatch):
+        lookup = self._create_lookup(monkeypatch, async_num_workers=2)
+
+        async def _run():
+            first = asyncio.create_task(lookup.look_up_async(self.POLYGON))
+            while not self._running:
+                await asyncio.sleep(0.01)
+            first.cancel()
+            with raises(asyncio.CancelledError):
+                await first
+
+            # The cancelled look-up is still running in its thread, so
+            # another large look-up has to wait for it, whereas point
+            # look-ups still have a thread available
+            second = asyncio.create_task(lookup.look_up_async(self.POLYGON))
+            await asyncio.wait_for(lookup.look_up_async(self.POINT), 5)
+            await asyncio.sleep(0.1)
+            assert self._running == 1
+            self._release.set()
+            await second
+
+        asyncio.run(_run())
+        assert self._raw_look_ups == [('Point', None), ('Polygon', None),
+            ('Polygon', None)]
+        lookup.close()
+
+    def test_multiple_event_loops(self, monkeypatch):
+        lookup = self._create_lookup(monkeypatch, async_num_workers=2)
+
+        async def _run():
+            polygons = [asyncio.create_task(lookup.look_up_async(self.POLYGON))
+                for i in range(2)]
+            await asyncio.sleep(0.1)
+            self._release.set()
+            await asyncio.gather(*polygons)
+
+        for i in range(2):
+            self._release.clear()
+            asyncio.run(_run())
+        assert len(self._raw_look_ups) == 4
+        assert self._max_running == 1
+        lookup.close()
+
+    def test_close(self, monkeypatch):
+        lookup = self._create_lookup(monkeypatch)
+        # Threads aren't started until needed
+        assert lookup._async_executor is None
+        lookup.close()
+
+        asyncio.run(lookup.look_up_async(self.POINT))
+        executor = lookup._async_executor
+        assert executor is not None
+        lookup.close()
+        assert lookup._async_executor is None
+        with raises(RuntimeError):
+            executor.submit(print)
+
+        # and are started again if needed after closing
+        asyncio.run(lookup.look_up_async(self.POINT))
+        assert lookup._async_executor not in (None, executor)
+        lookup.close()
+        assert len(self._raw_look_ups) == 2
+
+
 class TestFccsLookUpTransformPoints(object):
 
     def setup_method(self):
@@ -305,6 +548,304 @@ class TestFccsLookUpTransformPoints(object):
         }
         assert self._lookup._transform_points(geo_data, 1) == expected
 
+class TestFccsLookUpOpenRaster(object):
+
+    class MockRaster(object):
+        crs = 'EPSG:5070'
+        transform = 'TRANSFORM'
+        nodata = -9999
+
+    def setup_method(self):
+        self._lookup = FccsLookUp(fccs_fuelload_file='foo.nc')
+
+    def test_opened_once(self, monkeypatch):
+        opened = []
+        def _open(filename):
+            opened.append(filename)
+            return self.MockRaster()
+        monkeypatch.setattr('rasterio.open', _open)
+
+        assert self._lookup._raster is None
+        raster = self._lookup._open_raster()
+        assert self._lookup._open_raster() is raster
+        assert opened == ['foo.nc']
+        assert self._lookup._crs == 'EPSG:5070'
+        assert self._lookup._transform == 'TRANSFORM'
+        assert self._lookup._nodata == -9999
+
+    def test_opened_once_for_batches(self, write_raster, point, monkeypatch):
+        filename = write_raster(numpy.full((20, 20), 52, dtype=numpy.int32))
+
+        opened = []
+        _open = rasterio.open
+        def _open_and_record(*args, **kwargs):
+            opened.append(args[0])
+            return _open(*args, **kwargs)
+        monkeypatch.setattr('rasterio.open', _open_and_record)
+
+        lng, lat = point(10, 10)['coordinates']
+        geometries = [
+            {"type": "Point", "coordinates": [lng, lat]},
+            {"type": "Polygon", "coordinates": [[[lng, lat],
+                [lng + 0.05, lat], [lng + 0.05, lat + 0.05], [lng, lat]]]}
+        ]
+        for options in ({}, {'rasterio_engine': True}):
+            opened.clear()
+            lookup = FccsLookUp(fccs_fuelload_file=filename, **options)
+            for i in range(2):
+                results = lookup.look_up_many(geometries)
+                assert results == [lookup.look_up(g) for g in geometries]
+            assert opened == [filename]
+
+class TestFccsLookUpRasterizeAndCount(object):
+
+    def setup_method(self):
+        self._lookup = FccsLookUp(rasterio_engine=True)
+        self._data = numpy.array([
+            [1, 2, 3, 4],
+            [5, 6, 7, 8],
+            [9, 10, 11, 12],
+            [13, 14, -9999, 16]
+        ])
+        # grid cell (r, c) spans x from c to c+1 and y from 3-r to 4-r
+        self._affine = rasterio.transform.from_origin(0, 4, 1, 1)
+
+    def _count(self, shape):
+        return self._lookup._rasterize_and_count(shape, self._data,
+            self._affine, -9999)
+
+    def test_full_cells(self):
+        assert self._count(shapely.box(0.2, 1.8, 2.8, 3.8)) == {
+            1: 1, 2: 1, 3: 1, 5: 1, 6: 1, 7: 1}
+
+    def test_all_partial(self):
+        assert self._count(shapely.box(1.1, 1.1, 1.4, 1.4)) == {10: 1}
+        # nodata isn't counted
+        assert self._count(shapely.box(1.6, 0.2, 2.4, 1.8)) == {
+            10: 1, 11: 1, 14: 1}
+
+    def test_use_all_grid_cells(self):
+        self._lookup._use_all_grid_cells = True
+        assert self._count(shapely.box(0.2, 1.8, 2.8, 3.8)) == {
+            1: 1, 2: 1, 3: 1, 5: 1, 6: 1, 7: 1, 9: 1, 10: 1, 11: 1}
+
+    def test_coverage_weighting(self):
+        self._lookup._coverage_weighting = True
+        assert self._count(shapely.box(0.5, 2.5, 2.5, 3.5)) == approx({
+            1: 0.25, 2: 0.5, 3: 0.25, 5: 0.25, 6: 0.5, 7: 0.25})
+        assert self._count(shapely.box(1.1, 1.1, 1.4, 1.4)) == approx(
+            {10: 0.09})
+        # nodata isn't counted, and cells touched only on their edges
+        # (i.e. 9 and 12) are left out
+        assert self._count(shapely.box(1.0, 0.5, 3.0, 2.0)) == approx({
+            10: 1.0, 11: 1.0, 14: 0.5})
+
+
+class TestFccsLookUpChunks(object):
+
+    @fixture
+    def raster_file(self, write_raster):
+        # 64x64 grid cells, in 16x16 blocks, of random fuelbeds, with a
+        # band of nodata
+        rng = numpy.random.default_rng(0)
+        data = rng.choice([0, 52, 60, 24, 900], size=(64, 64)).astype('int32')
+        data[:, 30:33] = -9999
+        return write_raster(data, tiled=True, blockxsize=16, blockysize=16)
+
+    @fixture
+    def polygon(self, point):
+        def _polygon(*coords):
+            # coords in km from the raster's upper left corner
+            ring = [point(x, y)['coordinates'] for x, y in coords]
+            return {"type": "Polygon", "coordinates": [ring + [ring[0]]]}
+        return _polygon
+
+    def test_chunk_windows(self, raster_file):
+        from rasterio.windows import Window
+
+        lookup = FccsLookUp(chunk_memory_budget_mb=0.02)
+        with rasterio.open(raster_file) as dataset:
+            # 0.02 MB fits 551 grid cells (at 38 bytes each), i.e. two
+            # blocks; the window is clipped to the raster
+            chunks = lookup._chunk_windows(Window(5, -1, 40, 20), dataset)
+        assert [c.toranges() for c in chunks] == [
+            ((0, 16), (5, 32)), ((0, 16), (32, 45)),
+            ((16, 19), (5, 32)), ((16, 19), (32, 45))]
+
+    def test_same_as_unchunked(self, raster_file, polygon):
+        geometries = [
+            polygon((2.5, 3.2), (50.3, 10.1), (40.2, 60.7), (5.1, 45.9)),
+            polygon((20.2, 20.2), (20.4, 20.2), (20.4, 20.4)),
+            polygon((-10, -10), (80, -10), (80, 80), (-10, 80))
+        ]
+        for options in ({}, {'use_all_grid_cells': True}):
+            unchunked = FccsLookUp(fccs_fuelload_file=raster_file,
+                rasterio_engine=True, insignificance_threshold=0, **options)
+            chunked = FccsLookUp(fccs_fuelload_file=raster_file,
+                chunk_memory_budget_mb=0.001, insignificance_threshold=0,
+                **options)
+            assert chunked._rasterio_engine
+            for g in geometries:
+                expected = unchunked.look_up(g)
+                # compare fuelbed order, too
+                assert list(chunked.look_up(g)['fuelbeds'].items()) == list(
+                    expected['fuelbeds'].items())
+
+        unchunked = FccsLookUp(fccs_fuelload_file=raster_file,
+            coverage_weighting=True)
+        chunked = FccsLookUp(fccs_fuelload_file=raster_file,
+            coverage_weighting=True, chunk_memory_budget_mb=0.001)
+        for g in geometries:
+            expected = unchunked.look_up(g)
+            actual = chunked.look_up(g)
+            assert list(actual['fuelbeds']) == list(expected['fuelbeds'])
+            for fccs_id, f in expected['fuelbeds'].items():
+                assert actual['fuelbeds'][fccs_id] == approx(f)
+
+    def test_under_budget(self, raster_file, polygon, monkeypatch):
+        lookup = FccsLookUp(fccs_fuelload_file=raster_file,
+            chunk_memory_budget_mb=10)
+        monkeypatch.setattr(lookup, '_look_up_in_chunks', None)
+        lookup.look_up(polygon((2, 3), (50, 10), (40, 60)))
+
+
+class TestFccsLookUpBlockCacheAndOverviews(object):
+
+    @fixture
+    def raster_file(self, write_raster):
+        rng = numpy.random.default_rng(0)
+        data = rng.choice([0, 52, 60, 24], size=(64, 64)).astype('int32')
+        return write_raster(data, tiled=True, blockxsize=16, blockysize=16,
+            overviews=[2, 4])
+
+    def test_block_cache(self, raster_file, point):
+        geometries = [point(10.3, 20.6), point(12.1, 21.2),
+            {"type": "MultiPoint", "coordinates": [
+                point(40.5, 40.5)["coordinates"],
+                point(63.5, 0.5)["coordinates"]]}]
+        lookup = FccsLookUp(fccs_fuelload_file=raster_file)
+        cached = FccsLookUp(fccs_fuelload_file=raster_file, block_cache_size=4)
+        for g in geometries:
+            assert cached.look_up(g, 300) == lookup.look_up(g, 300)
+        assert cached.block_cache.hits > 0
+        assert lookup.block_cache is None
+
+    def test_sampling_overview(self, raster_file, point):
+        geo_data = point(30.5, 30.5)
+        lookup = FccsLookUp(fccs_fuelload_file=raster_file,
+            sampling_overview_grid_cells=8)
+        # about 10 grid cells across at the raster's resolution, and so
+        # too few across either overview
+        assert lookup.look_up(geo_data)['sampled_grid_cells'] == FccsLookUp(
+            fccs_fuelload_file=raster_file).look_up(
+                geo_data)['sampled_grid_cells']
+        assert lookup._overviews == {}
+
+        # about 20 across at the raster's resolution, and so about 10
+        # across the first overview, and 5 across the second
+        stats = lookup.look_up(geo_data, 100000)
+        assert list(lookup._overviews) == [0]
+        assert 80 <= stats['sampled_grid_cells'] <= 121
+        assert lookup._compute_raster_fingerprint() != FccsLookUp(
+            fccs_fuelload_file=raster_file)._compute_raster_fingerprint()
+
+    def test_sampling_overview_batches(self, raster_file, point, monkeypatch):
+        points = [point(30.5, 30.5), point(10.5, 12.5), point(50.5, 20.5)]
+        area_acres = [None, 100000, None]
+        lookup = FccsLookUp(fccs_fuelload_file=raster_file,
+            sampling_overview_grid_cells=8)
+        expected = [lookup.look_up(p, a) for p, a in zip(points, area_acres)]
+
+        batches = []
+        _look_up_in_file_batch = lookup._look_up_in_file_batch
+        def _record_batch(geo_data_df, *args, **kwargs):
+            batches.append(len(geo_data_df))
+            return _look_up_in_file_batch(geo_data_df, *args, **kwargs)
+        monkeypatch.setattr(lookup, '_look_up_in_file_batch', _record_batch)
+
+        assert lookup.look_up_many(points, area_acres) == expected
+        # Those to which no overview applies are looked up together
+        assert batches == [2]
+
+
+class TestFccsLookUpCountGridCells(object):
+
+    def setup_method(self):
+        self._lookup = FccsLookUp()
+        self._data = numpy.array([
+            [52, 52, -9999],
+            [0, 24, 52],
+            [24, 900, 52]
+        ])
+
+    def test_full_cells(self):
+        masked = numpy.ma.MaskedArray(self._data, mask=[
+            [False, True, True],
+            [False, False, True],
+            [True, True, False]
+        ])
+        assert self._lookup._count_grid_cells(masked) == {52: 2, 0: 1, 24: 1}
+        assert list(self._lookup._count_grid_cells(masked)) == [52, 0, 24]
+
+    def test_all_partial(self):
+        masked = numpy.ma.MaskedArray(self._data, mask=True)
+        expected = {52: 4, 0: 1, 24: 2, 900: 1}
+        assert self._lookup._count_grid_cells(masked) == expected
+
+    def test_use_all_grid_cells(self):
+        self._lookup._use_all_grid_cells = True
+        masked = numpy.ma.MaskedArray(self._data, mask=[
+            [False, True, True],
+            [True, True, True],
+            [True, True, True]
+        ])
+        expected = {52: 4, 0: 1, 24: 2, 900: 1}
+        assert self._lookup._count_grid_cells(masked) == expected
+
+    def test_empty(self):
+        masked = numpy.ma.MaskedArray(numpy.array([[-9999]]), mask=False)
+        assert self._lookup._count_grid_cells(masked) == {}
+
+class TestFccsLookUpMergePointStats(object):
+
+    def setup_method(self):
+        self._lookup = FccsLookUp()
+
+    def test_none(self):
+        expected = {'fuelbeds': {}, 'grid_cells': 0, 'area': 0, 'units': 'm^2'}
+        assert self._lookup._merge_point_stats([]) == expected
+
+    def test_multiple(self):
+        per_point_stats = [
+            {
+                'fuelbeds': {
+                    '52': {'grid_cells': 4, 'percent': 100.0}
+                },
+                'grid_cells': 4, 'area': 4.0, 'units': 'm^2'
+            },
+            {
+                'fuelbeds': {
+                    '52': {'grid_cells': 9, 'percent': 25.0},
+                    '0': {'grid_cells': 27, 'percent': 75.0}
+                },
+                'grid_cells': 36, 'area': 36.0, 'units': 'm^2'
+            },
+            {
+                'fuelbeds': {},
+                'grid_cells': 0, 'area': 100.0, 'units': 'm^2'
+            }
+        ]
+        expected = {
+            'fuelbeds': {
+                '52': {'grid_cells': 13, 'percent': 62.5},
+                '0': {'grid_cells': 27, 'percent': 37.5}
+            },
+            'grid_cells': 40,
+            'area': 40.0,
+            'units': 'm^2'
+        }
+        assert self._lookup._merge_point_stats(per_point_stats) == expected
+
 class TestFccsLookUpHasHighPercentOfIgnored(object):
 
     def setup_method(self):
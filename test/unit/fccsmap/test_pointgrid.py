@@ -0,0 +1,155 @@
+import numpy
+import rasterio
+from pytest import fixture, raises
+
+from fccsmap.lookup import FccsLookUp
+from fccsmap.pointgrid import _box_sums, create_point_grid, PointGrid
+from fccsmap.summedarea import integral_image
+
+
+# Upper left corner of the test raster, in EPSG:5070, which
+# is near -120.0, 47.4
+ORIGIN = (-1850000.0, 2990000.0)
+
+@fixture
+def raster_file(write_raster):
+    """Writes a 40x40 raster of 1km grid cells, mostly fuelbed 52, with
+    a 15x15 lake (fuelbed 900) in the northwest and some fuelbed 24 in
+    the northeast corner
+    """
+    data = numpy.full((40, 40), 52, dtype=numpy.int32)
+    data[5:20, 5:20] = 900
+    data[0:4, 36:40] = 24
+    return write_raster(data, origin=ORIGIN)
+
+@fixture
+def cell_center(point):
+    """Returns a function that returns the center of a grid
+    cell, by row and column, in lng/lat
+    """
+    return lambda row, col: point(col + 0.5, row + 0.5, ORIGIN)
+
+
+class TestBoxSums(object):
+
+    def test_matches_brute_force(self):
+        array = numpy.random.default_rng(0).integers(0, 2, (7, 9))
+        table = integral_image(array, 2)
+        for k in (0, 1, 2):
+            sums = _box_sums(table, 2, k, array.shape)
+            for r in range(7):
+                for c in range(9):
+                    assert sums[r, c] == array[max(0, r-k):r+k+1,
+                        max(0, c-k):c+k+1].sum()
+
+
+class TestPointGrid(object):
+
+    def test_look_up(self, cell_center, raster_file, tmp_path):
+        create_point_grid(raster_file, str(tmp_path / 'grid'))
+        grid = PointGrid(str(tmp_path / 'grid'))
+
+        # 3x3 neighborhood
+        assert grid.look_up(*cell_center(30, 30)['coordinates']) == {
+            'fuelbeds': {'52': {'percent': 100.0, 'grid_cells': 9}},
+            'grid_cells': 9, 'area': 9000000.0, 'units': 'm^2'
+        }
+        # straddling fuelbeds 52 and 24
+        stats = grid.look_up(*cell_center(3, 35)['coordinates'])
+        assert stats['fuelbeds'] == {
+            '24': {'percent': 100.0 * 2 / 9, 'grid_cells': 2},
+            '52': {'percent': 100.0 * 7 / 9, 'grid_cells': 7},
+        }
+        # 3x3 and 7x7 neighborhoods in the lake are entirely fuelbed 900,
+        # so the 11x11 neighborhood is used
+        stats = grid.look_up(*cell_center(8, 8)['coordinates'])
+        assert stats['grid_cells'] == 121
+        assert stats['fuelbeds']['900']['grid_cells'] == 81
+        assert stats['fuelbeds']['52']['grid_cells'] == 40
+        # beyond the raster
+        assert grid.look_up(-100.0, 40.0) is None
+
+    def test_max_fuelbeds(self, cell_center, raster_file, tmp_path):
+        create_point_grid(raster_file, str(tmp_path / 'grid'),
+            max_fuelbeds=1)
+        grid = PointGrid(str(tmp_path / 'grid'))
+        stats = grid.look_up(*cell_center(3, 35)['coordinates'])
+        assert list(stats['fuelbeds']) == ['52']
+        assert stats['grid_cells'] == 9
+        # percentages are of the fuelbeds kept
+        assert stats['fuelbeds']['52'] == {'percent': 100.0, 'grid_cells': 7}
+
+        # 11x11 neighborhood, with 81 cells of the lake, which is ignored
+        stats = grid.look_up(*cell_center(8, 8)['coordinates'])
+        assert stats['fuelbeds'] == {
+            '900': {'percent': 100.0 * 81 / 121, 'grid_cells': 81},
+            '52': {'percent': 100.0 * 40 / 121, 'grid_cells': 40},
+        }
+
+    def test_non_negative_nodata(self, write_raster, cell_center, tmp_path):
+        # Unsigned rasters' nodata is typically non-negative
+        data = numpy.full((40, 40), 52, dtype=numpy.uint8)
+        data[28:31, 28:30] = 255
+        data[0:4, 36:40] = 24
+        filename = write_raster(data, origin=ORIGIN, nodata=255)
+
+        create_point_grid(filename, str(tmp_path / 'grid'), max_fuelbeds=1)
+        grid = PointGrid(str(tmp_path / 'grid'))
+        assert grid.look_up(*cell_center(30, 30)['coordinates']) == {
+            'fuelbeds': {'52': {'percent': 100.0, 'grid_cells': 7}},
+            'grid_cells': 7, 'area': 9000000.0, 'units': 'm^2'
+        }
+
+
+class TestFccsLookUpPointGrid(object):
+
+    def test_look_up(self, cell_center, raster_file, tmp_path):
+        create_point_grid(raster_file, str(tmp_path / 'grid'))
+        lookup = FccsLookUp(fccs_fuelload_file=raster_file,
+            point_grid_directory=str(tmp_path / 'grid'))
+        expected = {
+            'fuelbeds': {'52': {'percent': 100.0, 'grid_cells': 40}},
+            'sampled_grid_cells': 121,
+            'sampled_area': 121000000.0,
+            'units': 'm^2'
+        }
+        assert lookup.look_up(cell_center(8, 8)) == expected
+        assert lookup.look_up_many([cell_center(8, 8)]) == [expected]
+
+    def test_not_used_with_area(self, cell_center, raster_file, tmp_path, monkeypatch):
+        create_point_grid(raster_file, str(tmp_path / 'grid'))
+        lookup = FccsLookUp(fccs_fuelload_file=raster_file,
+            point_grid_directory=str(tmp_path / 'grid'))
+        monkeypatch.setattr(lookup._point_grid, 'look_up',
+            lambda lng, lat: 1/0)
+        lookup.look_up(cell_center(30, 30), area_acres=1000)
+        lookup.look_up_many([cell_center(30, 30)], area_acres=1000)
+
+    def test_mismatched_settings(self, raster_file, tmp_path):
+        create_point_grid(raster_file, str(tmp_path / 'grid'))
+        with raises(ValueError):
+            FccsLookUp(fccs_fuelload_file=raster_file,
+                point_grid_directory=str(tmp_path / 'grid'),
+                sampling_radius_factors=[1, 2])
+        for option in ('use_all_grid_cells', 'coverage_weighting'):
+            with raises(ValueError):
+                FccsLookUp(fccs_fuelload_file=raster_file,
+                    point_grid_directory=str(tmp_path / 'grid'),
+                    **{option: True})
+
+    def test_mismatched_raster(self, raster_file, write_raster, tmp_path):
+        create_point_grid(raster_file, str(tmp_path / 'grid'))
+        with rasterio.open(raster_file) as src:
+            data = src.read(1)
+
+        # same data, elsewhere
+        other_file = write_raster(data, 'other.tif', origin=ORIGIN)
+        with raises(ValueError):
+            FccsLookUp(fccs_fuelload_file=other_file,
+                point_grid_directory=str(tmp_path / 'grid'))
+
+        # same file, shifted
+        write_raster(data, origin=(ORIGIN[0] + 1, ORIGIN[1]))
+        with raises(ValueError):
+            FccsLookUp(fccs_fuelload_file=raster_file,
+                point_grid_directory=str(tmp_path / 'grid'))
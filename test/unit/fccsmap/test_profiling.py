@@ -0,0 +1,84 @@
+import json
+import os
+import pstats
+
+import numpy
+from pytest import fixture, raises
+
+from fccsmap.lookup import FccsLookUp
+from fccsmap.profiling import LookUpProfiler
+
+
+@fixture
+def raster_file(write_raster):
+    return write_raster(numpy.full((20, 20), 52, dtype=numpy.int32))
+
+@fixture
+def geo_data(point):
+    return point(10, 10)
+
+def _files(directory):
+    return sorted(os.listdir(directory)) if os.path.exists(directory) else []
+
+
+class TestLookUpProfiler(object):
+
+    def test_requires_threshold(self, tmp_path):
+        with raises(ValueError):
+            LookUpProfiler(str(tmp_path))
+
+    def test_disabled(self, raster_file, geo_data, tmp_path):
+        lookup = FccsLookUp(fccs_fuelload_file=raster_file,
+            profile_latency_threshold=0)
+        assert lookup._profiler is None
+        lookup.look_up(geo_data)
+
+    def test_under_thresholds(self, raster_file, geo_data, tmp_path):
+        profile_dir = str(tmp_path / 'profiles')
+        lookup = FccsLookUp(fccs_fuelload_file=raster_file,
+            profile_directory=profile_dir, profile_latency_threshold=60,
+            profile_memory_threshold_mb=1024)
+        lookup.look_up(geo_data)
+        lookup.look_up_many([geo_data, geo_data])
+        assert _files(profile_dir) == []
+
+    def test_latency(self, raster_file, geo_data, tmp_path):
+        profile_dir = str(tmp_path / 'profiles')
+        lookup = FccsLookUp(fccs_fuelload_file=raster_file,
+            profile_directory=profile_dir, profile_latency_threshold=0)
+        expected = lookup.look_up(geo_data, 100)
+
+        files = _files(profile_dir)
+        assert [os.path.splitext(f)[1] for f in files] == ['.json', '.prof']
+        with open(os.path.join(profile_dir, files[0])) as f:
+            profile = json.load(f)
+        assert profile['method'] == 'look_up'
+        assert profile['geo_data'] == geo_data
+        assert profile['area_acres'] == 100
+        assert profile['peak_memory_mb'] is None
+        assert profile['instrumentation']['counters']['geometries'] == 1
+        stats = pstats.Stats(os.path.join(profile_dir, files[1]))
+        assert any(func[2] == '_look_up_raw' for func in stats.stats)
+
+        # Results are unaffected by profiling
+        assert FccsLookUp(fccs_fuelload_file=raster_file).look_up(
+            geo_data, 100) == expected
+
+    def test_memory(self, raster_file, geo_data, tmp_path):
+        import tracemalloc
+
+        profile_dir = str(tmp_path / 'profiles')
+        lookup = FccsLookUp(fccs_fuelload_file=raster_file,
+            profile_directory=profile_dir, profile_memory_threshold_mb=0)
+        lookup.look_up_many([geo_data, geo_data])
+        assert not tracemalloc.is_tracing()
+
+        files = _files(profile_dir)
+        assert [f.split('.', 1)[1] for f in files] == ['json', 'memory.txt']
+        with open(os.path.join(profile_dir, files[0])) as f:
+            profile = json.load(f)
+        assert profile['method'] == 'look_up_many'
+        assert profile['geo_data'] == [geo_data, geo_data]
+        assert profile['peak_memory_mb'] > 0
+        with open(os.path.join(profile_dir, files[1])) as f:
+            assert f.read().strip()
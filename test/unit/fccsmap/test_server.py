@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from pytest import fixture
+
+from fccsmap import instrumentation
+from fccsmap.instrumentation import LookUpMetrics
+from fccsmap.server import LookUpServer
+
+
+class FakeLookUp(object):
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.release.set()
+
+    def look_up(self, geo_data, area_acres=None):
+        self.release.wait()
+        if area_acres is not None and area_acres < 0:
+            raise ValueError("area_acres must be positive")
+        if geo_data['coordinates'] == [0, 0]:
+            raise RuntimeError("Failed to read raster")
+        return {'geo_data': geo_data, 'area_acres': area_acres}
+
+    def look_up_many(self, geometries, area_acres=None):
+        return [self.look_up(g, area_acres) for g in geometries]
+
+
+@fixture
+def lookup():
+    return FakeLookUp()
+
+@fixture
+def server(lookup):
+    server = LookUpServer(lookup, port=0, num_workers=1, max_queue_size=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    lookup.release.set()
+    server.shutdown()
+
+def _request(server, path, body=None):
+    url = 'http://{}:{}{}'.format(*server.server_address, path)
+    data = json.dumps(body).encode() if body is not None else None
+    try:
+        with urllib.request.urlopen(url, data=data) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+POINT = {"type": "Point", "coordinates": [-121.4522115, 47.4316976]}
+
+class TestLookUpServer(object):
+
+    def test_health(self, server):
+        assert _request(server, '/health') == (200, {'status': 'ok'})
+
+    def test_not_found(self, server):
+        assert _request(server, '/foo')[0] == 404
+        assert _request(server, '/foo', {})[0] == 404
+
+    def test_look_up(self, server):
+        assert _request(server, '/look-up', POINT) == (200,
+            {'geo_data': POINT, 'area_acres': None})
+        assert _request(server, '/look-up',
+                {'geo_data': POINT, 'area_acres': 10}) == (200,
+            {'geo_data': POINT, 'area_acres': 10})
+        assert _request(server, '/look-up', {'type': 'Feature',
+                'geometry': POINT, 'properties': {'area_acres': 20}}) == (200,
+            {'geo_data': POINT, 'area_acres': 20})
+
+    def test_look_up_many(self, server):
+        assert _request(server, '/look-up-many',
+                {'geometries': [POINT, POINT], 'area_acres': 5}) == (200,
+            [{'geo_data': POINT, 'area_acres': 5}] * 2)
+
+    def test_errors(self, server):
+        # invalid requests
+        assert _request(server, '/look-up', {'type': 'Bogus'}) == (400,
+            {'error': "Invalid geometry: Unknown geometry type: 'bogus'"})
+        assert _request(server, '/look-up',
+            {'type': 'Point', 'coordinates': 'x'})[0] == 400
+        assert _request(server, '/look-up', [POINT])[0] == 400
+        assert _request(server, '/look-up', {'type': 'Feature',
+            'geometry': POINT, 'properties': 'x'})[0] == 400
+        assert _request(server, '/look-up',
+            {'geo_data': POINT, 'area_acres': -1}) == (400,
+            {'error': "area_acres must be positive"})
+        assert _request(server, '/look-up-many', {})[0] == 400
+        assert _request(server, '/look-up-many',
+            {'geometries': [POINT, {'type': 'Bogus'}]})[0] == 400
+        # failed look-ups
+        status, body = _request(server, '/look-up',
+            {"type": "Point", "coordinates": [0, 0]})
+        assert status == 500
+        assert 'Failed to read raster' in body['error']
+        metrics = _request(server, '/metrics')[1]
+        assert metrics['errors'] == 8
+        assert metrics['requests'] == 9
+        # only the two accepted by the server
+        assert metrics['look_ups'] == 2
+
+    def test_too_many_pending(self, server, lookup):
+        lookup.release.clear()
+        # One is worked on and one is queued
+        threads = [threading.Thread(target=_request,
+            args=(server, '/look-up', POINT)) for i in range(2)]
+        for t in threads:
+            t.start()
+        try:
+            deadline = time.time() + 5
+            while server.metrics['pending'] < 2:
+                assert time.time() < deadline, "Look-ups weren't queued"
+                time.sleep(0.01)
+            assert _request(server, '/look-up', POINT)[0] == 503
+        finally:
+            lookup.release.set()
+            for t in threads:
+                t.join()
+        metrics = _request(server, '/metrics')[1]
+        assert metrics['rejected'] == 1
+        # the rejected look-up isn't counted
+        assert metrics['look_ups'] == 2
+        assert metrics['pending'] == 0
+        assert set(metrics['latency']) == {'p50', 'p99', 'max'}
+
+    def test_look_up_metrics(self, server, lookup):
+        assert _request(server, '/metrics/prometheus')[0] == 404
+        assert 'look_up' not in _request(server, '/metrics')[1]
+
+        lookup.metrics = LookUpMetrics()
+        with instrumentation.call('look_up', lookup.metrics):
+            instrumentation.count('geometries')
+        metrics = _request(server, '/metrics')[1]
+        assert metrics['look_up']['calls'] == {'look_up': 1}
+        assert metrics['look_up']['counters']['geometries'] == 1
+
+        url = 'http://{}:{}/metrics/prometheus'.format(*server.server_address)
+        with urllib.request.urlopen(url) as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert 'fccsmap_geometries_total 1\n' in response.read().decode()
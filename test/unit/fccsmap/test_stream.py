@@ -0,0 +1,99 @@
+import io
+import json
+
+from fccsmap.stream import look_up_batch, parse_ndjson_line, stream
+
+
+class FakeLookUp(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def look_up(self, geo_data, area_acres=None):
+        if geo_data['type'] == 'Bogus':
+            raise ValueError("Unknown geometry type: 'bogus'")
+        return {'geo_data': geo_data, 'area_acres': area_acres}
+
+    def look_up_many(self, geometries, area_acres=None):
+        self.batches.append(len(geometries))
+        return [self.look_up(g, a) for g, a in zip(geometries, area_acres)]
+
+
+POINT = {"type": "Point", "coordinates": [-121.4522115, 47.4316976]}
+BOGUS = {"type": "Bogus", "coordinates": []}
+
+def _stream(lines, batch_size=1):
+    lookup = FakeLookUp()
+    output = io.StringIO()
+    stream(lookup, io.StringIO('\n'.join(lines) + '\n'), batch_size, output)
+    return lookup, [json.loads(line) for line in
+        output.getvalue().splitlines()]
+
+
+class TestParseNdjsonLine(object):
+
+    def test_geometry(self):
+        assert parse_ndjson_line(json.dumps(POINT)) == (POINT, None)
+
+    def test_feature(self):
+        assert parse_ndjson_line(json.dumps({'type': 'Feature',
+            'geometry': POINT, 'properties': {'area_acres': 500}})) == (
+            POINT, 500)
+        assert parse_ndjson_line(json.dumps({'type': 'Feature',
+            'geometry': POINT, 'properties': None})) == (POINT, None)
+
+
+class TestLookUpBatch(object):
+
+    def test_look_up_many(self):
+        lookup = FakeLookUp()
+        results = list(look_up_batch(lookup, [(POINT, 10, None),
+            (None, None, "Invalid input: foo"), (POINT, None, None)]))
+        assert results == [
+            {'geo_data': POINT, 'area_acres': 10},
+            {'error': "Invalid input: foo"},
+            {'geo_data': POINT, 'area_acres': None},
+        ]
+        assert lookup.batches == [2]
+
+    def test_falls_back_to_individual_look_ups(self):
+        lookup = FakeLookUp()
+        results = list(look_up_batch(lookup, [(POINT, 10, None),
+            (BOGUS, None, None), (None, None, "Invalid input: foo"),
+            (POINT, 20, None)]))
+        assert results == [
+            {'geo_data': POINT, 'area_acres': 10},
+            {'error': "Unknown geometry type: 'bogus'"},
+            {'error': "Invalid input: foo"},
+            {'geo_data': POINT, 'area_acres': 20},
+        ]
+
+
+class TestStream(object):
+
+    LINES = [
+        json.dumps(POINT),
+        '{"type": "Point", ',
+        '',
+        json.dumps(BOGUS),
+        json.dumps({'type': 'Feature', 'geometry': POINT,
+            'properties': {'area_acres': 500}}),
+        '[]',
+    ]
+
+    def test_aligned_with_input(self):
+        for batch_size in (1, 2, 10):
+            lookup, results = _stream(self.LINES, batch_size)
+            # one line of output per non-blank line of input
+            assert len(results) == 5
+            assert results[0] == {'geo_data': POINT, 'area_acres': None}
+            assert results[1]['error'].startswith("Invalid input: ")
+            assert results[2] == {'error': "Unknown geometry type: 'bogus'"}
+            assert results[3] == {'geo_data': POINT, 'area_acres': 500}
+            assert results[4]['error'].startswith("Invalid input: ")
+
+    def test_batches(self):
+        lines = [json.dumps(POINT)] * 5
+        lookup, results = _stream(lines, 2)
+        assert lookup.batches == [2, 2, 1]
+        assert results == [{'geo_data': POINT, 'area_acres': None}] * 5
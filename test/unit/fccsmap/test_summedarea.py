@@ -0,0 +1,95 @@
+import numpy
+from pytest import approx
+
+from fccsmap.lookup import FccsLookUp
+from fccsmap.summedarea import SummedAreaTables
+
+
+def _count(array, windows):
+    """Counts fuelbeds in order of first occurrence, window by window"""
+    counts = {}
+    for r0, r1, c0, c1 in windows:
+        for v in array[max(r0, 0):r1, max(c0, 0):c1].ravel().tolist():
+            if v >= 0:
+                counts[v] = counts.get(v, 0) + 1
+    return counts
+
+
+class TestSummedAreaTables(object):
+
+    ARRAY = numpy.array([
+        [52, 52, 24, 900, -9999],
+        [52, 61, 24, 900, 900],
+        [4, 61, 52, 52, 900],
+        [4, 4, 319, 52, 0],
+    ])
+
+    def test_count(self):
+        # tables for 0, 900, and the two most prevalent others (52, 4)
+        tables = SummedAreaTables(self.ARRAY, max_fuelbeds=2,
+            always_included=[0, 900])
+        for windows in (
+                [(0, 4, 0, 5)],
+                [(0, 1, 1, 4), (1, 3, 0, 2)],
+                [(1, 2, 1, 3), (2, 3, 0, 5), (3, 4, 2, 3)],
+                # clipped to the raster
+                [(-2, 2, 3, 9)],
+                [(2, 6, -1, 2)]):
+            counts = tables.count(windows)
+            assert counts == _count(self.ARRAY, windows)
+            assert list(counts) == list(_count(self.ARRAY, windows))
+
+    def test_non_negative_nodata(self):
+        # Unsigned rasters' nodata is typically non-negative
+        array = numpy.where(self.ARRAY < 0, 255, self.ARRAY).astype(
+            numpy.uint16)
+        array[1, 1] = 255
+        expected = _count(numpy.where(array == 255, -1, array.astype(int)),
+            [(0, 4, 0, 5)])
+        for max_fuelbeds in (0, 2, 8):
+            tables = SummedAreaTables(array, max_fuelbeds=max_fuelbeds,
+                always_included=[0, 900], nodata=255)
+            assert 255 not in tables._fccs_ids
+            counts = tables.count([(0, 4, 0, 5)])
+            assert counts == expected
+            assert list(counts) == list(expected)
+
+    def test_empty(self):
+        tables = SummedAreaTables(self.ARRAY)
+        assert tables.count([]) == {}
+        assert tables.count([(5, 6, 0, 5)]) == {}
+        assert tables.count([(0, 1, 4, 5)]) == {}
+
+
+class TestFccsLookUpSummedAreaTables(object):
+
+    def test_matches_sampling(self, write_raster):
+        rng = numpy.random.default_rng(0)
+        data = rng.choice([0, 900, 52, 24, 61, 4],
+            size=(40, 60)).astype(numpy.int32)
+        data[10:30, 15:40] = 900
+        filename = write_raster(data, origin=(-1870000.0, 2990000.0))
+
+        geometries = [
+            # beyond the raster
+            {"type": "Point", "coordinates": [-119.0, 47.0]},
+            {"type": "Point", "coordinates": [-120.35, 47.6]},
+            # in the lake
+            {"type": "Point", "coordinates": [-120.597, 47.566]},
+            # overlapping squares
+            {"type": "MultiPoint", "coordinates": [
+                [-120.35, 47.6], [-120.34, 47.6], [-120.8, 47.5]]},
+        ]
+        for options in ({}, {'use_all_grid_cells': True},
+                {'summed_area_table_fuelbeds': 1}):
+            lookup = FccsLookUp(fccs_fuelload_file=filename, **options)
+            sat_lookup = FccsLookUp(fccs_fuelload_file=filename,
+                summed_area_tables=True, **options)
+            for g in geometries:
+                expected = lookup.look_up(g)
+                stats = sat_lookup.look_up(g)
+                assert stats.pop('sampled_area') == approx(
+                    expected.pop('sampled_area'))
+                assert stats == expected
+                assert (g['coordinates'][0] == -119.0
+                    or stats['sampled_grid_cells'] > 0)
@@ -0,0 +1,198 @@
+import contextlib
+import os
+import threading
+
+import geopandas
+import numpy
+import pyproj
+import shapely
+from pytest import fixture
+
+from fccsmap.lookup import FccsLookUp
+from fccsmap.tileslookup import FccsTilesLookUp, create_compact_index
+
+
+# Upper left corner of the test raster, in EPSG:5070, which
+# is near -120.0, 47.4
+ORIGIN = (-1850000.0, 2990000.0)
+
+@fixture
+def raster_file(write_raster, tmp_path):
+    """Writes a 20x40 raster of 1km grid cells, with fuelbed 52 in the
+    west and 24 in the east, and splits it into two 20x20 tiles
+    """
+    data = numpy.full((20, 40), 52, dtype=numpy.int32)
+    data[:, 20:] = 24
+    filename = write_raster(data, origin=ORIGIN)
+
+    records = []
+    for i in range(2):
+        name = f"fccs_{i}.tif"
+        x = ORIGIN[0] + i * 20000
+        write_raster(data[:, i * 20:(i + 1) * 20], 'tiles/' + name,
+            origin=(x, ORIGIN[1]))
+        records.append({'location': name, 'geometry': shapely.box(
+            x, ORIGIN[1] - 20000, x + 20000, ORIGIN[1])})
+    geopandas.GeoDataFrame(records, crs='EPSG:5070').to_file(
+        str(tmp_path / 'tiles' / 'index.shp'))
+
+    return filename
+
+@fixture
+def coords(point):
+    """Returns a function that returns the lng/lat coordinates x
+    meters east and y meters south of the test raster's origin
+    """
+    return lambda x, y: point(x / 1000, y / 1000, ORIGIN)['coordinates']
+
+@fixture
+def geometries(coords):
+    """Returns geometries within, straddling, and outside of the tiles"""
+    def _polygon(*vertices):
+        return {"type": "Polygon", "coordinates": [
+            [coords(x, y) for x, y in vertices + vertices[:1]]]}
+    return [
+        {"type": "Point", "coordinates": coords(5500, 5500)},
+        {"type": "Point", "coordinates": coords(20000, 10000)},
+        {"type": "MultiPoint", "coordinates": [coords(3000, 4000),
+            coords(37000, 16000)]},
+        _polygon((15000, 5000), (25000, 5000), (25000, 15000)),
+        _polygon((2000, 2000), (8000, 2000), (8000, 8000), (2000, 8000)),
+        _polygon((50000, 5000), (60000, 5000), (60000, 15000)),
+    ]
+
+
+class TestFccsTilesLookUp(object):
+
+    def test_overlapping_sampling_squares(self, raster_file, coords,
+            tmp_path):
+        # The points' sampling squares overlap, and straddle the tiles
+        geo_data = {"type": "MultiPoint", "coordinates": [
+            coords(19600, 10000), coords(20400, 10500)]}
+
+        expected = FccsLookUp(fccs_fuelload_file=raster_file).look_up(geo_data)
+        stats = FccsTilesLookUp(tiles_directory=str(tmp_path / 'tiles')
+            ).look_up(geo_data)
+        assert set(stats['fuelbeds']) == {'24', '52'}
+        assert stats['fuelbeds'] == expected['fuelbeds']
+        assert stats['sampled_grid_cells'] == expected['sampled_grid_cells']
+
+    def test_instrumentation(self, raster_file, coords, tmp_path):
+        received = []
+        lookup = FccsTilesLookUp(tiles_directory=str(tmp_path / 'tiles'),
+            tile_concurrency=2, instrumentation_hooks=[received.append])
+        # straddles the two tiles
+        lookup.look_up({"type": "Polygon", "coordinates": [[
+            coords(x, y) for x, y in [(15000, 5000), (25000, 5000),
+                (25000, 15000), (15000, 15000), (15000, 5000)]]]})
+        assert received[0]['counters']['tiles_touched'] == 2
+        assert received[0]['counters']['grid_cells_counted'] > 0
+        assert {'tile_matching', 'counting', 'aggregation'} <= set(
+            received[0]['stage_seconds'])
+
+    def test_tile_concurrency(self, raster_file, geometries, tmp_path,
+            monkeypatch):
+        tiles_directory = str(tmp_path / 'tiles')
+        sequential = FccsTilesLookUp(tiles_directory=tiles_directory)
+        expected = [sequential.look_up(g) for g in geometries]
+        assert sequential.look_up_many(geometries) == expected
+
+        lookup = FccsTilesLookUp(tiles_directory=tiles_directory,
+            tile_concurrency=2)
+        threads = set()
+        _look_up_in_file_batch = lookup._look_up_in_file_batch
+        def _record_thread(*args, **kwargs):
+            threads.add(threading.current_thread())
+            return _look_up_in_file_batch(*args, **kwargs)
+        monkeypatch.setattr(lookup, '_look_up_in_file_batch', _record_thread)
+
+        assert [lookup.look_up(g) for g in geometries] == expected
+        threads.clear()
+        # Both tiles are looked up at once, in pooled threads
+        assert lookup.look_up_many(geometries) == expected
+        assert threading.current_thread() not in threads
+        assert len(threads) >= 2
+
+    def test_concurrent_tile_reads(self, raster_file, geometries, tmp_path,
+            monkeypatch):
+        # Tiles are opened per look-up, so reads of different tiles
+        # aren't serialized; each waits, while reading, for the other
+        lookup = FccsTilesLookUp(tiles_directory=str(tmp_path / 'tiles'),
+            tile_concurrency=2, rasterio_engine=True)
+        barrier = threading.Barrier(2, timeout=5)
+        _dataset_lock = lookup._dataset_lock
+        @contextlib.contextmanager
+        def _waiting_lock(dataset):
+            with _dataset_lock(dataset):
+                barrier.wait()
+                yield
+        monkeypatch.setattr(lookup, '_dataset_lock', _waiting_lock)
+        geo_data = geometries[3]
+        stats = lookup.look_up(geo_data)
+        assert stats == FccsTilesLookUp(
+            tiles_directory=str(tmp_path / 'tiles'),
+            rasterio_engine=True).look_up(geo_data)
+        assert set(stats['fuelbeds']) == {'24', '52'}
+
+        # whereas reads of FccsLookUp's raster, which is shared, are
+        fccs_lookup = FccsLookUp(fccs_fuelload_file=raster_file)
+        assert (fccs_lookup._dataset_lock(fccs_lookup._open_raster())
+            is fccs_lookup._raster_lock)
+
+    def test_find_matching_tiles(self, raster_file, geometries, tmp_path):
+        tiles_directory = str(tmp_path / 'tiles')
+        lookup = FccsTilesLookUp(tiles_directory=tiles_directory)
+        geo_data_df = lookup._create_geo_data_df(geometries[3:])
+        matching_tiles = [(tile_index, indices.tolist()) for tile_index, indices
+            in lookup._find_matching_tiles(geo_data_df)]
+
+        # Compare with a spatial join against the index shapefile
+        tiles_df = geopandas.read_file(tiles_directory + '/index.shp')
+        matches = tiles_df.sjoin(geo_data_df.reset_index(drop=True),
+            rsuffix='geo_data')
+        expected = sorted((int(tile_index), sorted(
+                m['index_geo_data'].tolist()))
+            for tile_index, m in matches.groupby(level=0))
+        assert matching_tiles == expected
+        # the polygon straddling the tiles, and the one in the west
+        assert matching_tiles == [(0, [0, 1]), (1, [0])]
+
+
+class TestCompactIndex(object):
+
+    def test_round_trip(self, raster_file, geometries, tmp_path):
+        tiles_directory = str(tmp_path / 'tiles')
+        shapefile_lookup = FccsTilesLookUp(tiles_directory=tiles_directory)
+        assert shapefile_lookup._index_file.endswith('index.shp')
+
+        create_compact_index(tiles_directory + '/index.shp',
+            tiles_directory + '/index.npy')
+        lookup = FccsTilesLookUp(tiles_directory=tiles_directory)
+        assert lookup._index_file.endswith('index.npy')
+
+        assert list(lookup._tile_locations) == list(
+            shapefile_lookup._tile_locations)
+        assert all(shapely.equals(lookup._tile_geometries,
+            shapefile_lookup._tile_geometries))
+        assert pyproj.CRS(lookup._crs) == pyproj.CRS(shapefile_lookup._crs)
+
+        assert lookup.look_up_many(geometries) == (
+            shapefile_lookup.look_up_many(geometries))
+
+    def test_selection(self, raster_file, tmp_path):
+        tiles_directory = str(tmp_path / 'tiles')
+        create_compact_index(tiles_directory + '/index.shp',
+            tiles_directory + '/index.npy')
+
+        def _index_file(**options):
+            return os.path.basename(FccsTilesLookUp(
+                tiles_directory=tiles_directory, **options)._index_file)
+
+        assert _index_file() == 'index.npy'
+        # an explicitly specified shapefile takes precedence over the
+        # default compact index, but not over one specified explicitly
+        assert _index_file(index_shapefile='index.shp') == 'index.shp'
+        assert _index_file(index_shapefile='index.shp',
+            compact_index_file='index.npy') == 'index.npy'
+        # a missing compact index falls back to the shapefile
+        assert _index_file(compact_index_file='foo.npy') == 'index.shp'